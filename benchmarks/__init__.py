@@ -0,0 +1,16 @@
+"""
+Performance benchmarks of infinibatch pipelines.
+
+Run from the root of the repository, e.g.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json    # after a change, compare against the saved results
+
+`run` measures the throughput of the standard pipelines defined in `pipelines`, over synthetic in-memory chunks
+and over gzipped chunk files created by `data`. The other modules measure specific trade-offs:
+
+    python -m benchmarks.checkpoint_restore              # latency of checkpointing and restoring standard pipelines
+    python -m benchmarks.parallel_map_backends           # thread vs. process backends of ParallelMapIterator
+    python -m benchmarks.per_item_overhead               # per-item overhead of the iterators themselves
+    python -m benchmarks.prefetch_checkpoint_interval    # checkpoint_interval of PrefetchIterator vs. throughput and resume time
+"""
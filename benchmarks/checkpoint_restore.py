@@ -0,0 +1,75 @@
+#!/usr/bin/python3.6
+
+# Measures the latency of checkpointing and restoring standard pipelines at several scales:
+# the time of getstate(), the size of the checkpoint, the time of setstate(), and the time to the first item after setstate(),
+# along with the number of items re-read on restore as estimated by estimate_resume_cost().
+# The scale is the size of the shuffle buffer, read-ahead window, or prefetch buffer, respectively.
+# Example:
+#   python -m benchmarks.checkpoint_restore --scales 1000 10000 100000
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from benchmarks.data import create_chunks, write_gzip_chunks, read_gzip_chunk
+from infinibatch.checkpoints import serialize_checkpoint
+from infinibatch.datasets import chunked_dataset_iterator
+from infinibatch.iterators import BucketedReadaheadBatchIterator, estimate_resume_cost
+
+
+def _pipelines(chunk_paths):
+    return {
+        'blockwise-shuffle':     lambda scale: chunked_dataset_iterator(chunk_paths, read_gzip_chunk, buffer_size=scale, seed=1),
+        'buffered-shuffle':      lambda scale: chunked_dataset_iterator(chunk_paths, read_gzip_chunk, buffer_size=scale, seed=1, use_windowed=True),
+        'prefetch':              lambda scale: chunked_dataset_iterator(chunk_paths, read_gzip_chunk, buffer_size=scale, seed=1, prefetch=True),
+        'bucketed-readahead':    lambda scale: BucketedReadaheadBatchIterator(chunked_dataset_iterator(chunk_paths, read_gzip_chunk, buffer_size=1000, seed=1),
+                                                                              read_ahead=scale, key=len, batch_size=32, seed=1),
+    }
+
+
+def _measure(create, scale: int, num_items: int):
+    it = create(scale)
+    for _ in range(num_items):
+        next(it)
+    start = time.perf_counter()
+    checkpoint = it.getstate()
+    getstate_seconds = time.perf_counter() - start
+    checkpoint_size = len(serialize_checkpoint(checkpoint))
+    replayed_items = sum(stage['replayed_items'] for stage in estimate_resume_cost(it, checkpoint))
+    expected = next(it)
+    del it
+    it = create(scale)
+    start = time.perf_counter()
+    it.setstate(checkpoint)
+    setstate_seconds = time.perf_counter() - start
+    first = next(it)
+    first_item_seconds = time.perf_counter() - start - setstate_seconds
+    if first != expected:
+        raise RuntimeError('restored pipeline does not continue where the checkpoint was taken')
+    return getstate_seconds, checkpoint_size, replayed_items, setstate_seconds, first_item_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure checkpoint and restore latency of standard pipelines.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--num-chunks', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=20000, help='number of lines per chunk')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    try:
+        pipelines = _pipelines(write_gzip_chunks(create_chunks(args.num_chunks, args.chunk_size), data_dir))
+        print('{:>20}{:>9}{:>14}{:>14}{:>12}{:>14}{:>16}'.format('pipeline', 'scale', 'getstate ms', 'size bytes', 'replayed', 'setstate ms', 'first item ms'))
+        for name, create in pipelines.items():
+            for scale in args.scales:
+                # take the checkpoint in the middle of the second buffer, where restoring is typically most expensive
+                getstate_seconds, size, replayed, setstate_seconds, first_item_seconds = _measure(create, scale, scale * 3 // 2)
+                print('{:>20}{:>9}{:>14.2f}{:>14}{:>12}{:>14.2f}{:>16.2f}'.format(name, scale, getstate_seconds * 1000, size, replayed,
+                                                                                  setstate_seconds * 1000, first_item_seconds * 1000))
+    finally:
+        shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
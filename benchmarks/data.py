@@ -0,0 +1,60 @@
+# Benchmark data: synthetic text chunks, either kept in memory or written to gzipped chunk files.
+
+import gzip
+import os
+from random import Random
+from typing import Iterator, List
+
+
+def create_chunks(num_chunks: int, chunk_size: int, seed: int=1) -> List[List[str]]:
+    """
+    Create chunks of lines of random words, of varying length as in typical text corpora.
+
+    Args:
+        num_chunks: number of chunks
+        chunk_size: number of lines per chunk
+        seed: random seed; the same seed gives the same data
+    """
+    random = Random(seed)
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randrange(1, 12))) for _ in range(5000)]
+    # lines are drawn from a pool, since creating every line from words would dominate the time of short benchmarks
+    lines = [' '.join(random.choice(words) for _ in range(random.randrange(5, 80))) for _ in range(10000)]
+    return [[random.choice(lines) for _ in range(chunk_size)] for _ in range(num_chunks)]
+
+
+def read_memory_chunk(chunk: List[str]) -> Iterator[str]:
+    """
+    read_chunk_fn for chunks kept in memory, i.e. when the chunks themselves are passed as chunk_refs.
+    """
+    return iter(chunk)
+
+
+def write_gzip_chunks(chunks: List[List[str]], data_dir: str) -> List[str]:
+    """
+    Write chunks to gzipped text files with one line per item, as chunked_dataset_iterator() expects them.
+
+    Returns:
+        The paths of the files.
+    """
+    paths = []
+    for i, chunk in enumerate(chunks):
+        path = os.path.join(data_dir, 'chunk_{:05}.gz'.format(i))
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            f.write('\n'.join(chunk))
+        paths.append(path)
+    return paths
+
+
+def list_gzip_chunks(data_dir: str) -> List[str]:
+    """
+    Get the paths of the chunk files written by write_gzip_chunks().
+    """
+    return sorted(os.path.join(data_dir, name) for name in os.listdir(data_dir) if name.startswith('chunk_') and name.endswith('.gz'))
+
+
+def read_gzip_chunk(path: str) -> Iterator[str]:
+    """
+    read_chunk_fn for gzipped chunk files.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        return iter(f.read().splitlines())
@@ -0,0 +1,79 @@
+#!/usr/bin/python3.6
+
+# Compares the 'thread' and 'process' backends of ParallelMapIterator on representative transforms.
+# Transforms that release the GIL (zlib, hashlib) scale with threads, pure-Python transforms only with processes.
+# Example:
+#   python -m benchmarks.parallel_map_backends --num-processes 4
+
+import argparse
+import hashlib
+import re
+import time
+import zlib
+from random import Random
+
+from infinibatch.iterators import NativeCheckpointableIterator, MapIterator, ParallelMapIterator, WorkerPool
+
+
+# transforms have to be top-level functions to be usable with the 'process' backend
+def zlib_compress(item: bytes):
+    return zlib.compress(item, 6)
+
+
+def sha256(item: bytes):
+    return hashlib.sha256(item * 16).digest()
+
+
+_token_regex = re.compile(r'\w+|[^\w\s]')
+
+def tokenize(item: bytes):
+    return len(_token_regex.findall(item.decode('ascii')))
+
+
+TRANSFORMS = {'zlib': zlib_compress, 'sha256': sha256, 'regex-tokenize': tokenize}
+
+
+def _create_data(num_items: int, item_size: int):
+    random = Random(1)
+    words = [''.join(random.choice('abcdefghij') for _ in range(random.randrange(2, 10))) for _ in range(1000)]
+    data = []
+    for _ in range(num_items):
+        text = ' '.join(random.choice(words) for _ in range(item_size // 6))
+        data.append(text[:item_size].encode('ascii'))
+    return data
+
+
+def _measure(data, transform, backend, num_processes, num_items_per_process):
+    if backend == 'serial':
+        it = MapIterator(NativeCheckpointableIterator(data), transform)
+        start = time.perf_counter()
+        for _ in it:
+            pass
+        return len(data) / (time.perf_counter() - start)
+    with WorkerPool(num_processes, backend=backend) as pool:
+        it = ParallelMapIterator(NativeCheckpointableIterator(data), transform, num_processes, num_items_per_process, pool=pool)
+        start = time.perf_counter()
+        for _ in it:
+            pass
+        return len(data) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the thread and process backends of ParallelMapIterator.')
+    parser.add_argument('--num-items', type=int, default=4000)
+    parser.add_argument('--item-size', type=int, default=16384, help='size of each item in bytes')
+    parser.add_argument('--num-processes', type=int, default=4)
+    parser.add_argument('--num-items-per-process', type=int, default=50)
+    parser.add_argument('--transforms', nargs='+', default=sorted(TRANSFORMS), choices=sorted(TRANSFORMS))
+    args = parser.parse_args()
+
+    data = _create_data(args.num_items, args.item_size)
+    backends = ['serial', 'thread', 'process']
+    print('{:>16}'.format('items/s') + ''.join('{:>12}'.format(backend) for backend in backends))
+    for name in args.transforms:
+        results = [_measure(data, TRANSFORMS[name], backend, args.num_processes, args.num_items_per_process) for backend in backends]
+        print('{:>16}'.format(name) + ''.join('{:>12.0f}'.format(result) for result in results))
+
+
+if __name__ == '__main__':
+    main()
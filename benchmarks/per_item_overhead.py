@@ -0,0 +1,73 @@
+#!/usr/bin/python3.6
+
+# Measures the per-item overhead of the iterators themselves, using trivial transforms.
+# For MapIterator, chains of 1 and 10 stages are measured with and without fusion of adjacent stages
+# (subclasses of MapIterator are not fused, which is used here to emulate the unfused chain).
+# To compare the other iterators before and after a change, run this script on both revisions.
+# Example:
+#   python -m benchmarks.per_item_overhead --num-items 1000000
+
+import argparse
+import time
+
+from infinibatch.iterators import NativeCheckpointableIterator, MapIterator, FixedBatchIterator, SelectManyIterator, \
+                                  RecurrentIterator, MultiplexIterator
+
+
+class _UnfusedMapIterator(MapIterator):
+    pass
+
+
+def _identity(item):
+    return item
+
+
+def _step(state, item):
+    return state, item
+
+
+def _map_chain(map_iterator_class, num_stages):
+    def create(data):
+        it = NativeCheckpointableIterator(data)
+        for _ in range(num_stages):
+            it = map_iterator_class(it, _identity)
+        return it
+    return create
+
+
+PIPELINES = [
+    ('source only',            lambda data: NativeCheckpointableIterator(data)),
+    ('map, 1 stage',           _map_chain(MapIterator, 1)),
+    ('map, 10 stages unfused', _map_chain(_UnfusedMapIterator, 10)),
+    ('map, 10 stages fused',   _map_chain(MapIterator, 10)),
+    ('recurrent',              lambda data: RecurrentIterator(NativeCheckpointableIterator(data), _step, initial_state=0)),
+    ('multiplex',              lambda data: MultiplexIterator(NativeCheckpointableIterator([0] * len(data)), [NativeCheckpointableIterator(data)])),
+    ('batch + select-many',    lambda data: SelectManyIterator(FixedBatchIterator(NativeCheckpointableIterator(data), 100))),
+]
+
+
+def _measure(create, data, num_repetitions):
+    best = float('inf')
+    for _ in range(num_repetitions):
+        it = create(data)
+        start = time.perf_counter()
+        for _ in it:
+            pass
+        best = min(best, time.perf_counter() - start)
+    return best / len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure per-item overhead of iterator pipelines.')
+    parser.add_argument('--num-items', type=int, default=200000)
+    parser.add_argument('--num-repetitions', type=int, default=3, help='the fastest repetition is reported')
+    args = parser.parse_args()
+
+    data = list(range(args.num_items))
+    print('{:>24}{:>12}'.format('pipeline', 'ns/item'))
+    for name, create in PIPELINES:
+        print('{:>24}{:>12.0f}'.format(name, _measure(create, data, args.num_repetitions) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
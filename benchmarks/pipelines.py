@@ -0,0 +1,52 @@
+# Standard pipelines for benchmarking. Each one yields batches (lists of items) from chunk_refs read with read_chunk,
+# configured by the options of benchmarks.run.
+
+import re
+
+from infinibatch.datasets import chunked_dataset_iterator
+from infinibatch.iterators import BucketedReadaheadBatchIterator, FixedBatchIterator, ParallelMapIterator, WeightedMultiplexIterator
+
+
+_token_regex = re.compile(r'\w+|[^\w\s]')
+
+def tokenize(line: str):  # a top-level function, so that it can be sent to worker processes
+    return _token_regex.findall(line)
+
+
+def _dataset(chunk_refs, read_chunk, options, **kwargs):
+    return chunked_dataset_iterator(chunk_refs, read_chunk, buffer_size=options.buffer_size, seed=1, warmup_size=options.warmup_size, **kwargs)
+
+
+def chunked_dataset(chunk_refs, read_chunk, options):
+    # the defaults of chunked_dataset_iterator(), i.e. blockwise shuffling
+    return FixedBatchIterator(_dataset(chunk_refs, read_chunk, options), options.batch_size)
+
+
+def bucketed(chunk_refs, read_chunk, options):
+    return BucketedReadaheadBatchIterator(_dataset(chunk_refs, read_chunk, options), read_ahead=options.read_ahead,
+                                          key=len, batch_size=options.batch_size, seed=1, warmup_size=options.warmup_size)
+
+
+def parallel_map(chunk_refs, read_chunk, options):
+    samples = ParallelMapIterator(_dataset(chunk_refs, read_chunk, options), tokenize,
+                                  num_processes=options.num_processes, num_items_per_process=options.batch_size)
+    return FixedBatchIterator(samples, options.batch_size)
+
+
+def prefetch(chunk_refs, read_chunk, options):
+    return FixedBatchIterator(_dataset(chunk_refs, read_chunk, options, prefetch=True), options.batch_size)
+
+
+def multiplex(chunk_refs, read_chunk, options):
+    # two corpora, made of the even and odd chunks, mixed 3:1
+    corpora = [_dataset(chunk_refs[i::2], read_chunk, options) for i in range(2)]
+    return FixedBatchIterator(WeightedMultiplexIterator(corpora, weights=[3, 1], seed=1), options.batch_size)
+
+
+PIPELINES = {
+    'chunked-dataset': chunked_dataset,
+    'bucketed':        bucketed,
+    'parallel-map':    parallel_map,
+    'prefetch':        prefetch,
+    'multiplex':       multiplex,
+}
@@ -0,0 +1,60 @@
+#!/usr/bin/python3.6
+
+# Measures the trade-off between the checkpoint_interval of PrefetchIterator and throughput / resume time.
+# A small interval makes the prefetcher call getstate() on its source more often,
+# a large interval makes restoring a checkpoint replay more items.
+# Example:
+#   python -m benchmarks.prefetch_checkpoint_interval --buffer-size 1000 --num-items 20000
+
+import argparse
+import itertools
+import time
+
+from infinibatch.iterators import NativeCheckpointableIterator, BufferedShuffleIterator, MapIterator, PrefetchIterator
+
+
+def _expensive_transform(item):  # simulates a per-item transform, which also has to be replayed on resume
+    return sum(i * i for i in range(200)) + item
+
+
+def _create_source(num_items: int, shuffle_buffer_size: int):
+    # BufferedShuffleIterator copies its buffer in getstate(), which makes the source's checkpoints expensive
+    source = NativeCheckpointableIterator(list(range(num_items)))
+    source = BufferedShuffleIterator(source, shuffle_buffer_size, seed=1)
+    return MapIterator(source, _expensive_transform)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure throughput and resume time of PrefetchIterator for different checkpoint intervals.')
+    parser.add_argument('--num-items', type=int, default=20000)
+    parser.add_argument('--buffer-size', type=int, default=1000, help='buffer_size of the PrefetchIterator')
+    parser.add_argument('--shuffle-buffer-size', type=int, default=1000)
+    parser.add_argument('--backend', default=None)
+    parser.add_argument('--intervals', type=int, nargs='+', default=[1, 10, 100, 1000])
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>14}'.format('interval', 'items/s', 'resume [ms]'))
+    for checkpoint_interval in args.intervals:
+        it = PrefetchIterator(_create_source(args.num_items, args.shuffle_buffer_size), args.buffer_size,
+                              backend=args.backend, checkpoint_interval=checkpoint_interval)
+        start = time.perf_counter()
+        num_items = 0
+        checkpoint = None
+        for _ in it:
+            num_items += 1
+            # remember the first checkpoint that requires the maximum replay
+            if checkpoint is None and it.getstate()['item_offset'] == checkpoint_interval - 1:
+                checkpoint = it.getstate()
+        items_per_second = num_items / (time.perf_counter() - start)
+        # resume time: from setstate() to the first item
+        resumed = PrefetchIterator(_create_source(args.num_items, args.shuffle_buffer_size), args.buffer_size,
+                                   backend=args.backend, checkpoint_interval=checkpoint_interval)
+        start = time.perf_counter()
+        resumed.setstate(checkpoint)
+        next(itertools.islice(resumed, 1))
+        resume_ms = (time.perf_counter() - start) * 1000
+        print('{:>10} {:>12.0f} {:>14.1f}'.format(checkpoint_interval, items_per_second, resume_ms))
+
+
+if __name__ == '__main__':
+    main()
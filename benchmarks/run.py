@@ -0,0 +1,145 @@
+#!/usr/bin/python3.6
+
+# Measures the throughput of the standard pipelines in benchmarks.pipelines, over synthetic chunks kept in memory
+# and over gzipped chunk files. Reports items/s, batches/s, CPU time, peak RSS, and time to the first batch.
+# Each benchmark runs in a fresh process, so that peak RSS and CPU time are its own.
+# Results can be saved as JSON, and compared against saved results to spot regressions between versions.
+# Example:
+#   python -m benchmarks.run --output before.json
+#   (change something)
+#   python -m benchmarks.run --output after.json --compare before.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks.data import create_chunks, read_memory_chunk, write_gzip_chunks, list_gzip_chunks, read_gzip_chunk
+from benchmarks.pipelines import PIPELINES
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+DATA_KINDS = ['memory', 'gzip']
+
+
+def _peak_rss_bytes() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # macOS reports bytes, Linux kilobytes
+
+
+def _measure(pipeline: str, data: str, options) -> Dict[str, Any]:
+    """
+    Run one benchmark in the current process.
+    """
+    if data == 'memory':
+        chunk_refs, read_chunk = create_chunks(options.num_chunks, options.chunk_size), read_memory_chunk
+    else:
+        chunk_refs, read_chunk = list_gzip_chunks(options.data_dir), read_gzip_chunk
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    it = PIPELINES[pipeline](chunk_refs, read_chunk, options)
+    num_first_items = len(next(it))
+    first_batch_seconds = time.perf_counter() - start
+    start = time.perf_counter()  # the steady state is measured from the first batch on
+    num_items = 0
+    for _ in range(options.num_batches - 1):
+        num_items += len(next(it))
+    seconds = time.perf_counter() - start
+    return {'pipeline':                    pipeline,
+            'data':                        data,
+            'batches':                     options.num_batches,
+            'items':                       num_first_items + num_items,
+            'items_per_second':            num_items / seconds if seconds > 0 else None,
+            'batches_per_second':          (options.num_batches - 1) / seconds if seconds > 0 else None,
+            'cpu_seconds':                 time.process_time() - cpu_start,  # of this process only, not of worker processes
+            'peak_rss_bytes':              _peak_rss_bytes(),
+            'time_to_first_batch_seconds': first_batch_seconds}
+
+
+def _run_in_subprocess(pipeline: str, data: str, argv: List[str]) -> Dict[str, Any]:
+    output = subprocess.check_output([sys.executable, '-m', 'benchmarks.run', '--single', pipeline, data] + argv,
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def _print_results(results: List[Dict[str, Any]], baseline: Optional[List[Dict[str, Any]]]):
+    baseline_by_key = {(result['pipeline'], result['data']): result for result in baseline or []}
+    print('{:>16}{:>8}{:>12}{:>11}{:>9}{:>10}{:>15}'.format('pipeline', 'data', 'items/s', 'batches/s', 'CPU s', 'RSS MB', 'first batch s')
+          + ('{:>14}'.format('vs. baseline') if baseline is not None else ''))
+    for result in results:
+        line = '{:>16}{:>8}{:>12.0f}{:>11.1f}{:>9.2f}{:>10}{:>15.3f}'.format(
+            result['pipeline'], result['data'], result['items_per_second'] or 0, result['batches_per_second'] or 0, result['cpu_seconds'],
+            '{:.0f}'.format(result['peak_rss_bytes'] / 2**20) if result['peak_rss_bytes'] is not None else '-', result['time_to_first_batch_seconds'])
+        if baseline is not None:
+            reference = baseline_by_key.get((result['pipeline'], result['data']))
+            if reference and reference['items_per_second'] and result['items_per_second']:
+                line += '{:>+13.1f}%'.format((result['items_per_second'] / reference['items_per_second'] - 1) * 100)
+            else:
+                line += '{:>14}'.format('-')
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the throughput of standard pipelines.')
+    parser.add_argument('--pipelines', nargs='+', default=list(PIPELINES), choices=list(PIPELINES))
+    parser.add_argument('--data', nargs='+', default=DATA_KINDS, choices=DATA_KINDS,
+                        help='chunks kept in memory, or read from gzipped files')
+    parser.add_argument('--num-chunks', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=10000, help='number of lines per chunk')
+    parser.add_argument('--num-batches', type=int, default=500,
+                        help='number of batches to measure; should cover several shuffle buffers, so that the steady state is measured')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--buffer-size', type=int, default=10000, help='shuffle buffer size of chunked_dataset_iterator')
+    parser.add_argument('--read-ahead', type=int, default=10000, help='read-ahead of BucketedReadaheadBatchIterator')
+    parser.add_argument('--num-processes', type=int, default=4, help='number of processes of ParallelMapIterator')
+    parser.add_argument('--warmup-size', type=int, default=None, help='initial size of the shuffle buffer and read-ahead window (default: no warm-up)')
+    parser.add_argument('--output', help='file to save the results to, as JSON')
+    parser.add_argument('--compare', help='file with saved results to compare against')
+    parser.add_argument('--single', nargs=2, metavar=('PIPELINE', 'DATA'), help=argparse.SUPPRESS)  # run one benchmark, used internally
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(_measure(args.single[0], args.single[1], args)))
+        return
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    options = ['--num-chunks', str(args.num_chunks), '--chunk-size', str(args.chunk_size), '--num-batches', str(args.num_batches),
+               '--batch-size', str(args.batch_size), '--buffer-size', str(args.buffer_size), '--read-ahead', str(args.read_ahead),
+               '--num-processes', str(args.num_processes)] + (['--warmup-size', str(args.warmup_size)] if args.warmup_size else [])
+    data_dir = tempfile.mkdtemp()
+    try:
+        if 'gzip' in args.data:
+            write_gzip_chunks(create_chunks(args.num_chunks, args.chunk_size), data_dir)
+        results = [_run_in_subprocess(pipeline, data, options + ['--data-dir', data_dir])
+                   for pipeline in args.pipelines for data in args.data]
+    finally:
+        shutil.rmtree(data_dir)
+
+    _print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python':   platform.python_version(),
+                       'platform': platform.platform(),
+                       'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'options':  {key: value for key, value in vars(args).items() if key not in ('single', 'data_dir', 'output', 'compare')},
+                       'results':  results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
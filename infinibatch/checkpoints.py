@@ -0,0 +1,242 @@
+"""
+Saving and loading checkpoints of iterator pipelines.
+
+A checkpoint of a pipeline is obtained by calling `getstate()` on its last iterator.
+`AsyncCheckpointWriter` takes this checkpoint on the calling thread, so that it is consistent with the items consumed so far,
+and copies, serializes, and writes it to a file on a background thread, so that the training loop does not wait for this work:
+
+>>> import os, tempfile
+>>> from infinibatch.iterators import NativeCheckpointableIterator
+>>> it = NativeCheckpointableIterator(list(range(10)))
+>>> _ = next(it)
+>>> path = os.path.join(tempfile.mkdtemp(), 'checkpoint')
+>>> with AsyncCheckpointWriter() as writer:
+...     future = writer.save(it, path)
+...     _ = next(it)
+>>> future.result() == path
+True
+>>> it.setstate(load_checkpoint(path))
+>>> next(it)
+1
+
+By default, checkpoints are pickled. `serialize_checkpoint()` produces a more compact binary format instead,
+which deduplicates repeated values (such as copies of random-generator states held by several stages),
+can compress the data, and carries a format version and a checksum, which are verified when loading:
+
+>>> data = serialize_checkpoint(it.getstate(), compress=True)
+>>> deserialize_checkpoint(data)
+{'num_items_yielded': 2}
+
+`checkpoint_size_breakdown()` shows which stage of a pipeline contributes how much to the size of a checkpoint.
+"""
+
+import concurrent.futures
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, Callable, Dict, Optional
+
+from infinibatch.iterators import CheckpointableIterator, _getstate_deferring_copies, _resolve_deferred_copies
+
+
+def _pickle_checkpoint(checkpoint: Dict) -> bytes:
+    return pickle.dumps(checkpoint, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _write_file_atomically(path: str, data: bytes, fsync: bool):
+    # write to a temporary file and rename it, so that the file at path is always a complete checkpoint
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints of iterator pipelines to files on a background thread.
+
+    save() calls getstate() on the calling thread and returns right away with a future;
+    serialization and writing happen on a single background thread, in the order in which save() was called.
+    The file is written atomically, i.e. it either contains the previous or the new checkpoint.
+
+    getstate() has to run on the calling thread, since only then the checkpoint matches the position of the pipeline.
+    To keep this cheap, stages with large buffers, such as BufferedShuffleIterator, only take a shallow copy of them there;
+    the deep copy, which protects the checkpoint against changes to the items, is made on the background thread.
+    Hence, items that such stages yield must not be modified in place until the future returned by save() is done.
+    For other stages with large states, see the snapshot protocol of RecurrentIterator.
+    """
+    def __init__(self, serialize: Optional[Callable[[Dict], bytes]]=None, fsync: bool=True):
+        """
+        Args:
+            serialize: function that turns a checkpoint into bytes (default: pickle with the highest protocol)
+            fsync: whether to flush the file to disk before the future completes
+        """
+        self._serialize = serialize if serialize is not None else _pickle_checkpoint  # type: Callable[[Dict], bytes]
+        self._fsync = fsync                                                          # type: bool
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)        # type: concurrent.futures.ThreadPoolExecutor
+
+    def save(self, iterator: CheckpointableIterator, path: str) -> concurrent.futures.Future:
+        """
+        Take a checkpoint of iterator and write it to path in the background.
+
+        Args:
+            iterator: last iterator of the pipeline
+            path: file to write the checkpoint to
+
+        Returns:
+            A future whose result is path once the checkpoint has been written, or that raises the error that occurred.
+        """
+        checkpoint = _getstate_deferring_copies(iterator)
+        return self._executor.submit(self._write, checkpoint, path)
+
+    def _write(self, checkpoint: Dict, path: str) -> str:  # runs on the background thread
+        _write_file_atomically(path, self._serialize(_resolve_deferred_copies(checkpoint)), self._fsync)
+        return path
+
+    def close(self, wait: bool=True):
+        """
+        Shut down the background thread.
+
+        Args:
+            wait: whether to wait until all pending checkpoints have been written
+        """
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def load_checkpoint(path: str, deserialize: Optional[Callable[[bytes], Dict]]=None) -> Dict:
+    """
+    Read a checkpoint written by AsyncCheckpointWriter, to be passed to setstate().
+
+    Args:
+        path: file the checkpoint was written to
+        deserialize: inverse of the serialize function given to AsyncCheckpointWriter
+                     (default: deserialize_checkpoint() for the binary format, pickle otherwise)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if deserialize is not None:
+        return deserialize(data)
+    if data.startswith(_MAGIC):
+        return deserialize_checkpoint(data)
+    return pickle.loads(data)
+
+
+# Binary checkpoint format: a fixed-size header followed by the payload, which is the checkpoint pickled
+# with repeated values deduplicated, optionally compressed with zlib.
+#   magic (4 bytes), format version (uint8), flags (uint8), CRC32 of the payload (uint32), payload size (uint64)
+_MAGIC = b'IBCP'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sBBIQ')
+_FLAG_COMPRESSED = 1
+_PICKLE_PROTOCOL = 4  # fixed, so that checkpoints written by newer Python versions can be read by older ones
+
+
+def _deduplicate(value: Any, canonical: Dict[Any, Any]) -> Any:
+    """
+    Replace equal tuples, strings and bytes by the same object, so that pickle writes them only once.
+    Dicts and lists are traversed (and copied), but not deduplicated themselves.
+    """
+    # note: exact type checks, so that subclasses such as namedtuples are preserved
+    if type(value) is dict:
+        return {key: _deduplicate(item, canonical) for key, item in value.items()}
+    if type(value) is list:
+        return [_deduplicate(item, canonical) for item in value]
+    if type(value) is tuple:
+        value = tuple(_deduplicate(item, canonical) for item in value)
+        if len(value) > 1:
+            # tuples are keyed by their pickled form, since equal tuples may hold items of different types,
+            # e.g. (1, 0), (1.0, 0.0) and (True, False), which must not be replaced by one another
+            try:
+                hash(value)
+                key = pickle.dumps(value, protocol=_PICKLE_PROTOCOL)
+            except Exception:  # not hashable, e.g. a tuple containing a list, or not picklable
+                return value
+            return canonical.setdefault(key, value)
+    if type(value) in (str, bytes) and len(value) > 1:
+        return canonical.setdefault(value, value)
+    return value
+
+
+def serialize_checkpoint(checkpoint: Dict, compress: bool=False) -> bytes:
+    """
+    Serialize a checkpoint into the binary checkpoint format, see above.
+
+    Args:
+        checkpoint: checkpoint as returned by getstate()
+        compress: whether to compress the data, which pays off for checkpoints with large buffers of items
+    """
+    payload = pickle.dumps(_deduplicate(checkpoint, {}), protocol=_PICKLE_PROTOCOL)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= _FLAG_COMPRESSED
+    return _HEADER.pack(_MAGIC, FORMAT_VERSION, flags, zlib.crc32(payload), len(payload)) + payload
+
+
+def deserialize_checkpoint(data: bytes) -> Dict:
+    """
+    Load a checkpoint from the binary checkpoint format, verifying its version and checksum.
+
+    Args:
+        data: bytes produced by serialize_checkpoint()
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError('checkpoint data is truncated')
+    magic, version, flags, checksum, payload_size = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError('data is not in the binary checkpoint format')
+    if version > FORMAT_VERSION:
+        raise ValueError('checkpoint format version {} is not supported (newest supported version is {})'.format(version, FORMAT_VERSION))
+    payload = memoryview(data)[_HEADER.size:]
+    if len(payload) != payload_size:
+        raise ValueError('checkpoint data is truncated')
+    if zlib.crc32(payload) != checksum:
+        raise ValueError('checkpoint data is corrupted (checksum mismatch)')
+    if flags & _FLAG_COMPRESSED:
+        payload = zlib.decompress(payload)
+    return pickle.loads(payload)
+
+
+# keys under which iterators store the checkpoints of the iterators they read from
+_NESTED_STATE_KEYS = ('source_state', 'control_iterator_state', 'source_iterator_states', 'input_states')
+
+
+def checkpoint_size_breakdown(checkpoint: Dict) -> Dict[str, Dict[str, int]]:
+    """
+    Report how much each stage of a pipeline contributes to the size of its checkpoint.
+
+    Stages are identified by their path in the nested checkpoint, e.g. 'checkpoint.source_state.source_iterator_states[1]'.
+    For each stage, the pickled size in bytes of each entry of its own state is reported, excluding the states of
+    the stages it reads from. Sizes are measured before deduplication and compression.
+    Stages that do not add any state of their own, such as MapIterator, do not appear.
+
+    Args:
+        checkpoint: checkpoint as returned by getstate()
+    """
+    breakdown = {}  # type: Dict[str, Dict[str, int]]
+    def visit(state, path):
+        if not isinstance(state, dict):
+            return
+        breakdown[path] = {key: len(pickle.dumps(value, protocol=_PICKLE_PROTOCOL)) for key, value in state.items() if key not in _NESTED_STATE_KEYS}
+        for key in _NESTED_STATE_KEYS:
+            nested_state = state.get(key)
+            if isinstance(nested_state, dict) and key == 'source_iterator_states':  # LazyMultiplexIterator: states by index
+                for index, source_state in nested_state.items():
+                    visit(source_state, '{}.{}[{}]'.format(path, key, index))
+            elif isinstance(nested_state, (list, tuple)):
+                for index, source_state in enumerate(nested_state):
+                    visit(source_state, '{}.{}[{}]'.format(path, key, index))
+            else:
+                visit(nested_state, '{}.{}'.format(path, key))
+    visit(checkpoint, 'checkpoint')
+    return breakdown
@@ -19,7 +19,8 @@ def chunked_dataset_iterator(chunk_refs: List, read_chunk_fn: Callable[[Any], It
                              seed: Optional[int]=None, shuffle: bool=True, use_windowed: bool=False,
                              transform: Callable[[Any],Any]=None,
                              prefetch: bool=False,
-                             num_instances: int=1, instance_rank: int=0):
+                             num_instances: int=1, instance_rank: int=0,
+                             warmup_size: Optional[int]=None):
     """
     Dataset reading data from gzipped chunks.
 
@@ -30,6 +31,7 @@ def chunked_dataset_iterator(chunk_refs: List, read_chunk_fn: Callable[[Any], It
     and then concatenate these lists in order of increasing rank.
     When using MPI, this can be achieved by a gather-operation to get a list of lists of outputs, one list per GPU,
     followed by flattening the lists back into a single list.
+    With train=True, checkpoints can be converted to a different num_instances with reshard_checkpoints().
 
     Args:
         chunk_refs: references (such as path names) to chunk files
@@ -43,6 +45,8 @@ def chunked_dataset_iterator(chunk_refs: List, read_chunk_fn: Callable[[Any], It
         num_instances: number of instances of this dataset. Meant for use with multi-process data loading, e.g., in distributed training.
         instance_rank: rank of this instance of the dataset. Meant for use with multi-process data loading, e.g., in distributed training.
         use_windowed: temporary option to switch back to the WindowedShuffleIterator (default False). Will go away once shown that we don't need it anymore.
+        warmup_size: if given, the shuffle buffer starts with this size and grows geometrically up to buffer_size,
+                     so that the first items are served without waiting for the whole buffer to be filled (default: no warm-up)
     """
     if not train and shuffle:
         raise ValueError('shuffling is not supported when train=False')
@@ -56,9 +60,9 @@ def chunked_dataset_iterator(chunk_refs: List, read_chunk_fn: Callable[[Any], It
     # set up the item randomizer
     if shuffle:
         if use_windowed:
-            samples = BufferedShuffleIterator(samples, buffer_size, bump_seed(seed, 1))
+            samples = BufferedShuffleIterator(samples, buffer_size, bump_seed(seed, 1), warmup_size=warmup_size)
         else:
-            samples = BlockwiseShuffleIterator(samples, buffer_size, bump_seed(seed, 1))
+            samples = BlockwiseShuffleIterator(samples, buffer_size, bump_seed(seed, 1), warmup_size=warmup_size)
     # apply transform, if given
     if transform is not None:
         samples = MapIterator(samples, transform)
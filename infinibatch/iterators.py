@@ -208,17 +208,33 @@ It is mainly intended for demonstration and debugging purposes.
 """
 
 from abc import abstractmethod
+import array
+import atexit
+import bisect
 import collections
 import copy
+import functools
 import gzip
+import itertools
 from itertools import cycle, islice
+import logging
 import math
 import multiprocessing as python_multiprocessing
+import multiprocessing.pool
 import os
+import pickle
+import queue as python_queue
+import sys
 from random import Random
+import threading
+import time
+import weakref
 from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
 
 
+_logger = logging.getLogger(__name__)
+
+
 # TODO for next release:
 #  - benchmark the accuracy when using BlockwiseShuffleIterator vs. the BufferedShuffleIterator
 #  - change all convenience functions back to true classes, using a wrapper class
@@ -226,22 +242,74 @@ from typing import Any, Callable, Dict, Generator, Iterable, Iterator, List, Opt
 # TODO later:
 # - make iterator pipeline work for streaming data
 
+def _consume(iterator: Iterator, n: int) -> int:
+    """ Little helper to advance an iterator by up to n items without looping in Python; returns the number of items consumed """
+    last = collections.deque(enumerate(islice(iterator, n), 1), maxlen=1)
+    return last[0][0] if last else 0
+
+
 def _advance_iterator(iterator: Iterator, n: int):
     """ Little helper to advance an iterator by n items """
-    for i in range(n):
-        try:
-            next(iterator)
-        except StopIteration:
-            raise RuntimeError('Trying to advance iterator by {} but iterator raised StopIteration exception on call to next with index {}.'.format(n, i))
+    # CheckpointableIterators may know a faster way than iterating over the items
+    i = iterator.skip(n) if isinstance(iterator, CheckpointableIterator) else _consume(iterator, n)
+    if i < n:
+        raise RuntimeError('Trying to advance iterator by {} but iterator raised StopIteration exception on call to next with index {}.'.format(n, i))
     return n
 
 
+# Deferred copies: getstate() deep-copies large mutable parts of a state, e.g. the buffer of BufferedShuffleIterator,
+# so that the iterator cannot modify the checkpoint after it was taken. When the checkpoint is taken with
+# _getstate_deferring_copies(), these parts are shallow copies wrapped in _DeferredDeepCopy instead, and the deep copies
+# are made later by _resolve_deferred_copies(), e.g. on the background thread of checkpoints.AsyncCheckpointWriter.
+_deferred_copies = threading.local()
+
+
+class _DeferredDeepCopy:
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value  # type: Any  -- shallow copy of the value to be deep-copied
+
+
+def _checkpoint_copy(value: List) -> Any:
+    # copy of a list for a checkpoint, see above
+    if getattr(_deferred_copies, 'enabled', False):
+        return _DeferredDeepCopy(list(value))
+    return copy.deepcopy(value)
+
+
+def _getstate_deferring_copies(iterator: 'CheckpointableIterator') -> Dict:
+    """
+    Call getstate() on iterator, deferring deep copies; see above. Pass the result to _resolve_deferred_copies() before using it.
+    """
+    _deferred_copies.enabled = True
+    try:
+        return iterator.getstate()
+    finally:
+        _deferred_copies.enabled = False
+
+
+def _resolve_deferred_copies(state: Any) -> Any:
+    """
+    Make the deep copies deferred by _getstate_deferring_copies(), returning the checkpoint getstate() would have returned.
+    """
+    if type(state) is _DeferredDeepCopy:
+        return copy.deepcopy(state.value)
+    if type(state) is dict:  # states, and states of sources by index (LazyMultiplexIterator)
+        return {key: _resolve_deferred_copies(value) for key, value in state.items()}
+    if type(state) is list:  # states of sources
+        return [_resolve_deferred_copies(value) for value in state]
+    return state
+
+
 class CheckpointableIterator(collections.abc.Iterator):
     """
     Abstract base class that defines the interface for checkpointing.
 
     The interface (getstate, setstate) is inspired by Python's random package.
     """
+    __slots__ = ()  # so that frequently used subclasses can avoid the per-instance __dict__ by declaring __slots__
+
     def __iter__(self):
         return self
 
@@ -286,6 +354,54 @@ class CheckpointableIterator(collections.abc.Iterator):
     def __next__(self):
         pass
 
+    def next_batch(self, n: int) -> List:
+        """
+        Get the next n items at once
+
+        This is equivalent to calling __next__ n times, but iterators that can do so pull whole slices from
+        the preceding iterator, which avoids most of the per-item overhead of the pipeline.
+        After the call, the iterator is in the same state as after the equivalent calls to __next__,
+        hence checkpoints can be taken between calls as usual.
+
+        Args:
+            n: number of items to get
+
+        Returns:
+            A list of n items, or less if the iterator is exhausted. An empty list means that the iterator is exhausted.
+        """
+        return list(islice(self, n))
+
+    def skip(self, n: int) -> int:
+        """
+        Skip the next n items
+
+        This is equivalent to calling __next__ n times and discarding the items, but iterators that can do so skip
+        without producing the items, e.g. by jumping to an index, or by skipping in the preceding iterator
+        without applying a transform. This is used to advance to a checkpoint when resuming.
+
+        Args:
+            n: number of items to skip
+
+        Returns:
+            The number of items skipped, which is less than n only if the iterator is exhausted.
+        """
+        return _consume(self, n)
+
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        """
+        Work this iterator itself does to restore the given checkpoint, see estimate_resume_cost():
+        the number of items it re-reads from its source or input beyond those it yields afterwards, and a description.
+        """
+        return 0, ''
+
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        """
+        Items this iterator itself currently holds in buffers, see profiling.memory_usage():
+        their number and their size in bytes as given by estimate_size(items), or None if the iterator does not buffer items.
+        Either number may be None if it cannot be determined.
+        """
+        return None
+
 
 class NativeCheckpointableIterator(CheckpointableIterator):
     """
@@ -296,6 +412,8 @@ class NativeCheckpointableIterator(CheckpointableIterator):
 
     Warning: This class cannot be used with Iterators (as opposed to Iterables), which have an `__iter__` function that simply returns self, but does not reset.
     """
+    __slots__ = ('_input_iterable', '_iterator', '_num_items_yielded', '__weakref__')
+
     def __init__(self, iterable: Iterable):
         # check whether iterable is iterable or iterator:
         # if the variable iterable contains an iterator, the function __iter__ returns self
@@ -310,13 +428,36 @@ class NativeCheckpointableIterator(CheckpointableIterator):
 
     def setstate(self, checkpoint: Optional[Dict]):
         self._iterator = iter(self._input_iterable)
-        self._num_items_yielded = _advance_iterator(self._iterator, checkpoint['num_items_yielded']) if checkpoint is not None else 0
+        self._num_items_yielded = 0
+        if checkpoint is not None:
+            _advance_iterator(self, checkpoint['num_items_yielded'])
 
     def __next__(self):
         item = next(self._iterator)  # call this before increasing _num_items_yielded to correctly handle the case when a StopIteration exception is thrown
         self._num_items_yielded += 1
         return item
 
+    def next_batch(self, n: int) -> List:
+        items = list(islice(self._iterator, n))
+        self._num_items_yielded += len(items)
+        return items
+
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        n = checkpoint['num_items_yielded'] if checkpoint else 0
+        if type(self._input_iterable) in (list, tuple, range):
+            return 0, 'jumps to index {}'.format(n)
+        return n, 'iterates over the first {} items of the iterable'.format(n)
+
+    def skip(self, n: int) -> int:
+        if type(self._input_iterable) in (list, tuple, range):
+            # jump to the index, using the iterators' support for pickling
+            num_skipped = max(0, min(n, len(self._input_iterable) - self._num_items_yielded))
+            self._iterator.__setstate__(self._num_items_yielded + num_skipped)
+        else:
+            num_skipped = _consume(self._iterator, n)
+        self._num_items_yielded += num_skipped
+        return num_skipped
+
 
 def create_source_iterator(source_items: List, train: bool=True, seed: Optional[int]=None, shuffle: bool=True, num_instances: int=1, instance_rank: int=0):
     if not train and shuffle:
@@ -386,6 +527,7 @@ class InfinitePermutationSourceIterator(CheckpointableIterator):
         # set iteration state. Do this outside the generator below in case getstate() is called before ever iterating
         self._random_state      = checkpoint['random_state']      if checkpoint else None
         self._num_items_yielded = checkpoint['num_items_yielded'] if checkpoint else 0
+        self._shuffled_iterator = None  # iterator over the current permutation, set once the generator below has started
         # We define the iteration itself as a generator for ease of implementation.
         # We could as well just have used an explicit state machine represented by class members.
         def _generate() -> Iterator:
@@ -402,10 +544,13 @@ class InfinitePermutationSourceIterator(CheckpointableIterator):
                 shuffled_items = self._source_items[:]  # note: if underlying iterator is checkpointable, use setstate(checkpoint['nested_state']) on it
                 if self._shuffle:
                     random.shuffle(shuffled_items)
-                shuffled_iterator = iter(shuffled_items)
-                # skip initial items when restarting from checkpoint
-                if skip_to_checkpoint:  # @TODO: find a way to abstract this more, so that we can plug it into the 'for' statement directly
-                    self._num_items_yielded += _advance_iterator(shuffled_iterator, skip_to_checkpoint)
+                shuffled_iterator = self._shuffled_iterator = iter(shuffled_items)
+                # skip initial items when restarting from checkpoint, by jumping to the index
+                if skip_to_checkpoint:
+                    if skip_to_checkpoint > len(shuffled_items):
+                        raise RuntimeError('Trying to advance iterator by {} but iterator raised StopIteration exception on call to next with index {}.'.format(skip_to_checkpoint, len(shuffled_items)))
+                    shuffled_iterator.__setstate__(skip_to_checkpoint)
+                    self._num_items_yielded += skip_to_checkpoint
                     skip_to_checkpoint = 0  # done skipping
                 # main inner loop over items
                 for item in shuffled_iterator:
@@ -414,6 +559,47 @@ class InfinitePermutationSourceIterator(CheckpointableIterator):
                         yield item
         self._iterator = _generate()
 
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        n = checkpoint['num_items_yielded'] if checkpoint else 0
+        description = 'recreates the current permutation of {} items'.format(len(self._source_items))
+        return 0, description + (' and jumps to index {}'.format(n) if n else '')
+
+    def _num_instance_items(self, position: int) -> int:
+        """ Number of items of this instance at or after the given position in a permutation """
+        first = position + (self._instance_rank - position) % self._num_instances
+        return max(0, (len(self._source_items) - first + self._num_instances - 1) // self._num_instances)
+
+    def skip(self, n: int) -> int:
+        num_items_per_pass = self._num_instance_items(0)
+        if n <= 0 or num_items_per_pass == 0:
+            return super().skip(n)
+        # find the permutation and the position in it after skipping n items of this instance
+        position = self._num_items_yielded
+        num_items_left = self._num_instance_items(position)
+        num_passes = 0
+        num_items_skipped_in_pass = n
+        if n > num_items_left:
+            num_passes = (n - num_items_left - 1) // num_items_per_pass + 1
+            num_items_skipped_in_pass = n - num_items_left - (num_passes - 1) * num_items_per_pass
+            position = 0
+        position += (self._instance_rank - position) % self._num_instances + (num_items_skipped_in_pass - 1) * self._num_instances + 1
+        if not num_passes and self._shuffled_iterator is not None:
+            # jump within the current permutation
+            self._shuffled_iterator.__setstate__(position)
+            self._num_items_yielded = position
+            return n
+        # advance the random generator over the skipped permutations; shuffling consumes the same random numbers for any items
+        random = Random(self._seed)
+        if self._random_state is not None:
+            random.setstate(self._random_state)
+        if self._shuffle and num_passes:
+            shuffled_items = [None] * len(self._source_items)
+            for _ in range(num_passes):
+                random.shuffle(shuffled_items)
+        # jump to the position like when resuming from a checkpoint
+        self.setstate({'random_state': random.getstate(), 'num_items_yielded': position})
+        return n
+
     def __next__(self):
         return next(self._iterator)
 
@@ -425,6 +611,8 @@ class MultiplexIterator(CheckpointableIterator):
     A control iterator is expected to yield a sequence of indices into an array of input iterators.
     The next item is selected from the input iterator whose index was read from the control iterator
     """
+    __slots__ = ('_control_iterator', '_source_iterators', '__weakref__')
+
     def __init__(self, control_iterator: CheckpointableIterator, source_iterators: List[CheckpointableIterator]):
         if any(not isinstance(it, CheckpointableIterator) for it in [control_iterator] + source_iterators):
             raise ValueError('control_iterator and source_iterators have to be CheckpointableIterators')
@@ -440,20 +628,246 @@ class MultiplexIterator(CheckpointableIterator):
         self._control_iterator.setstate(checkpoint['control_iterator_state'] if checkpoint else None)
         for i, source_iterator in enumerate(self._source_iterators):
             source_iterator.setstate(checkpoint['source_iterator_states'][i] if checkpoint else None)
-        def _generate():
-            for index in self._control_iterator:
-                item = next(self._source_iterators[index])
-                yield item
-        self._iterator = _generate()
 
     def __next__(self):
-        return next(self._iterator)
+        index = next(self._control_iterator)
+        return next(self._source_iterators[index])
+
+
+class LazyMultiplexIterator(CheckpointableIterator):
+    """
+    Multiplexes a large number of input iterators, which are only created once they are first selected.
+
+    Like MultiplexIterator, a control iterator is expected to yield a sequence of indices into the input iterators,
+    and the next item is selected from the input iterator whose index was read from the control iterator.
+    Instead of a list of input iterators, this takes a factory that creates the input iterator for a given index.
+    Thereby, start-up time and memory use depend on the number of input iterators that are actually used, not on their total number.
+
+    If max_open_sources is given, the least recently used input iterator is closed once this number would be exceeded,
+    i.e. its state is kept and the iterator itself is dropped. It is recreated from its state when it is selected again.
+
+    The checkpoint only contains the states of the input iterators that have been selected since the beginning of the iteration.
+    """
+    def __init__(self, control_iterator: CheckpointableIterator, source_factory: Callable[[int], CheckpointableIterator], max_open_sources: Optional[int]=None):
+        """
+        Args:
+            control_iterator: iterator over indices of input iterators
+            source_factory: function(index) -> CheckpointableIterator that creates the input iterator for an index
+            max_open_sources: maximum number of input iterators that are kept open at the same time (default: no limit)
+        """
+        if not isinstance(control_iterator, CheckpointableIterator):
+            raise ValueError('control_iterator has to be a CheckpointableIterator')
+        if max_open_sources is not None and max_open_sources < 1:
+            raise ValueError('max_open_sources must be at least 1')
+        self._control_iterator = control_iterator  # type: CheckpointableIterator
+        self._source_factory = source_factory      # type: Callable[[int], CheckpointableIterator]
+        self._max_open_sources = max_open_sources  # type: Optional[int]
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        source_iterator_states = dict(self._closed_source_states)
+        for index, source_iterator in self._open_sources.items():
+            source_iterator_states[index] = source_iterator.getstate()
+        return {'control_iterator_state': self._control_iterator.getstate(),
+                'source_iterator_states': source_iterator_states}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._control_iterator.setstate(checkpoint['control_iterator_state'] if checkpoint else None)
+        self._open_sources = collections.OrderedDict()  # type: collections.OrderedDict  -- open input iterators by index, least recently used first
+        self._closed_source_states = dict(checkpoint['source_iterator_states']) if checkpoint else {}  # type: Dict[int, Dict]
+
+    @property
+    def num_open_sources(self) -> int:
+        return len(self._open_sources)
+
+    def _open_source(self, index: int) -> CheckpointableIterator:
+        if self._max_open_sources is not None and len(self._open_sources) >= self._max_open_sources:
+            # close the least recently used input iterator
+            closed_index, closed_source = self._open_sources.popitem(last=False)
+            self._closed_source_states[closed_index] = closed_source.getstate()
+        source_iterator = self._source_factory(index)
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_factory has to return CheckpointableIterators')
+        if index in self._closed_source_states:
+            source_iterator.setstate(self._closed_source_states.pop(index))
+        self._open_sources[index] = source_iterator
+        return source_iterator
+
+    def __next__(self):
+        index = next(self._control_iterator)
+        source_iterator = self._open_sources.get(index)
+        if source_iterator is None:
+            source_iterator = self._open_source(index)
+        else:
+            self._open_sources.move_to_end(index)
+        return next(source_iterator)
+
+
+class WeightedMultiplexIterator(CheckpointableIterator):
+    """
+    Multiplexes multiple input iterators by drawing each next item from a randomly chosen input iterator,
+    where the probability of choosing an input iterator is proportional to its weight.
+
+    This is similar to a MultiplexIterator with a control iterator that draws random indices, but faster:
+    The indices are drawn in blocks of block_size. A single call to the random generator provides one random byte per item,
+    and a lookup table maps each byte, i.e. a cell of 1/256 of the total weight, to the source whose share contains that cell.
+    Only items whose byte falls on a cell that contains a boundary between two shares take another draw to decide between them.
+    With 255 or more source iterators, the indices are drawn one by one instead.
+    Each block uses a random generator that is seeded from the seed and the position at which the block starts,
+    so that the checkpoint only needs to contain the position, and restoring it only draws a single block.
+
+    The weights can be changed at runtime with set_weights(). Since this starts a new block at the current position,
+    a checkpoint remains exact across such changes. The checkpoint contains the weights that are active at the time,
+    and restoring a checkpoint restores them.
+    """
+    def __init__(self, source_iterators: List[CheckpointableIterator], weights: List[float], seed: int=0, block_size: int=1024):
+        """
+        Args:
+            source_iterators: iterators to multiplex
+            weights: non-negative weights of the iterators, not all zero; they do not need to sum to one
+            seed: random seed
+            block_size: number of indices to draw at a time
+        """
+        if any(not isinstance(it, CheckpointableIterator) for it in source_iterators):
+            raise ValueError('all iterators in source_iterators have to be CheckpointableIterators')
+        if block_size < 1:
+            raise ValueError('block_size must be at least 1')
+        self._source_iterators = list(source_iterators)  # type: List[CheckpointableIterator]
+        self._seed = seed                                # type: int
+        self._block_size = block_size                    # type: int
+        self._initial_weights = self._checked_weights(weights)  # type: List[float]
+        self.setstate(None)
+
+    def _checked_weights(self, weights: List[float]) -> List[float]:
+        weights = list(weights)
+        if len(weights) != len(self._source_iterators):
+            raise ValueError('weights must contain one weight per source iterator')
+        if any(weight < 0 for weight in weights) or not any(weight > 0 for weight in weights):
+            raise ValueError('weights must be non-negative and not all zero')
+        return weights
+
+    def getstate(self) -> Dict:
+        return {'source_iterator_states': [source_iterator.getstate() for source_iterator in self._source_iterators],
+                'weights':                list(self._weights),
+                'block_start':            self._block_start,                         # position at which the current block starts
+                'position':               self._block_start + self._index_in_block}  # number of items yielded so far
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        for i, source_iterator in enumerate(self._source_iterators):
+            source_iterator.setstate(checkpoint['source_iterator_states'][i] if checkpoint else None)
+        self._set_weights(checkpoint['weights'] if checkpoint else self._initial_weights,
+                          checkpoint['block_start'] if checkpoint else 0)
+        self._index_in_block = checkpoint['position'] - self._block_start if checkpoint else 0
+
+    def set_weights(self, weights: List[float]):
+        """
+        Change the weights of the source iterators, effective from the next item on.
+        """
+        self._set_weights(self._checked_weights(weights), self._block_start + self._index_in_block)
+        self._index_in_block = 0
+
+    def _set_weights(self, weights: List[float], block_start: int):
+        self._weights = list(weights)
+        self._cum_weights = list(itertools.accumulate(self._weights))
+        self._cell_table = self._create_cell_table(self._cum_weights)
+        self._block_start = block_start
+        self._draw_block()
+
+    _BOUNDARY_CELL = 255  # entry of the cell table for cells that contain a boundary between the shares of two sources
+
+    @staticmethod
+    def _create_cell_table(cum_weights: List[float]) -> Optional[bytes]:
+        # maps each cell [c, c + 1) * total / 256 of the total weight to the index of the source whose share contains it,
+        # or to _BOUNDARY_CELL; None if there are too many sources for indices to fit into a byte
+        hi = len(cum_weights) - 1
+        if hi >= WeightedMultiplexIterator._BOUNDARY_CELL:
+            return None
+        scale = cum_weights[-1] / 256
+        table = bytearray()
+        for cell in range(256):
+            index = bisect.bisect(cum_weights, cell * scale, 0, hi)
+            table.append(index if index == hi or (cell + 1) * scale < cum_weights[index] else WeightedMultiplexIterator._BOUNDARY_CELL)
+        return bytes(table)
+
+    def _draw_block(self):
+        random = Random('{}:{}'.format(self._seed, self._block_start))
+        cum_weights = self._cum_weights
+        hi = len(cum_weights) - 1
+        if self._cell_table is None:  # same as Random.choices(), which is not available in Python 3.5
+            total = cum_weights[-1]
+            self._block = [bisect.bisect(cum_weights, random.random() * total, 0, hi) for _ in range(self._block_size)]  # type: Union[List[int], bytearray]
+            return
+        cells = random.getrandbits(8 * self._block_size).to_bytes(self._block_size, 'little')
+        block = bytearray(cells.translate(self._cell_table))
+        # items in boundary cells: draw the exact position within the cell
+        scale = cum_weights[-1] / 256
+        i = block.find(self._BOUNDARY_CELL)
+        while i >= 0:
+            block[i] = bisect.bisect(cum_weights, (cells[i] + random.random()) * scale, 0, hi)
+            i = block.find(self._BOUNDARY_CELL, i + 1)
+        self._block = block
+
+    def __next__(self):
+        if self._index_in_block == self._block_size:
+            self._block_start += self._block_size
+            self._draw_block()
+            self._index_in_block = 0
+        item = next(self._source_iterators[self._block[self._index_in_block]])  # call this before increasing _index_in_block to correctly handle the case when a StopIteration exception is thrown
+        self._index_in_block += 1
+        return item
+
+
+class RoundRobinIterator(CheckpointableIterator):
+    """
+    Interleaves items from multiple input iterators in round-robin order.
+
+    E.g. [0, 1, 2], [10, 11], and [20, 21, 22, 23] yield [0, 10, 20, 1, 11, 21, 2, 22, 23].
+    Exhausted input iterators are skipped; the iteration stops once all input iterators are exhausted.
+    """
+    def __init__(self, source_iterators: List[CheckpointableIterator]):
+        """
+        Args:
+            source_iterators: iterators to interleave
+        """
+        if any(not isinstance(it, CheckpointableIterator) for it in source_iterators):
+            raise ValueError('all iterators in source_iterators have to be CheckpointableIterators')
+        if not source_iterators:
+            raise ValueError('source_iterators must not be empty')
+        self._source_iterators = list(source_iterators)  # type: List[CheckpointableIterator]
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        return {'source_iterator_states': [source_iterator.getstate() for source_iterator in self._source_iterators],
+                'next_index':             self._next_index}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        for i, source_iterator in enumerate(self._source_iterators):
+            source_iterator.setstate(checkpoint['source_iterator_states'][i] if checkpoint else None)
+        self._next_index = checkpoint['next_index'] if checkpoint else 0
+        # Exhausted iterators are not part of the checkpoint. After restoring, they are rediscovered
+        # at the same positions in the round-robin order, which keeps the order deterministic.
+        self._exhausted = [False for _ in self._source_iterators]
+
+    def __next__(self):
+        while not all(self._exhausted):
+            index = self._next_index
+            self._next_index = (index + 1) % len(self._source_iterators)
+            if self._exhausted[index]:
+                continue
+            try:
+                return next(self._source_iterators[index])
+            except StopIteration:
+                self._exhausted[index] = True
+        raise StopIteration()
 
 
 class SelectManyIterator(CheckpointableIterator):
     """
     Projects each element of a source sequence to a sequence and flattens the resulting sequences into one sequence.
     """
+    __slots__ = ('_source_iterator', '_collection_selector', '_source_state', '_flattened_items_yielded',
+                 '_skip_to_checkpoint', '_data', '__weakref__')
+
     def __init__(self, source_iterator: CheckpointableIterator, collection_selector: Optional[Callable[[Any], Iterator]]=None):
         """
         Args:
@@ -477,51 +891,114 @@ class SelectManyIterator(CheckpointableIterator):
         self._source_state            = checkpoint['source_state']            if checkpoint else None
         self._flattened_items_yielded = checkpoint['flattened_items_yielded'] if checkpoint else 0
         self._source_iterator.setstate(self._source_state)
-        def _generate():
-            skip_to_checkpoint = self._flattened_items_yielded
-            # main loop over source source_items
-            for source_item in self._source_iterator:
-                if self._collection_selector is not None:
-                    data = iter(self._collection_selector(source_item))
-                else:
-                    data = iter(source_item)
-                self._flattened_items_yielded = 0
-                if skip_to_checkpoint:
-                    #print("Skipping to index", skip_to_checkpoint, file=sys.stderr)
-                    self._flattened_items_yielded += _advance_iterator(data, skip_to_checkpoint)
-                    skip_to_checkpoint = 0
-                # main loop over lines
-                for item in data:
-                    self._flattened_items_yielded += 1
-                    yield item
-                self._source_state = self._source_iterator.getstate()
-        self._iterator = _generate()
+        self._skip_to_checkpoint = self._flattened_items_yielded
+        self._data = None  # iterator over the items of the current source item
+
+    def _open_next_collection(self):  # raises StopIteration when the source iterator is exhausted
+        source_item = next(self._source_iterator)
+        if self._collection_selector is not None:
+            self._data = iter(self._collection_selector(source_item))
+        else:
+            self._data = iter(source_item)
+        self._flattened_items_yielded = 0
+        if self._skip_to_checkpoint:
+            self._flattened_items_yielded += _advance_iterator(self._data, self._skip_to_checkpoint)
+            self._skip_to_checkpoint = 0
 
     def __next__(self):
-        return next(self._iterator)
+        # main loop over source items
+        while True:
+            if self._data is None:
+                self._open_next_collection()
+            try:
+                item = next(self._data)
+            except StopIteration:
+                self._data = None
+                self._source_state = self._source_iterator.getstate()
+                continue
+            self._flattened_items_yielded += 1
+            return item
+
+    def next_batch(self, n: int) -> List:
+        items = []  # type: List
+        while len(items) < n:
+            if self._data is None:
+                try:
+                    self._open_next_collection()
+                except StopIteration:
+                    break
+            num_missing = n - len(items)
+            items.extend(islice(self._data, num_missing))
+            num_taken = len(items) - (n - num_missing)
+            self._flattened_items_yielded += num_taken
+            if num_taken < num_missing:  # collection is exhausted
+                self._data = None
+                self._source_state = self._source_iterator.getstate()
+        return items
+
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        n = checkpoint['flattened_items_yielded'] if checkpoint else 0
+        if not n:
+            return 0, ''
+        return n, 'reopens the current collection and skips {} of its items (without iterating if it has a length)'.format(n)
+
+    def skip(self, n: int) -> int:
+        num_skipped = 0
+        while num_skipped < n:
+            if self._data is None:
+                try:
+                    source_item = next(self._source_iterator)
+                except StopIteration:
+                    break
+                collection = self._collection_selector(source_item) if self._collection_selector is not None else source_item
+                offset, self._skip_to_checkpoint = self._skip_to_checkpoint, 0
+                if isinstance(collection, collections.abc.Sized) and len(collection) - offset <= n - num_skipped:
+                    # the whole collection is skipped, which does not require iterating over it
+                    num_skipped += len(collection) - offset
+                    self._flattened_items_yielded = 0
+                    self._source_state = self._source_iterator.getstate()
+                    continue
+                self._data = iter(collection)
+                self._flattened_items_yielded = _advance_iterator(self._data, offset)
+            num_missing = n - num_skipped
+            num_taken = _consume(self._data, num_missing)
+            num_skipped += num_taken
+            self._flattened_items_yielded += num_taken
+            if num_taken < num_missing:  # collection is exhausted
+                self._data = None
+                self._source_state = self._source_iterator.getstate()
+        return num_skipped
 
 
 class BufferedShuffleIterator(CheckpointableIterator):
     """
     Shuffles given iterable using a limited buffer.
+
+    With a large buffer, the first item is only yielded once the buffer is filled. For a faster start, pass warmup_size:
+    the buffer then starts with warmup_size slots and gains a slot with every item read until it has buffer_size slots,
+    i.e. its size doubles whenever it has taken in as many items as it holds. This is deterministic and checkpointable.
     """
-    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, seed: int=0):
+    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, seed: int=0, warmup_size: Optional[int]=None):
         """
         Args:
             source_iterator: checkpointable iterator or restartable iterable over input items to shuffle
             buffer_size: size of the buffer in number of items used for shuffling
             seed: random seed used for shuffling (or None)
+            warmup_size: initial size of the buffer (default: no warm-up, i.e. buffer_size)
         """
         if not isinstance(source_iterator, CheckpointableIterator):
             raise ValueError('source_iterator has to be a CheckpointableIterator')
+        if warmup_size is not None and warmup_size < 1:
+            raise ValueError('warmup_size must be at least 1')
         self._source_iterator = source_iterator
         self._buffer_size = buffer_size
+        self._warmup_size = warmup_size
         self._seed = seed
         self.setstate(None)
 
     def getstate(self) -> Dict:
         return {'source_state': self._source_iterator.getstate(),
-                'buffer':       copy.deepcopy(self._buffer),  # create deepcopy so that iterator cannot modify checkpoint after it was taken
+                'buffer':       _checkpoint_copy(self._buffer),  # create deepcopy so that iterator cannot modify checkpoint after it was taken
                 'random_state': self._random.getstate()}
 
     def setstate(self, checkpoint: Optional[Dict]):
@@ -532,7 +1009,8 @@ class BufferedShuffleIterator(CheckpointableIterator):
             # @TODO: Can we add a comment how the flush part is handled?
         else:
             self._source_iterator.setstate(None)
-            self._buffer = [None for _ in range(self._buffer_size)]
+            initial_size = min(self._warmup_size, self._buffer_size) if self._warmup_size is not None else self._buffer_size
+            self._buffer = [None for _ in range(initial_size)]
             self._random = Random(self._seed)
         self._iterator = self._generate()
 
@@ -549,6 +1027,8 @@ class BufferedShuffleIterator(CheckpointableIterator):
             if self._buffer[index] is not None:
                 result = self._buffer[index]
             self._buffer[index] = item
+            if len(self._buffer) < self._buffer_size:  # warm-up: grow by one slot per item read
+                self._buffer.append(None)
             # only yield value once buffer is updated to allow for correct checkpointing!
             if result is not None:
                 yield result
@@ -559,14 +1039,36 @@ class BufferedShuffleIterator(CheckpointableIterator):
             if item is not None:
                 yield item
 
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        items = [item for item in self._buffer if item is not None]
+        return len(items), sys.getsizeof(self._buffer) + estimate_size(items)
+
     def __next__(self):
         return next(self._iterator)
 
 
+def _compose_transforms(transforms: Tuple[Callable[[Any],Any], ...]) -> Callable[[Any],Any]:
+    """ Composes transforms applied in the given order into a single function """
+    if len(transforms) == 1:
+        return transforms[0]
+    def composed_transform(item):
+        for transform in transforms:
+            item = transform(item)
+        return item
+    return composed_transform
+
+
 class MapIterator(CheckpointableIterator):
     """
     Applies given tranform to each data item
+
+    Items that are skipped, e.g. when resuming from a checkpoint, are not transformed.
+
+    If the source iterator is itself a MapIterator, the two are fused into a single stage that applies both transforms,
+    which saves one call per item. The checkpoints are the same as without fusion.
     """
+    __slots__ = ('_source_iterator', '_transforms', '_transform', '__weakref__')
+
     def __init__(self, source_iterator: CheckpointableIterator, transform: Callable[[str],Any]):
         """
         Args:
@@ -575,8 +1077,13 @@ class MapIterator(CheckpointableIterator):
         """
         if not isinstance(source_iterator, CheckpointableIterator):
             raise ValueError('source_iterator has to be a CheckpointableIterator')
-        self._source_iterator = source_iterator
-        self._transform = transform
+        if type(source_iterator) is MapIterator:  # subclasses may change the behavior, hence are not fused
+            self._source_iterator = source_iterator._source_iterator
+            self._transforms = source_iterator._transforms + (transform,)
+        else:
+            self._source_iterator = source_iterator
+            self._transforms = (transform,)
+        self._transform = _compose_transforms(self._transforms)
 
     def getstate(self) -> Dict:
         return self._source_iterator.getstate()
@@ -587,33 +1094,657 @@ class MapIterator(CheckpointableIterator):
     def __next__(self):
         return self._transform(next(self._source_iterator))
 
+    def next_batch(self, n: int) -> List:
+        return list(map(self._transform, self._source_iterator.next_batch(n)))
+
+    def skip(self, n: int) -> int:
+        return self._source_iterator.skip(n)  # the transform is not applied to skipped items
+
+
+# Shared-memory transport of array payloads between processes, used by PrefetchIterator and ParallelMapIterator.
+# Items are pickled with protocol 5, which hands the data of NumPy arrays and other objects supporting
+# out-of-band pickling to a callback instead of copying it into the pickle. These buffers are written into
+# shared memory, and the receiving process unpickles the item on top of views into the shared memory.
+
+_SHARED_MEMORY_ALIGNMENT = 64  # buffers are placed at multiples of this, so that arrays reconstructed on top of them are aligned
+_MIN_OUT_OF_BAND_SIZE = 1024   # smaller buffers are pickled in-band, since the bookkeeping would cost more than the copy
+
+
+def _import_shared_memory():
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        raise RuntimeError('shared-memory transport requires Python 3.8 or newer')
+    return shared_memory
+
+
+def _aligned(n: int) -> int:
+    return (n + _SHARED_MEMORY_ALIGNMENT - 1) // _SHARED_MEMORY_ALIGNMENT * _SHARED_MEMORY_ALIGNMENT
+
+
+def _dump_out_of_band(item: Any) -> Tuple[bytes, List[memoryview]]:
+    """
+    Pickle item with protocol 5, returning the pickle and the out-of-band buffers that it excludes.
+    """
+    buffers = []
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:  # returns True to pickle the buffer in-band
+        try:
+            raw = buffer.raw()
+        except BufferError:  # not contiguous
+            return True
+        if raw.nbytes < _MIN_OUT_OF_BAND_SIZE:
+            return True
+        buffers.append(raw)
+        return False
+    return pickle.dumps(item, protocol=5, buffer_callback=buffer_callback), buffers
+
+
+def _write_buffers(buffers: List[memoryview], memory: memoryview, offset: int) -> List[Tuple[int, int]]:
+    """
+    Copy buffers into memory, starting at offset, and return their (offset, length) spans.
+    The caller has to make sure that sum(_aligned(buffer.nbytes) for buffer in buffers) bytes are available.
+    """
+    spans = []
+    for buffer in buffers:
+        memory[offset:offset + buffer.nbytes] = buffer
+        spans.append((offset, buffer.nbytes))
+        offset += _aligned(buffer.nbytes)
+    return spans
+
+
+def _load_out_of_band(message: '_SharedMemoryItem', memory: memoryview, copy: bool=False) -> Any:
+    """
+    Unpickle the item of message on top of views into memory, or on top of copies of these if copy is True.
+    """
+    buffers = [memory[offset:offset + length] for offset, length in message.spans]
+    if copy:
+        buffers = [bytearray(buffer) for buffer in buffers]
+    return pickle.loads(message.pickled_item, buffers=buffers)
+
+
+class _SharedMemoryItem:
+    """
+    Message that is sent between processes in place of an item whose array payloads were placed in shared memory.
+    """
+    __slots__ = ('pickled_item', 'spans', 'end')
+
+    def __init__(self, pickled_item: bytes, spans: List[Tuple[int, int]], end: Optional[int]):
+        self.pickled_item = pickled_item  # type: bytes                  -- item pickled with protocol 5, out-of-band buffers excluded
+        self.spans = spans                # type: List[Tuple[int, int]]  -- (offset, length) of each out-of-band buffer in the shared memory
+        self.end = end                    # type: Optional[int]          -- _SharedMemoryRingBuffer: logical position after this item, None if it uses no space
+
+
+class _SharedMemorySlabPool:
+    """
+    Pool of equally sized shared-memory slabs into which the workers of ParallelMapIterator write the array payloads of their results.
+
+    The main process assigns a free slab to each work unit it submits. The worker writes the out-of-band buffers
+    of the unit's results into that slab and returns a _SharedMemoryItem instead of the results.
+    The main process unpickles the results on top of views into the slab, and releases the slab for reuse
+    once the results are no longer needed. New slabs are only created if no released slab is available.
+
+    Args:
+        slab_size: size of each slab in bytes
+    """
+    def __init__(self, slab_size: int):
+        self._shared_memory_module = _import_shared_memory()
+        if slab_size <= 0:
+            raise ValueError('shared_memory_size must be positive')
+        self.slab_size = _aligned(slab_size)  # type: int
+        self._slabs = {}                       # type: Dict[str, Any]  -- all slabs by name
+        self._free_slab_names = []             # type: List[str]
+        self._finalizer = weakref.finalize(self, _SharedMemorySlabPool._close, self._slabs, os.getpid())  # also called when garbage-collected or at exit
+
+    def acquire(self) -> str:
+        """
+        Get the name of a free slab.
+        """
+        if self._free_slab_names:
+            return self._free_slab_names.pop()
+        slab = self._shared_memory_module.SharedMemory(create=True, size=self.slab_size)
+        self._slabs[slab.name] = slab
+        return slab.name
+
+    def release(self, slab_name: str):
+        """
+        Return a slab for reuse. Results loaded from it must no longer be used.
+        """
+        self._free_slab_names.append(slab_name)
+
+    def load(self, slab_name: str, message: _SharedMemoryItem, copy: bool=False) -> Any:
+        """
+        Reconstruct the results a worker wrote into a slab, with their buffers being views into the slab (or copies if copy is True).
+        """
+        return _load_out_of_band(message, self._slabs[slab_name].buf, copy)
+
+    def close(self):
+        self._finalizer()
+        self._free_slab_names = []
+
+    @staticmethod
+    def _close(slabs: Dict[str, Any], owner_pid: int):  # must not refer to the pool, so that the pool can be garbage-collected
+        if owner_pid != os.getpid():
+            return
+        for slab in slabs.values():
+            _close_shared_memory(slab)
+        slabs.clear()
+
+
+_unclosed_shared_memory = []  # type: List[Any]  -- blocks whose memory was still referenced when they were closed, see _close_shared_memory()
+
+def _close_shared_memory(block: Optional[Any]=None):
+    """
+    Unlink and close a shared-memory block created by this process.
+
+    While items handed out still reference its memory, the block cannot be closed (SharedMemory.close() raises BufferError).
+    It is then kept mapped, and closing it is retried on every later call, and at exit.
+    Calling this without a block only does the retrying.
+    """
+    pending = list(_unclosed_shared_memory)
+    del _unclosed_shared_memory[:]
+    if block is not None:
+        block.unlink()
+        pending.append(block)
+    for pending_block in pending:
+        try:
+            pending_block.close()
+        except BufferError:
+            _unclosed_shared_memory.append(pending_block)
+
+atexit.register(_close_shared_memory)
+
+
+def _ensure_resource_tracker():
+    """
+    Start the resource tracker of this process before it starts worker processes that will attach to its shared memory.
+
+    Before Python 3.13, attaching to a shared-memory block registers it with the resource tracker, which unlinks the block
+    when the process ends. Worker processes started while the tracker runs share it (also with the spawn and forkserver
+    start methods), so this only re-registers the block with the creator's tracker. A worker started before would start
+    a tracker of its own, which would unlink the blocks a second time when the worker ends, and warn about a leak.
+    """
+    if os.name == 'posix' and (3, 8) <= sys.version_info < (3, 13):
+        from multiprocessing import resource_tracker
+        resource_tracker.ensure_running()
+
+
+def _attach_shared_memory(name: str) -> Any:
+    """
+    Attach to a shared-memory block created by another process, which remains responsible for unlinking it.
+    Processes attaching with Python < 3.13 must share the resource tracker of the creator, see _ensure_resource_tracker().
+    """
+    shared_memory = _import_shared_memory()
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _dump_to_slab(results: List[Any], slab_name: str, slab_size: int) -> Any:
+    # executed on a worker: write the out-of-band buffers of results into the given slab, see _SharedMemorySlabPool
+    pickled_results, buffers = _dump_out_of_band(results)
+    if not buffers:
+        return _SharedMemoryItem(pickled_results, [], None)
+    if sum(_aligned(buffer.nbytes) for buffer in buffers) > slab_size:  # does not fit, pickle the buffers in-band instead
+        return _SharedMemoryItem(pickle.dumps(results, protocol=5), [], None)
+    # attach for this call only, since workers of a shared WorkerPool outlive the slabs of any one pipeline
+    slab = _attach_shared_memory(slab_name)
+    try:
+        spans = _write_buffers(buffers, slab.buf, 0)
+    finally:
+        slab.close()
+    return _SharedMemoryItem(pickled_results, spans, None)
+
+
+class WorkerPool:
+    """
+    Pool of worker processes or threads for ParallelMapIterator that can be shared among multiple pipeline stages and pipelines.
+
+    Sharing one pool avoids paying the start-up cost of a pool for every pipeline, e.g. when pipelines are rebuilt
+    for every epoch or evaluation set, and prevents multiple parallel stages from oversubscribing the CPU cores.
+    The pool should be shut down explicitly with close(), or used as a context manager:
+    ```
+    with WorkerPool(8) as pool:
+        it = ParallelMapIterator(it, transform, num_processes=8, num_items_per_process=100, pool=pool)
+        ...
+    ```
+    Otherwise, it is shut down when it is garbage-collected, which may happen late, or at exit.
+    The total number of workers of all open WorkerPools of the current process is capped at WorkerPool.max_total_workers,
+    which defaults to the number of CPU cores of the host. A pool that would exceed the cap gets fewer workers, but at least one,
+    and a warning is logged. Pass limit_workers=False to exempt a pool from the cap; its workers still count towards it.
+    The cap is per process: it does not coordinate with other processes on the same host, e.g. other training processes,
+    so these have to divide the cores among themselves, e.g. by setting max_total_workers to their share.
+
+    There are two backends:
+    'process' transforms items in worker processes. Items, results, and the transform function are pickled
+    to cross the process boundaries, so the transform has to be a top-level function.
+    'thread' transforms items in worker threads of the current process. This avoids the pickling and allows any callable
+    as transform, but only gives a speed-up if the transform releases the GIL, e.g. NumPy operations, zlib, or hashlib.
+
+    Args:
+        num_processes: number of workers (default: WorkerPool.max_total_workers)
+        backend: 'process' (default) or 'thread'
+        limit_workers: whether the pool is subject to WorkerPool.max_total_workers (default: True)
+    """
+    max_total_workers = os.cpu_count() or 1  # type: int  -- cap on the workers of all open pools of this process, change before creating pools
+    _num_total_workers = 0                    # type: int  -- number of workers of all open pools of this process
+
+    def __init__(self, num_processes: Optional[int]=None, backend: str='process', limit_workers: bool=True):
+        if backend not in ('process', 'thread'):
+            raise ValueError("unknown WorkerPool backend '{}'".format(backend))
+        if num_processes is None:
+            num_processes = WorkerPool.max_total_workers
+        if num_processes < 1:
+            raise ValueError('num_processes must be at least 1')
+        self.num_processes = num_processes  # type: int
+        if limit_workers:
+            self.num_processes = max(1, min(num_processes, WorkerPool.max_total_workers - WorkerPool._num_total_workers))
+            if self.num_processes < num_processes:
+                _logger.warning('WorkerPool gets %d instead of %d workers, since open pools of this process already have %d workers '
+                                'and WorkerPool.max_total_workers is %d', self.num_processes, num_processes,
+                                WorkerPool._num_total_workers, WorkerPool.max_total_workers)
+        self.backend = backend  # type: str
+        self._owner_pid = os.getpid()
+        if backend == 'thread':
+            self._pool = python_multiprocessing.pool.ThreadPool(self.num_processes)
+        else:
+            _ensure_resource_tracker()  # workers may write into shared memory of this process, see _attach_shared_memory()
+            self._pool = python_multiprocessing.Pool(self.num_processes)
+        WorkerPool._num_total_workers += self.num_processes
+        self._finalizer = weakref.finalize(self, WorkerPool._terminate, self._pool, self.num_processes, self._owner_pid)  # also called when garbage-collected
+
+    def map_async(self, transform: Callable[[Any],Any], items: List[Any]):
+        """
+        Start applying transform to each of the items, see multiprocessing.Pool.map_async().
+        """
+        if self._pool is None:
+            raise ValueError('WorkerPool has been closed')
+        return self._pool.map_async(transform, items)
+
+    def apply_async(self, fn: Callable, args: Tuple, callback: Optional[Callable[[Any], None]]=None):
+        """
+        Start calling fn(*args) on a worker, see multiprocessing.Pool.apply_async().
+        """
+        if self._pool is None:
+            raise ValueError('WorkerPool has been closed')
+        return self._pool.apply_async(fn, args, callback=callback)
+
+    def close(self):
+        """
+        Terminate the workers. Pending work is abandoned. Calling this more than once has no effect.
+        """
+        if self._pool is None or self._owner_pid != os.getpid():  # only the creating process may terminate the workers, cf. _ForkPrefetchIterator._join_process()
+            return
+        self._finalizer()
+        self._pool = None
+
+    @staticmethod
+    def _terminate(pool: Any, num_processes: int, owner_pid: int):  # must not refer to the WorkerPool, so that it can be garbage-collected
+        if owner_pid != os.getpid():
+            return
+        pool.terminate()
+        pool.join()
+        WorkerPool._num_total_workers -= num_processes
+
+    @property
+    def closed(self) -> bool:
+        return self._pool is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class _PipelinedBatchMapIterator(CheckpointableIterator):
+    """
+    Internal helper for ParallelMapIterator that applies a transform to the items of each batch using a process pool,
+    keeping up to num_in_flight_batches batches in flight, so that the pool works ahead while the consumer processes a batch.
+
+    The checkpoint is the checkpoint of the source iterator before the next batch to be yielded,
+    i.e. the same as that of a MapIterator over the source.
+
+    Args:
+        source_iterator: checkpointable iterator over batches (lists of items)
+        transform: function to be applied to each item of a batch
+        pool: WorkerPool to use
+        num_in_flight_batches: maximum number of batches that are submitted to the pool but not yet yielded
+    """
+    def __init__(self, source_iterator: CheckpointableIterator, transform: Callable[[Any],Any], pool, num_in_flight_batches: int):
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        if num_in_flight_batches < 1:
+            raise ValueError('num_in_flight_batches must be at least 1')
+        self._source_iterator = source_iterator            # type: CheckpointableIterator
+        self._transform = transform                        # type: Callable[[Any],Any]
+        self._pool = pool
+        self._num_in_flight_batches = num_in_flight_batches  # type: int
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        if self._in_flight:  # the source is ahead of us; use its state from before the oldest batch in flight
+            return self._in_flight[0][0]
+        return self._source_iterator.getstate()
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        # batches still in flight are simply abandoned; the pool finishes them, but nobody picks up the results
+        self._in_flight = collections.deque()  # type: collections.deque  -- (source state before batch, AsyncResult) pairs
+        self._source_exhausted = False
+        self._source_iterator.setstate(checkpoint)
+
+    def __next__(self):
+        # top up the batches in flight
+        while not self._source_exhausted and len(self._in_flight) < self._num_in_flight_batches:
+            source_state = self._source_iterator.getstate()
+            try:
+                batch = next(self._source_iterator)
+            except StopIteration:
+                self._source_exhausted = True
+                break
+            self._in_flight.append((source_state, self._pool.map_async(self._transform, batch)))
+        if not self._in_flight:
+            raise StopIteration()
+        result = self._in_flight[0][1].get()  # (note: pop only after get(), so that getstate() is consistent if get() raises)
+        self._in_flight.popleft()
+        return result
+
+
+def _apply_transform_timed(transform: Callable[[Any],Any], items: List[Any], slab: Optional[Tuple[str, int]]=None) -> Tuple[Any, float, float]:
+    # work unit of _AdaptiveBatchMapIterator, executed on a worker; this is a top-level function, so that it can be pickled
+    start_time = time.time()  # (note: wall-clock time, so that it is comparable across processes)
+    results = [transform(item) for item in items]
+    end_time = time.time()
+    if slab is not None:  # writing the results into shared memory counts as communication, not as transform time
+        results = _dump_to_slab(results, *slab)
+    return results, start_time, end_time
+
+
+class _AdaptiveBatchMapIterator(CheckpointableIterator):
+    """
+    Internal helper for ParallelMapIterator that batches items and applies a transform to the items of each batch using a pool,
+    tuning the number of items per work unit and the number of active workers at runtime.
+
+    Each batch is split into one work unit per active worker. After each batch, the iterator updates running estimates
+    of the transform time per item and of the inter-process communication (IPC) cost per work unit, and picks the
+    smallest number of items per work unit for which the IPC cost stays below _MAX_IPC_OVERHEAD of the transform time.
+    If scale_workers is set, the number of active workers is decreased while the results are always ready before
+    the consumer asks for them, i.e. the consumer is the bottleneck, and increased whenever the consumer has to wait.
+
+    The sequence of transformed items does not depend on the batch sizes.
+    The checkpoint contains the size of the next batch, so that this batch is re-created exactly when restoring a checkpoint.
+
+    If a slab_pool is given, workers pass array payloads of their results through shared memory, see _SharedMemorySlabPool.
+    The slabs of a batch are released when the next batch is requested. If copy_items is set, the results are copied
+    out of the slabs, which are then released right away.
+
+    Args:
+        source_iterator: checkpointable iterator over items
+        transform: function to be applied to each item
+        pool: WorkerPool to use
+        num_workers: maximum number of active workers
+        num_items_per_process: initial number of items per work unit
+        items_per_process_bounds: (min, max) bounds for the number of items per work unit
+        scale_workers: whether to scale the number of active workers, see above
+        num_in_flight_batches: maximum number of batches that are submitted to the pool but not yet yielded
+        slab_pool: if given, _SharedMemorySlabPool to pass results through
+    """
+    _MAX_IPC_OVERHEAD = 0.05     # target ratio of IPC cost to transform time per work unit
+    _SMOOTHING = 0.2             # weight of the latest measurement in the running estimates
+    _NUM_READY_TO_SCALE_DOWN = 3  # number of consecutive batches that must be ready ahead of time before deactivating a worker
+
+    def __init__(self, source_iterator: CheckpointableIterator, transform: Callable[[Any],Any], pool: WorkerPool, num_workers: int,
+                 num_items_per_process: int, items_per_process_bounds: Tuple[int, int], scale_workers: bool, num_in_flight_batches: int,
+                 slab_pool: Optional[_SharedMemorySlabPool]=None):
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        min_items_per_process, max_items_per_process = items_per_process_bounds
+        if not 1 <= min_items_per_process <= max_items_per_process:
+            raise ValueError('items_per_process_bounds must satisfy 1 <= min <= max')
+        if num_in_flight_batches < 1:
+            raise ValueError('num_in_flight_batches must be at least 1')
+        self._source_iterator = source_iterator                      # type: CheckpointableIterator
+        self._transform = transform                                  # type: Callable[[Any],Any]
+        self._pool = pool                                            # type: WorkerPool
+        self._max_workers = num_workers                              # type: int
+        self._items_per_process_bounds = (min_items_per_process, max_items_per_process)
+        self._scale_workers = scale_workers                          # type: bool
+        self._num_in_flight_batches = num_in_flight_batches          # type: int
+        self._slab_pool = slab_pool                                  # type: Optional[_SharedMemorySlabPool]
+        self._last_batch_units = []                                  # type: List[Tuple[Optional[str], Any, List]]  -- slab, message, and results of each unit of the batch yielded last
+        self.copy_items = False                                      # type: bool        -- if set, results are copied out of the slabs
+        self._abandoned_units = []                                   # type: List[Dict]  -- units of batches dropped by setstate() whose slabs are not yet released
+        # tuning state; this is deliberately not part of the checkpoint, since it reflects the machine rather than the data
+        self.items_per_process = min(max(num_items_per_process, min_items_per_process), max_items_per_process)  # type: int
+        self.num_active_workers = num_workers                        # type: int
+        self._seconds_per_item = None                                # type: Optional[float]
+        self._ipc_seconds_per_unit = None                            # type: Optional[float]
+        self._num_ready_batches = 0                                  # type: int
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        if self._in_flight:  # the source is ahead of us; use the state from before the oldest batch in flight
+            return self._in_flight[0]['checkpoint']
+        return {'source_state': self._source_iterator.getstate(),
+                'batch_size':   self._next_batch_size}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        # batches still in flight are simply abandoned; the pool finishes them, but nobody picks up the results
+        # (their slabs are released once the workers are done writing into them)
+        if self._slab_pool is not None and getattr(self, '_in_flight', None):
+            self._abandoned_units.extend(unit for batch in self._in_flight for unit in batch['units'])
+        self._release_slabs()
+        self._in_flight = collections.deque()  # type: collections.deque  -- one dict per batch, see _submit_batch()
+        self._source_exhausted = False
+        self._source_iterator.setstate(checkpoint['source_state'] if checkpoint else None)
+        self._next_batch_size = checkpoint['batch_size'] if checkpoint else self._batch_size()  # type: int
+
+    def _batch_size(self) -> int:
+        return self.num_active_workers * self.items_per_process
+
+    def _submit_batch(self) -> bool:  # pull the next batch from the source and submit it to the pool; returns False if the source is exhausted
+        checkpoint = {'source_state': self._source_iterator.getstate(),
+                      'batch_size':   self._next_batch_size}
+        batch = list(islice(self._source_iterator, self._next_batch_size))
+        if not batch:
+            return False
+        num_units = math.ceil(len(batch) / self.items_per_process)
+        unit_size = math.ceil(len(batch) / num_units)
+        units = []
+        for i in range(0, len(batch), unit_size):
+            slab_name = self._slab_pool.acquire() if self._slab_pool else None
+            slab = (slab_name, self._slab_pool.slab_size) if self._slab_pool else None
+            unit = {'num_items': min(unit_size, len(batch) - i), 'submit_time': time.time(), 'done_time': None, 'slab_name': slab_name}
+            unit['result'] = self._pool.apply_async(_apply_transform_timed, (self._transform, batch[i:i + unit_size], slab),
+                                                    callback=functools.partial(self._on_unit_done, unit))
+            units.append(unit)
+        self._in_flight.append({'checkpoint': checkpoint, 'units': units})
+        self._next_batch_size = self._batch_size()
+        return True
+
+    @staticmethod
+    def _on_unit_done(unit: Dict, _):  # called on the pool's result handler thread
+        unit['done_time'] = time.time()
+
+    def _update_estimates(self, units: List[Dict], results: List[Tuple[List[Any], float, float]]):
+        num_items = sum(unit['num_items'] for unit in units)
+        transform_seconds = sum(end_time - start_time for _, start_time, end_time in results)
+        # IPC cost of a work unit: sending the items (the fastest dispatch, i.e. without waiting for a free worker) plus returning the results
+        send_seconds = min(max(start_time - unit['submit_time'], 0.0) for unit, (_, start_time, _) in zip(units, results))
+        receive_seconds = sum(max(unit['done_time'] - end_time, 0.0) for unit, (_, _, end_time) in zip(units, results) if unit['done_time'] is not None) / len(units)
+        def smoothed(estimate, measurement):
+            return measurement if estimate is None else (1 - self._SMOOTHING) * estimate + self._SMOOTHING * measurement
+        self._seconds_per_item = smoothed(self._seconds_per_item, transform_seconds / num_items)
+        self._ipc_seconds_per_unit = smoothed(self._ipc_seconds_per_unit, send_seconds + receive_seconds)
+        min_items_per_process, max_items_per_process = self._items_per_process_bounds
+        if self._seconds_per_item > 0:
+            items_per_process = math.ceil(self._ipc_seconds_per_unit / (self._MAX_IPC_OVERHEAD * self._seconds_per_item))
+        else:
+            items_per_process = max_items_per_process
+        self.items_per_process = min(max(items_per_process, min_items_per_process), max_items_per_process)
+
+    def _update_num_active_workers(self, was_ready: bool):
+        if was_ready:  # the consumer is slower than the workers
+            self._num_ready_batches += 1
+            if self._num_ready_batches >= self._NUM_READY_TO_SCALE_DOWN and self.num_active_workers > 1:
+                self.num_active_workers -= 1
+                self._num_ready_batches = 0
+        else:  # the consumer had to wait for the workers
+            self._num_ready_batches = 0
+            if self.num_active_workers < self._max_workers:
+                self.num_active_workers += 1
+
+    def _release_slabs(self):  # release the slabs of the batch yielded last and of abandoned batches that are done
+        if self._slab_pool is None:
+            return
+        for slab_name, _, _ in self._last_batch_units:
+            if slab_name is not None:
+                self._slab_pool.release(slab_name)
+        self._last_batch_units = []
+        pending_units = []
+        for unit in self._abandoned_units:
+            if unit['result'].ready():  # checked once per unit, since a unit may become ready in between
+                self._slab_pool.release(unit['slab_name'])
+            else:
+                pending_units.append(unit)
+        self._abandoned_units = pending_units
+
+    def copy_last_batch(self, start: int) -> Optional[List]:
+        """
+        Copies of the results of the batch yielded last, from index start on, whose array data does not refer to the slabs,
+        or None if the results do not refer to the slabs anyway.
+        """
+        if all(message is None for _, message, _ in self._last_batch_units):
+            return None
+        batch = []
+        for slab_name, message, unit_results in self._last_batch_units:
+            if start < len(unit_results):
+                if message is not None:
+                    unit_results = self._slab_pool.load(slab_name, message, copy=True)
+                batch.extend(unit_results[start:])
+            start = max(0, start - len(unit_results))
+        return batch
+
+    def __next__(self):
+        self._release_slabs()  # the items of the previous batch are no longer needed
+        # top up the batches in flight
+        while not self._source_exhausted and len(self._in_flight) < self._num_in_flight_batches:
+            self._source_exhausted = not self._submit_batch()
+        if not self._in_flight:
+            raise StopIteration()
+        units = self._in_flight[0]['units']
+        was_ready = all(unit['result'].ready() for unit in units)
+        results = [unit['result'].get() for unit in units]  # (note: pop only after get(), so that getstate() is consistent if get() raises)
+        self._in_flight.popleft()
+        self._update_estimates(units, results)
+        if self._scale_workers:
+            self._update_num_active_workers(was_ready)
+        batch = []
+        for unit, (unit_results, _, _) in zip(units, results):
+            slab_name, message = unit['slab_name'], None
+            if isinstance(unit_results, _SharedMemoryItem):
+                message = unit_results
+                unit_results = self._slab_pool.load(slab_name, message, copy=self.copy_items)
+            if slab_name is not None and self.copy_items:  # the results do not refer to the slab
+                self._slab_pool.release(slab_name)
+                slab_name, message = None, None
+            self._last_batch_units.append((slab_name, message, unit_results))
+            batch.extend(unit_results)
+        return batch
+
+
+class _SharedMemorySelectManyIterator(SelectManyIterator):
+    """
+    Flattens the batches of an _AdaptiveBatchMapIterator that passes results through shared-memory slabs.
+    The items returned by next_batch() are copied out of the slabs, since the slabs of a batch are recycled
+    once the next batch is requested, cf. _ForkPrefetchIterator.next_batch().
+    """
+    def next_batch(self, n: int) -> List:
+        if self._data is not None:  # the rest of the current batch may have been loaded as views into the slabs; replace it by copies
+            copies = self._source_iterator.copy_last_batch(self._flattened_items_yielded)
+            if copies is not None:
+                self._data = iter(copies)
+        self._source_iterator.copy_items = True
+        try:
+            return super().next_batch(n)
+        finally:
+            self._source_iterator.copy_items = False
+
 
-def ParallelMapIterator(source_iterator: CheckpointableIterator, transform: Callable[[str],Any], num_processes: int, num_items_per_process: int):
+def ParallelMapIterator(source_iterator: CheckpointableIterator, transform: Callable[[str],Any], num_processes: int, num_items_per_process: int,
+                        num_in_flight_batches: int=2, pool: Optional[WorkerPool]=None, backend: str='process',
+                        items_per_process_bounds: Optional[Tuple[int, int]]=None, scale_workers: bool=False, shared_memory_size: Optional[int]=None,
+                        limit_workers: bool=False):
     """
     Applies given transform to each data item
 
     Behaves the same as MapIterator, but applies transform in parallel using multiple processes in a parallel map operation.
+    The data items are processed in batches of num_processes * num_items_per_process items.
+    Up to num_in_flight_batches batches are processed ahead, so that the processes keep working while the consumer
+    is busy with the items of the current batch.
+
+    If no pool is given, the iterator creates its own WorkerPool, which is closed once the returned iterator is garbage-collected.
+    This pool has num_processes workers, regardless of WorkerPool.max_total_workers, unless limit_workers is True;
+    then it may get fewer workers, and batches are sized for these.
+    To share processes among multiple stages, or to control when they are shut down, pass a WorkerPool.
+
+    If num_items_per_process is too small, the communication between processes dominates; if it is too large,
+    latency and memory use increase. If items_per_process_bounds is given, num_items_per_process is only the initial value
+    and is tuned at runtime within these bounds, based on the measured transform time per item and communication cost.
+    If scale_workers is True, the number of workers that are given work is reduced while the consumer of this iterator
+    is the bottleneck, which frees CPU cores for other work. Neither option changes the sequence of items,
+    so checkpoints stay valid.
+
+    If shared_memory_size is given, the 'process' backend passes large array payloads of the results (e.g. the data of NumPy arrays)
+    through shared-memory slabs of this size, one per work unit, instead of pickling them through a pipe (requires Python 3.8).
+    Array data in items obtained this way is a view into a slab that is recycled once the next item is requested
+    or setstate() is called; copy it if you need to keep it longer. Items obtained through next_batch() are copied out of the slabs.
 
     Warning:
-    The transform function has to be pickleable because it is sent across process boundaries.
+    With the 'process' backend, the transform function has to be pickleable because it is sent across process boundaries.
     To achieve this, transform should be a top-level function.
+    The 'thread' backend has no such restriction, see WorkerPool for when it is preferable.
 
     Args:
         source_iterator: checkpointable iterator
         transform: function to be applied to each data item, has to be pickleable, see above
         num_processes: number of processes to use for parallel map
         num_items_per_process: number of data items each process operates on
+        num_in_flight_batches: maximum number of batches that are transformed ahead (default: 2). Pass 1 to transform synchronously.
+        pool: WorkerPool to use, see above. The pool is not closed by the iterator.
+        backend: backend of the WorkerPool created if no pool is given: 'process' (default) or 'thread'
+        items_per_process_bounds: (min, max) bounds to tune num_items_per_process within, see above (default: no tuning)
+        scale_workers: whether to scale the number of active workers, see above (default: False)
+        shared_memory_size: size in bytes of the shared-memory slab for the results of one work unit, see above (default: no shared memory)
+        limit_workers: whether the WorkerPool created if no pool is given is subject to WorkerPool.max_total_workers, see above (default: False)
     """
-    # divide stream of data items into batches
-    batched_samples = FixedBatchIterator(source_iterator, num_processes * num_items_per_process)
-    # create process pool and capture it in closure that performs parallel map
-    p = python_multiprocessing.Pool(num_processes)
-    def parallel_map_transform(buffer):
-        return p.map(transform, buffer)
-    # apply transform in parallel to data items in a batch
-    batched_transformed_samples = MapIterator(batched_samples, parallel_map_transform)
+    if shared_memory_size and (pool.backend if pool is not None else backend) != 'process':
+        raise ValueError("shared_memory_size is only supported by the WorkerPool backend 'process'")
+    # create process pool unless one is given
+    own_pool = pool is None
+    if own_pool:
+        pool = WorkerPool(num_processes, backend=backend, limit_workers=limit_workers)
+        num_processes = pool.num_processes
+    slab_pool = _SharedMemorySlabPool(shared_memory_size) if shared_memory_size else None
+    if items_per_process_bounds is not None or scale_workers or slab_pool is not None:
+        # batch and apply transform in parallel in explicit work units, with tuning of the batch sizes
+        if items_per_process_bounds is None:
+            items_per_process_bounds = (num_items_per_process, num_items_per_process)
+        batched_transformed_samples = _AdaptiveBatchMapIterator(source_iterator, transform, pool, num_processes, num_items_per_process,
+                                                                items_per_process_bounds, scale_workers, num_in_flight_batches, slab_pool)
+    else:
+        # divide stream of data items into batches
+        batched_samples = FixedBatchIterator(source_iterator, num_processes * num_items_per_process)
+        # apply transform in parallel to data items in a batch, keeping several batches in flight
+        batched_transformed_samples = _PipelinedBatchMapIterator(batched_samples, transform, pool, num_in_flight_batches)
     # unpack batches to go back to stream of (now transformed) data items
-    transformed_samples = SelectManyIterator(batched_transformed_samples)
+    if slab_pool is not None:
+        transformed_samples = _SharedMemorySelectManyIterator(batched_transformed_samples)
+    else:
+        transformed_samples = SelectManyIterator(batched_transformed_samples)
+    if own_pool:  # shut down our pool together with the pipeline
+        weakref.finalize(transformed_samples, pool.close)
+    if slab_pool is not None:
+        weakref.finalize(transformed_samples, slab_pool.close)
     return transformed_samples
 
 
@@ -653,25 +1784,37 @@ class ZipIterator(CheckpointableIterator):
         return tuple(res)
 
 
-# @TODO: The yield makes a (shallow) copy of the window, which has complexity O(width * length). In some cases,
-#        we don't actually need to consume all items in the window. Hence, to make this faster, we should use
-#        double-buffering and return a slice view (which we'd have to write).
+# @TODO: In generic mode, the yield makes a (shallow) copy of the window, which has complexity O(width * length).
+#        In some cases, we don't actually need to consume all items in the window. Hence, to make this faster,
+#        we should return a slice view (which we'd have to write). For numbers, the numeric mode already does that.
 class WindowedIterator(CheckpointableIterator):
     """
     Yields 'width' consecutive items in a sliding window.
 
     E.g. [1, 2, 3, 4, 5, 6] with width = 3 will yield
     [[1, 2, 3], [2, 3, 4], [3, 4, 5], [4, 5, 6]]
+
+    If the items are numbers, e.g. token ids, pass the typecode of the Python `array` module that can represent them
+    to use the numeric mode. Then, the windows are read-only memoryviews into a contiguous buffer,
+    which costs O(1) per window instead of O(width). Use e.g. numpy.frombuffer() to turn a window into an array without copying.
     """
-    def __init__(self, source_iterator: CheckpointableIterator, width: int):
+    def __init__(self, source_iterator: CheckpointableIterator, width: int, typecode: Optional[str]=None):
         """
         Args:
             source_iterator: checkpointable input iterators
+            width: number of items in a window
+            typecode: if given, typecode of the `array` module to store items in, see above (e.g. 'l' for integers, 'd' for floats)
         """
         if not isinstance(source_iterator, CheckpointableIterator):
             raise ValueError('source_iterator has to be a CheckpointableIterator')
+        if typecode is not None:
+            try:  # the conversion of _generate(), which rejects some typecodes that the array module accepts, e.g. 'u'
+                memoryview(array.array(typecode).tobytes()).cast(typecode)
+            except (TypeError, ValueError):
+                raise ValueError("typecode '{}' is not supported".format(typecode))
         self._source_iterator = source_iterator  # type: CheckpointableIterator
         self._width = width                      # type: int
+        self._typecode = typecode                # type: Optional[str]
         self.setstate(None)
 
     def getstate(self) -> Dict:
@@ -684,18 +1827,38 @@ class WindowedIterator(CheckpointableIterator):
         self._source_iterator.setstate(self._source_state)
         self._iterator = self._generate()
 
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        n = checkpoint['item_index'] if checkpoint else 0
+        if not n:
+            return 0, ''
+        return n, 're-reads the current block of up to {} items and skips {} windows'.format(2 * self._width, n)
+
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        fifo = getattr(self, '_fifo', [])  # (not created before the first item is requested)
+        if self._typecode is not None:  # the size of an array includes its data; plus the copy the windows are views into
+            fifo_view = getattr(self, '_fifo_view', None)
+            return len(fifo), sys.getsizeof(fifo) + (fifo_view.nbytes if fifo_view is not None else 0)
+        return len(fifo), sys.getsizeof(fifo) + estimate_size(fifo)
+
     def _fifo_slice(self, i):  # returns a window into the FIFO beginning at i
-        # @TODO: for efficiency, make this a slice view
+        if self._typecode is not None:  # numeric mode: O(1) slice view
+            return self._fifo_view[i:i + self._width]
         return tuple(self._fifo[i:i + self._width])
 
     def _generate(self) -> Iterator:
         self._source_state = self._source_iterator.getstate()
-        self._fifo = list(islice(self._source_iterator, self._width))
+        if self._typecode is not None:
+            self._fifo = array.array(self._typecode, islice(self._source_iterator, self._width))
+        else:
+            self._fifo = list(islice(self._source_iterator, self._width))
         # we do this in overlapping blocks of length 2*width, for easier checkpointing and potential efficiency
         while len(self._fifo) == self._width:
             # we got 'width' items; append another 'width' (or less if at end)
             next_input_state = self._source_iterator.getstate()
             self._fifo.extend(islice(self._source_iterator, self._width))
+            if self._typecode is not None:
+                # windows are views into an immutable copy of the block, which costs O(width) per block, i.e. O(1) per window
+                self._fifo_view = memoryview(self._fifo.tobytes()).cast(self._typecode)
             # now serve all positions in first half (last = width - 1). If at end, then limit accordingly.
             last = min(self._width - 1, len(self._fifo) - self._width)
             while self._item_index <= last:
@@ -719,6 +1882,8 @@ class FixedBatchIterator(CheckpointableIterator):
     E.g. [1, 2, 3 4, 5, 6, 7, 8] with batch_size = 3 will yield
     [(1, 2, 3), (4, 5, 6), (7, 8)]
     """
+    __slots__ = ('_source_iterator', '_batch_size', '__weakref__')
+
     def __init__(self, source_iterator: CheckpointableIterator, batch_size: int):
         """
         Args:
@@ -735,19 +1900,50 @@ class FixedBatchIterator(CheckpointableIterator):
         return {'source_state': self._source_iterator.getstate()}  # state for first item in next batch
 
     def setstate(self, checkpoint: Optional[Dict]):
-        self._source_state = checkpoint['source_state'] if checkpoint else None
-        self._source_iterator.setstate(self._source_state)
-        self._iterator = self._generate()
+        self._source_iterator.setstate(checkpoint['source_state'] if checkpoint else None)
 
-    def _generate(self) -> Iterator:
-        while True:
-            batch = list(islice(self._source_iterator, self._batch_size))
-            if not batch:
-                break
-            yield batch
+    def __next__(self):
+        batch = self._source_iterator.next_batch(self._batch_size)
+        if not batch:
+            raise StopIteration
+        return batch
+
+    def next_batch(self, n: int) -> List:
+        items = self._source_iterator.next_batch(n * self._batch_size)
+        return [items[i:i + self._batch_size] for i in range(0, len(items), self._batch_size)]
+
+    def skip(self, n: int) -> int:
+        num_items_skipped = self._source_iterator.skip(n * self._batch_size)
+        return (num_items_skipped + self._batch_size - 1) // self._batch_size
+
+
+class _WarmupBatchIterator(CheckpointableIterator):
+    """
+    Like FixedBatchIterator, but the first batch has initial_batch_size items, and each further batch twice as many
+    as the previous one, up to batch_size. Used for the warm-up of BlockwiseShuffleIterator.
+    """
+    def __init__(self, source_iterator: CheckpointableIterator, batch_size: int, initial_batch_size: int):
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        self._source_iterator = source_iterator                          # type: CheckpointableIterator
+        self._batch_size = batch_size                                    # type: int
+        self._initial_batch_size = min(initial_batch_size, batch_size)  # type: int
+        self.setstate(None)
+
+    def getstate(self) -> Dict:
+        return {'source_state':    self._source_iterator.getstate(),  # state for first item in next batch
+                'next_batch_size': self._next_batch_size}
+
+    def setstate(self, checkpoint: Optional[Dict]):
+        self._source_iterator.setstate(checkpoint['source_state'] if checkpoint else None)
+        self._next_batch_size = checkpoint['next_batch_size'] if checkpoint else self._initial_batch_size  # type: int
 
     def __next__(self):
-        return next(self._iterator)
+        batch = self._source_iterator.next_batch(self._next_batch_size)
+        if not batch:
+            raise StopIteration
+        self._next_batch_size = min(2 * self._next_batch_size, self._batch_size)
+        return batch
 
 
 class RandomIterator(CheckpointableIterator):
@@ -781,7 +1977,16 @@ class RecurrentIterator(CheckpointableIterator):
     """
     Iterates statefully over a step function. The step function accepts a state and a new item,
     and returns a new state and an output item, which is yielded.
+
+    By default, the recurrent state is deep-copied whenever a checkpoint is taken or restored,
+    so that the step function may modify it in place. For large states, this makes checkpointing expensive.
+    Such states can implement a snapshot protocol instead, consisting of two methods:
+    state.snapshot() returns an object that is stored in the checkpoint and must not change when the state is modified later,
+    and snapshot.restore() returns a state to continue from, whose modification must not change the snapshot.
+    Both should be cheap, e.g. by using immutable data structures, or by deferring the copy until the next modification (copy-on-write).
     """
+    __slots__ = ('_source_iterator', '_step_function', '_initial_state', '_recurrent_state', '__weakref__')
+
     def __init__(self, source_iterator: CheckpointableIterator, step_function: Callable[[Any,Any], Tuple[Any,Any]], initial_state: Any = None):
         """
         Args:
@@ -793,30 +1998,45 @@ class RecurrentIterator(CheckpointableIterator):
             raise ValueError('source_iterator has to be a CheckpointableIterator')
         self._source_iterator = source_iterator               # type: CheckpointableIterator
         self._step_function   = step_function                 # type: Callable[[Any,Any], Tuple[Any,Any]]
-        # take deepcopy of initial state so that user cannot change initial state after iterator is created
-        self._initial_state   = copy.deepcopy(initial_state)  # type: Any
+        # take snapshot of initial state so that user cannot change initial state after iterator is created
+        self._initial_state   = self._snapshot(initial_state) # type: Any
         self.setstate(None)
 
+    @staticmethod
+    def _snapshot(state):
+        # snapshot protocol if implemented by the state (see class docstring), deepcopy otherwise
+        snapshot = getattr(state, 'snapshot', None)
+        return snapshot() if callable(snapshot) else copy.deepcopy(state)
+
+    @staticmethod
+    def _restore(snapshot):
+        restore = getattr(snapshot, 'restore', None)
+        return restore() if callable(restore) else copy.deepcopy(snapshot)
+
     def getstate(self):
-        # return deepcopy of recurrent state so that user cannot change recurrent state within a checkpoint after it was taken
+        # return snapshot of recurrent state so that user cannot change recurrent state within a checkpoint after it was taken
         # by modifying the recurrent_state in place during the step_function
-        return {'recurrent_state': copy.deepcopy(self._recurrent_state),
+        return {'recurrent_state': self._snapshot(self._recurrent_state),
                 'source_state':    self._source_iterator.getstate()}
 
     def setstate(self, checkpoint):
-        # take deepcopy of recurrent_state from checkpoint and initial state so that user cannot modify the checkpoint / the initial state
+        # restore recurrent_state from snapshot in checkpoint or initial state so that user cannot modify the checkpoint / the initial state
         # by modifying the recurrent_state in place during the step_function
-        self._recurrent_state = copy.deepcopy(checkpoint['recurrent_state']) if checkpoint else copy.deepcopy(self._initial_state)
+        self._recurrent_state = self._restore(checkpoint['recurrent_state'] if checkpoint else self._initial_state)
         self._source_iterator.setstate(checkpoint['source_state'] if checkpoint else None)
-        def _generate():
-            for item in self._source_iterator:
-                # with all the deepcopies above, in-place modification of recurrent_state within the step_function is now ok
-                self._recurrent_state, output = self._step_function(self._recurrent_state, item)
-                yield output
-        self._iterator = _generate()
 
     def __next__(self):
-        return next(self._iterator)
+        item = next(self._source_iterator)
+        # with all the snapshots above, in-place modification of recurrent_state within the step_function is now ok
+        self._recurrent_state, output = self._step_function(self._recurrent_state, item)
+        return output
+
+    def next_batch(self, n: int) -> List:
+        outputs = []
+        for item in self._source_iterator.next_batch(n):
+            self._recurrent_state, output = self._step_function(self._recurrent_state, item)
+            outputs.append(output)
+        return outputs
 
 
 def SamplingRandomMapIterator(source_iterator: CheckpointableIterator, transform: Callable[[Random,Any],Any], seed: int=0):
@@ -837,23 +2057,33 @@ def SamplingRandomMapIterator(source_iterator: CheckpointableIterator, transform
     return RecurrentIterator(source_iterator, _step_function, initial_state=_random.getstate())
 
 
-def BlockwiseShuffleIterator(source_iterator: CheckpointableIterator, block_size: int, seed: int=0):
+def BlockwiseShuffleIterator(source_iterator: CheckpointableIterator, block_size: int, seed: int=0, warmup_size: Optional[int]=None):
     """
     Shuffles a sequence of items by grouping consecutive items in blocks of fixed size, shuffling
     each block, and yielding the shuffled items of all blocks as a flat sequence.
 
     E.g. [1, 2, 3, 4, 5, 6, 7, 8] with block_size = 3 may yield [3, 1, 2, 4, 6, 5, 8, 7].
 
+    With a large block size, the first item is only yielded once the first block has been read. For a faster start,
+    pass warmup_size: the first block then has warmup_size items, and each further block twice as many as the previous one,
+    up to block_size. This is deterministic and checkpointable.
+
     Args:
         source_iterator: checkpointable iterator or restartable iterable over input items to shuffle
         block_size: size of the buffer in number of items used for shuffling
         seed: random seed used for shuffling (or None)
+        warmup_size: size of the first block (default: no warm-up, i.e. block_size)
     """
+    if warmup_size is not None and warmup_size < 1:
+        raise ValueError('warmup_size must be at least 1')
     # This is implemented as a pipeline:
     #  - group N consecutive items together
     #  - shuffle them
     #  - flatten the result
-    blocks = FixedBatchIterator(source_iterator, batch_size=block_size)
+    if warmup_size is None:
+        blocks = FixedBatchIterator(source_iterator, batch_size=block_size)
+    else:
+        blocks = _WarmupBatchIterator(source_iterator, batch_size=block_size, initial_batch_size=warmup_size)
     def shuffle_block_fn(random: Random, block: List):
         random.shuffle(block)
         return block
@@ -862,109 +2092,508 @@ def BlockwiseShuffleIterator(source_iterator: CheckpointableIterator, block_size
     return samples
 
 
-def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int, multiprocessing=None):
+def PrefetchIterator(source_iterator: CheckpointableIterator, buffer_size: int, multiprocessing=None, shared_memory_size: Optional[int]=None, backend: Optional[str]=None,
+                     checkpoint_interval: Optional[int]=None):
     """
-    An iterator prefetching data into a buffer on a seperate process.
+    An iterator prefetching data into a buffer on a seperate process or thread.
+
+    There are two backends:
+    'fork' prefetches on a forked child process and is therefore only available on systems that use fork to create new processes.
+    'thread' prefetches on a background thread of the current process and works everywhere.
+    It only gives a speed-up if the preceding iterators release the GIL, e.g. during file I/O, decompression, or NumPy operations.
+    Both backends create identical checkpoints, so a checkpoint can be restored with either of them.
+
+    The prefetcher runs ahead of the consumer, so it cannot provide the source state for the item that is consumed next.
+    Instead, it sends the source state along with every checkpoint_interval-th item.
+    Restoring a checkpoint replays the items consumed since then, i.e. at most checkpoint_interval - 1 items.
+    A smaller checkpoint_interval makes restoring cheaper, at the cost of calling getstate() on the source more often while prefetching.
 
     Args:
         source_iterator: checkpointable iterator to recur over
         buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
         multiprocessing: module to get `Queue` type from. Pass torch.multiprocessing here when items are Torch tensors for optimized data transfer.
+        shared_memory_size: if given, size in bytes of a shared-memory ring buffer through which large array payloads
+                            (e.g. the data of NumPy arrays) are passed to the main process without copying (requires Python 3.8).
+                            Array data in items obtained this way is a view into the ring buffer that is only valid
+                            until the next item is requested; copy it if you need to keep it longer.
+                            Items obtained through next_batch() are copied out of the ring buffer.
+                            Only supported by the 'fork' backend.
+        backend: 'fork' or 'thread'. If None, 'fork' is used if the process start method is fork, and 'thread' otherwise.
+                 For prefetching on a process that is started with spawn or forkserver, see SpawnPrefetchIterator.
+        checkpoint_interval: number of items after which the prefetcher sends a new source state (default: buffer_size)
     """
-    if python_multiprocessing.get_start_method() != 'fork':
-        print('WARNING: \
-               PrefetchIterator is only supported on operating system that use fork to create new processes.\
-               This excludes Windows.\
-               A dummy iterator is inserted instead of a PrefetchIterator.\
-               This also means that checkpoints of this iterator pipeline cannot be ported to a system that uses fork.')
-        return source_iterator
+    if checkpoint_interval is None:
+        checkpoint_interval = buffer_size
+    if checkpoint_interval < 1:
+        raise ValueError('checkpoint_interval must be at least 1')
+    if backend is None:
+        backend = 'fork' if python_multiprocessing.get_start_method() == 'fork' else 'thread'
+    if backend == 'fork':
+        if python_multiprocessing.get_start_method() != 'fork':
+            raise ValueError("PrefetchIterator backend 'fork' requires the process start method to be fork")
+        return _ForkPrefetchIterator(source_iterator, buffer_size, multiprocessing, shared_memory_size, checkpoint_interval)
+    elif backend == 'thread':
+        if shared_memory_size:
+            raise ValueError("shared_memory_size is not supported by the PrefetchIterator backend 'thread'")
+        return _ThreadPrefetchIterator(source_iterator, buffer_size, checkpoint_interval)
+    elif backend in ('spawn', 'forkserver'):
+        raise ValueError("PrefetchIterator backend '{}' cannot transfer an existing pipeline to the prefetch process, use SpawnPrefetchIterator instead".format(backend))
     else:
-        return _ForkPrefetchIterator(source_iterator, buffer_size, multiprocessing)
+        raise ValueError("unknown PrefetchIterator backend '{}'".format(backend))
 
 
-class _ForkPrefetchIterator(CheckpointableIterator):
+def MultiWorkerPrefetchIterator(pipeline_factory: Callable[..., CheckpointableIterator], num_workers: int, buffer_size: int, multiprocessing=None,
+                                backend: Optional[str]=None, checkpoint_interval: Optional[int]=None):
     """
-    Actual internal implementation of the prefetch iterator for systems that support creating processes through fork.
+    Prefetches data with multiple workers, each of which runs its own shard of the data loading pipeline.
+
+    The pipeline is created once per worker by calling pipeline_factory(num_instances=num_workers, instance_rank=worker_rank),
+    which should pass these arguments on to the source iterator (e.g. create_source_iterator() or chunked_dataset_iterator())
+    to split the data among the workers. Each pipeline is wrapped into a PrefetchIterator,
+    and the items of all workers are interleaved in deterministic round-robin order.
+    The checkpoint contains the states of all workers.
+
+    To combine this with data that is already split among multiple instances, e.g. in distributed training,
+    let pipeline_factory pass num_instances * num_workers and instance_rank * num_workers + worker_rank to the source iterator.
 
     Args:
-        source_iterator: checkpointable iterator to recur over
+        pipeline_factory: function(num_instances, instance_rank) -> CheckpointableIterator to create the pipeline for one worker
+        num_workers: number of workers
+        buffer_size: number of items each worker prefetches
+        multiprocessing: see PrefetchIterator
+        backend: 'fork' or 'thread' (see PrefetchIterator), or 'spawn' or 'forkserver' (see SpawnPrefetchIterator).
+                 For the latter two, pipeline_factory is sent to the workers and thus has to be pickleable.
+        checkpoint_interval: see PrefetchIterator
+    """
+    if num_workers < 1:
+        raise ValueError('num_workers must be at least 1')
+    if backend in ('spawn', 'forkserver'):
+        workers = [SpawnPrefetchIterator(functools.partial(pipeline_factory, num_instances=num_workers, instance_rank=worker_rank), buffer_size,
+                                         start_method=backend, multiprocessing=multiprocessing, checkpoint_interval=checkpoint_interval)
+                   for worker_rank in range(num_workers)]
+    else:
+        workers = [PrefetchIterator(pipeline_factory(num_instances=num_workers, instance_rank=worker_rank), buffer_size,
+                                    multiprocessing=multiprocessing, backend=backend, checkpoint_interval=checkpoint_interval)
+                   for worker_rank in range(num_workers)]
+    return RoundRobinIterator(workers)
+
+
+def SpawnPrefetchIterator(pipeline_factory: Callable[[], CheckpointableIterator], buffer_size: int, start_method: str='spawn', multiprocessing=None,
+                          checkpoint_interval: Optional[int]=None):
+    """
+    An iterator prefetching data into a buffer on a separate process that is started with spawn or forkserver.
+
+    Unlike PrefetchIterator, this does not rely on fork to hand the pipeline to the prefetch process.
+    Instead, the prefetch process receives a recipe for the pipeline, pipeline_factory, and creates the pipeline itself
+    before restoring it to the current checkpoint. The main process never creates the pipeline.
+    The prefetch process starts from a fresh interpreter, so its memory footprint does not include the main process's heap,
+    and it is safe to use in processes that have initialized CUDA.
+    Checkpoints are interchangeable with those of PrefetchIterator over the same pipeline.
+
+    Note that starting the prefetch process, which happens on construction and on every call to setstate(),
+    takes considerably longer than with fork. As usual with spawn, the main module has to be importable
+    without side effects, i.e. guard the script's entry point with `if __name__ == '__main__':`.
+
+    Args:
+        pipeline_factory: function() -> CheckpointableIterator that creates the pipeline to prefetch from.
+                          It is sent to the prefetch process and thus has to be pickleable, e.g. a top-level function
+                          or a functools.partial of one.
         buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
-        multiprocessing_module: use this in place of Python's multiprocessing module, to allow for using torch.multiprocessing.Queue
+        start_method: 'spawn' or 'forkserver'
+        multiprocessing: module to get the multiprocessing context from. Pass torch.multiprocessing here when items are Torch tensors.
+        checkpoint_interval: number of items after which the prefetcher sends a new source state (default: buffer_size)
     """
-    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, multiprocessing_module):
-        if not isinstance(source_iterator, CheckpointableIterator):
-            raise ValueError('source_iterator has to be a CheckpointableIterator')
-        self._source_iterator = source_iterator  # type:CheckpointableIterator
+    if start_method not in ('spawn', 'forkserver'):
+        raise ValueError("start_method must be 'spawn' or 'forkserver'")
+    if checkpoint_interval is not None and checkpoint_interval < 1:
+        raise ValueError('checkpoint_interval must be at least 1')
+    return _SpawnPrefetchIterator(pipeline_factory, buffer_size, start_method, multiprocessing, checkpoint_interval)
+
+
+class _PrefetchIteratorBase(CheckpointableIterator):
+    """
+    Checkpointing logic shared by the prefetch iterator implementations.
+
+    The prefetcher sends each item along with a source state, which is only given at the END of each window of
+    length checkpoint_interval and None otherwise. The checkpoint consists of the last source state received and the number
+    of items consumed since then, which are skipped when the prefetcher is restarted from the checkpoint.
+
+    Subclasses implement _start_prefetching(), _stop_prefetching(), and _get_message().
+    """
+    def __init__(self, buffer_size: int, checkpoint_interval: Optional[int]=None):
         self._buffer_size = buffer_size          # type: int
-        self._QueueType = multiprocessing_module.Queue if multiprocessing_module else  \
-                          python_multiprocessing.Queue
-        self._prefetch_process = None            # type: Process
-        self.setstate(None)
+        self._checkpoint_interval = checkpoint_interval if checkpoint_interval is not None else buffer_size  # type: int
 
     def getstate(self) -> Dict:
         return {'source_state': self._source_state,
                 'item_offset' : self._item_offset  }
 
     def setstate(self, checkpoint: Optional[Dict]):
-        self._terminate_and_join_prefetch_process()  # kill current process if any
+        self._stop_prefetching()  # stop current prefetcher if any
 
         self._source_state = checkpoint['source_state'] if checkpoint is not None else None
         self._item_offset  = checkpoint['item_offset' ] if checkpoint is not None else 0
-        self._source_iterator.setstate(self._source_state)
-        self._queue = self._QueueType(maxsize=self._buffer_size)
-        _prefetch_process = python_multiprocessing.Process(target=self._prefetch_process_fn,
-                                                           args=(self._source_iterator,
-                                                                 self._item_offset,  # @TODO: why pass all these parameters? They are forked anyways. Seems a left-over from thread days.
-                                                                 self._buffer_size,
-                                                                 self._queue))
-        _prefetch_process.start()  # this invokes fork()
-        self._prefetch_process = _prefetch_process
-        # make sure that in case of an unexpected shutdown, we still get rid of any active child process
-        import atexit
-        atexit.register(_ForkPrefetchIterator._join_process, self._prefetch_process)
+        self._start_prefetching()
+
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        n = checkpoint['item_offset'] if checkpoint else 0
+        return n, 'restarts the prefetcher' + (', which skips {} items of its source'.format(n) if n else '')
+
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        # the items are held by another process, so only their number is known (and not even that on some platforms, e.g. macOS)
+        if self._queue is None:
+            return 0, 0
+        try:
+            return self._queue.qsize(), None
+        except NotImplementedError:
+            return None, None
+
+    @abstractmethod
+    def _start_prefetching(self):  # start a prefetcher that creates _queue and feeds it, starting from _source_state and _item_offset
+        pass
+
+    @abstractmethod
+    def _stop_prefetching(self):  # stop the current prefetcher if any
+        pass
+
+    @abstractmethod
+    def _get_message(self):  # retrieve the next message from the prefetcher, see _generate_messages()
+        pass
 
     @staticmethod
-    def _prefetch_process_fn(source, item_offset, buffer_size, queue):  # behavior of the prefetching process, only to be called from that process!        
+    def _generate_messages(source: CheckpointableIterator, item_offset: int, checkpoint_interval: int) -> Iterator:
+        """
+        Generator for the messages the prefetcher sends: (item, source_state) tuples, followed by StopIteration() at the end.
+        Only to be called from the prefetcher!
+        """
         _advance_iterator(source, item_offset)  # skip to checkpoint
         while True:
             try:
                 item = next(source)
             except StopIteration:
-                queue.put(StopIteration())
-                # It seems Python Queue has a bug: if we return here, then the StopIteration message is never sent to the receiver.
-                # So we just dead-loop, assuming that the process will be killed anyways when the consuming side destructs the prefetcher.
-                import time
-                while True:
-                    time.sleep(1000)
-                return  # we never actually get here
-            if item_offset == buffer_size - 1:    # for efficiency, we send a new source state only at the END of each window of length _buffer_size
+                yield StopIteration()
+                return
+            # for efficiency, we send a new source state only at the END of each window of length checkpoint_interval
+            # (note: '>=' since item_offset may stem from a checkpoint that was taken with a larger checkpoint_interval)
+            if item_offset >= checkpoint_interval - 1:
                 source_state = source.getstate()  # this is the state for retrieving the NEXT element, i.e. the first element of the next buffer
                 item_offset = 0
             else:
                 source_state = None
                 item_offset += 1
-            msg = (item, source_state)
-            queue.put(msg)
+            yield (item, source_state)
 
     def __next__(self):
         if self._queue is None:  # iterator has already been exhausted
             raise StopIteration()
-        msg = self._queue.get()
+        msg = self._get_message()
         if isinstance(msg, StopIteration):
             self._queue = None
             raise StopIteration()
-        item, prefetch_source_state = msg  # for efficiency, the prefetch_source_state is only transmitted at the end of each window of length _buffer_size
+        if isinstance(msg, Exception):  # the prefetcher failed, re-raise its exception here
+            raise msg
+        item, prefetch_source_state = msg  # for efficiency, the prefetch_source_state is only transmitted at the end of each window of length _checkpoint_interval
         if prefetch_source_state is not None:
-            assert self._item_offset == self._buffer_size - 1  # we expect a new source state at then END of each window of length _buffer_size
+            assert self._item_offset >= self._checkpoint_interval - 1  # we expect a new source state at then END of each window of length _checkpoint_interval
             self._source_state = prefetch_source_state
             self._item_offset = 0
         else:
             self._item_offset = self._item_offset + 1
-            assert self._item_offset < self._buffer_size
         return item  # for debugging, its useful to return msg instead of item
 
     def __del__(self):  # note: this is often not called. If you really need it, gc.collect() will do the trick.
-        self._terminate_and_join_prefetch_process()
+        self._stop_prefetching()
+
+
+class _ThreadPrefetchIterator(_PrefetchIteratorBase):
+    """
+    Internal implementation of the prefetch iterator that prefetches on a background thread.
+
+    Args:
+        source_iterator: checkpointable iterator to recur over
+        buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
+        checkpoint_interval: number of items after which the prefetcher sends a new source state (default: buffer_size)
+    """
+    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, checkpoint_interval: Optional[int]=None):
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        super().__init__(buffer_size, checkpoint_interval)
+        self._source_iterator = source_iterator  # type: CheckpointableIterator
+        self._prefetch_thread = None  # type: Optional[threading.Thread]
+        self.setstate(None)
+
+    def _start_prefetching(self):
+        self._source_iterator.setstate(self._source_state)
+        self._queue = python_queue.Queue(maxsize=self._buffer_size)
+        self._stop_event = threading.Event()
+        self._prefetch_thread = threading.Thread(target=self._prefetch_thread_fn,
+                                                 args=(self._source_iterator, self._item_offset, self._checkpoint_interval, self._queue, self._stop_event),
+                                                 daemon=True)  # a daemon thread does not prevent the interpreter from exiting
+        self._prefetch_thread.start()
+
+    def _stop_prefetching(self):
+        # Unlike a process, a thread cannot be terminated. We ask it to stop and wait until it is done with the
+        # item it is currently working on. Only then, the source iterator can safely be reset.
+        if self._prefetch_thread:
+            self._stop_event.set()
+            self._prefetch_thread.join()
+        self._prefetch_thread = None
+
+    @staticmethod
+    def _prefetch_thread_fn(source, item_offset, checkpoint_interval, queue, stop_event):  # behavior of the prefetching thread, only to be called from that thread!
+        def put(msg) -> bool:  # put msg into the queue unless we are asked to stop while waiting for space; returns False in that case
+            while not stop_event.is_set():
+                try:
+                    queue.put(msg, timeout=0.1)
+                    return True
+                except python_queue.Full:
+                    pass
+            return False
+        try:
+            for msg in _PrefetchIteratorBase._generate_messages(source, item_offset, checkpoint_interval):
+                if stop_event.is_set() or not put(msg):
+                    return
+        except Exception as e:  # hand the exception to the consumer, which re-raises it
+            put(e)
+
+    def _get_message(self):
+        return self._queue.get()
+
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        if self._queue is None:
+            return 0, 0
+        with self._queue.mutex:  # the prefetch thread may be adding to the queue
+            messages = list(self._queue.queue)
+        items = [msg[0] for msg in messages if isinstance(msg, tuple)]
+        return len(items), estimate_size(items)
+
+
+def _picklable_exception(e: Exception) -> Exception:
+    # an exception of a prefetch process, to be sent to the consumer; replaced if it cannot be pickled, since the queue would fail to send it
+    try:
+        pickle.dumps(e)
+    except Exception:
+        return RuntimeError('prefetch process failed with an exception that cannot be pickled: {!r}'.format(e))
+    return e
+
+
+def _spawn_prefetch_process_fn(pipeline_factory, source_state, item_offset, checkpoint_interval, queue):  # behavior of a spawned prefetching process, only to be called from that process!
+    # this is a top-level function, so that it can be pickled for the new process
+    try:
+        source = pipeline_factory()
+        source.setstate(source_state)
+        for msg in _PrefetchIteratorBase._generate_messages(source, item_offset, checkpoint_interval):
+            queue.put(msg)
+    except Exception as e:  # hand the exception to the consumer, which re-raises it
+        queue.put(_picklable_exception(e))
+    # make sure all messages have been sent before the process ends
+    queue.close()
+    queue.join_thread()
+
+
+class _SpawnPrefetchIterator(_PrefetchIteratorBase):
+    """
+    Internal implementation of the prefetch iterator that creates the pipeline in a process started with spawn or forkserver.
+
+    Args:
+        pipeline_factory: pickleable function() -> CheckpointableIterator that creates the pipeline
+        buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
+        start_method: 'spawn' or 'forkserver'
+        multiprocessing_module: use this in place of Python's multiprocessing module, to allow for using torch.multiprocessing
+        checkpoint_interval: number of items after which the prefetcher sends a new source state (default: buffer_size)
+    """
+    def __init__(self, pipeline_factory: Callable[[], CheckpointableIterator], buffer_size: int, start_method: str, multiprocessing_module=None,
+                 checkpoint_interval: Optional[int]=None):
+        super().__init__(buffer_size, checkpoint_interval)
+        self._pipeline_factory = pipeline_factory
+        self._context = (multiprocessing_module or python_multiprocessing).get_context(start_method)
+        self._prefetch_process = None  # type: Process
+        self.setstate(None)
+
+    def _start_prefetching(self):
+        # the source state and item offset are actually needed here, since the new process does not inherit our memory
+        self._queue = self._context.Queue(maxsize=self._buffer_size)
+        self._prefetch_process = self._context.Process(target=_spawn_prefetch_process_fn,
+                                                       args=(self._pipeline_factory,
+                                                             self._source_state,
+                                                             self._item_offset,
+                                                             self._checkpoint_interval,
+                                                             self._queue))
+        self._prefetch_process.start()
+        _prefetch_processes.add(self._prefetch_process)
+
+    def _stop_prefetching(self):
+        if self._prefetch_process:
+            _ForkPrefetchIterator._join_process(self._prefetch_process)
+        self._prefetch_process = None
+
+    def _get_message(self):
+        return self._queue.get()
+
+
+class _SharedMemoryRingBuffer:
+    """
+    Ring buffer in shared memory that passes array payloads from the prefetch process to the main process without copying.
+
+    The prefetch process pickles each item with protocol 5 and writes its out-of-band buffers (e.g. the data of NumPy arrays)
+    into the ring buffer; only the small remainder of the pickle goes through the queue.
+    The main process unpickles the item on top of views into the ring buffer.
+    The space used by an item is released when the next item is requested.
+
+    Args:
+        size: size of the ring buffer in bytes
+    """
+    def __init__(self, size: int):
+        shared_memory = _import_shared_memory()
+        if size <= 0:
+            raise ValueError('shared_memory_size must be positive')
+        self._size = _aligned(size)
+        self._shared_memory = shared_memory.SharedMemory(create=True, size=self._size)
+        self._finalizer = weakref.finalize(self, _SharedMemoryRingBuffer._close, self._shared_memory, os.getpid())  # also called when garbage-collected or at exit
+        self.reset()
+
+    def reset(self):  # called in the main process before a new prefetch process is started
+        # positions are logical, i.e. they grow monotonically; the physical offset is position % size
+        self._write_position = 0                                                    # producer: position of next write
+        self._released_position = python_multiprocessing.Value('q', 0, lock=False)  # consumer: everything before this may be overwritten
+        self._condition = python_multiprocessing.Condition()
+        self._pending_release = None                                                # consumer: end position of the item handed out last
+
+    def dump(self, item: Any) -> Any:  # only to be called from the prefetch process
+        """
+        Pickle item, place its out-of-band buffers into the ring buffer, and return the message to send instead of the item.
+        """
+        pickled_item, buffers = _dump_out_of_band(item)
+        if not buffers:
+            return _SharedMemoryItem(pickled_item, [], None)
+        total_size = sum(_aligned(buffer.nbytes) for buffer in buffers)
+        if total_size > self._size:  # will never fit, pickle the buffers in-band instead
+            return _SharedMemoryItem(pickle.dumps(item, protocol=5), [], None)
+        position = self._write_position
+        offset = position % self._size
+        if offset + total_size > self._size:  # does not fit before the end of the ring buffer: skip the remainder and wrap around
+            position += self._size - offset
+            offset = 0
+        end = position + total_size
+        with self._condition:  # wait until the consumer has released enough space
+            while end - self._released_position.value > self._size:
+                self._condition.wait()
+        spans = _write_buffers(buffers, self._shared_memory.buf, offset)
+        self._write_position = end
+        return _SharedMemoryItem(pickled_item, spans, end)
+
+    def load(self, message: _SharedMemoryItem, copy: bool=False) -> Any:  # only to be called from the main process
+        """
+        Reconstruct an item from a message produced by dump(), with its buffers being views into the ring buffer (or copies if copy is True).
+        """
+        item = _load_out_of_band(message, self._shared_memory.buf, copy)
+        if message.end is not None:
+            self._pending_release = message.end
+        return item
+
+    def release(self):  # only to be called from the main process
+        """
+        Release the space of the item handed out last. This must happen before waiting for the next item.
+        """
+        if self._pending_release is not None:
+            with self._condition:
+                self._released_position.value = self._pending_release
+                self._condition.notify()
+            self._pending_release = None
+
+    def close(self):
+        self._finalizer()
+        self._shared_memory = None
+
+    @staticmethod
+    def _close(block: Any, owner_pid: int):  # must not refer to the ring buffer, so that it can be garbage-collected
+        if owner_pid == os.getpid():
+            _close_shared_memory(block)
+
+
+class _ForkPrefetchIterator(_PrefetchIteratorBase):
+    """
+    Actual internal implementation of the prefetch iterator for systems that support creating processes through fork.
+
+    Args:
+        source_iterator: checkpointable iterator to recur over
+        buffer_size: number of items to prefetch; this is the maximum number of items held in the prefetch queue
+        multiprocessing_module: use this in place of Python's multiprocessing module, to allow for using torch.multiprocessing.Queue
+        shared_memory_size: if given, size in bytes of the shared-memory ring buffer used to pass array payloads
+        checkpoint_interval: number of items after which the prefetcher sends a new source state (default: buffer_size)
+    """
+    def __init__(self, source_iterator: CheckpointableIterator, buffer_size: int, multiprocessing_module, shared_memory_size: Optional[int]=None,
+                 checkpoint_interval: Optional[int]=None):
+        if not isinstance(source_iterator, CheckpointableIterator):
+            raise ValueError('source_iterator has to be a CheckpointableIterator')
+        super().__init__(buffer_size, checkpoint_interval)
+        self._source_iterator = source_iterator  # type:CheckpointableIterator
+        self._QueueType = multiprocessing_module.Queue if multiprocessing_module else  \
+                          python_multiprocessing.Queue
+        self._prefetch_process = None            # type: Process
+        self._ring_buffer = _SharedMemoryRingBuffer(shared_memory_size) if shared_memory_size else None  # type: Optional[_SharedMemoryRingBuffer]
+        self._copy_items = False                 # type: bool  -- copy array data out of the ring buffer, while next_batch() collects items
+        self.setstate(None)
+
+    def _start_prefetching(self):
+        self._source_iterator.setstate(self._source_state)
+        self._queue = self._QueueType(maxsize=self._buffer_size)
+        if self._ring_buffer is not None:
+            self._ring_buffer.reset()
+        _prefetch_process = python_multiprocessing.Process(target=self._prefetch_process_fn,
+                                                           args=(self._source_iterator,
+                                                                 self._item_offset,  # @TODO: why pass all these parameters? They are forked anyways. Seems a left-over from thread days.
+                                                                 self._checkpoint_interval,
+                                                                 self._queue,
+                                                                 self._ring_buffer))
+        _prefetch_process.start()  # this invokes fork()
+        self._prefetch_process = _prefetch_process
+        _prefetch_processes.add(self._prefetch_process)
+
+    def _stop_prefetching(self):
+        self._terminate_and_join_prefetch_process()  # kill current process if any
+
+    @staticmethod
+    def _prefetch_process_fn(source, item_offset, checkpoint_interval, queue, ring_buffer):  # behavior of the prefetching process, only to be called from that process!
+        try:
+            for msg in _PrefetchIteratorBase._generate_messages(source, item_offset, checkpoint_interval):
+                if isinstance(msg, StopIteration):
+                    break
+                if ring_buffer is not None:
+                    item, source_state = msg
+                    msg = (ring_buffer.dump(item), source_state)
+                queue.put(msg)
+        except Exception as e:  # hand the exception to the consumer, which re-raises it
+            msg = _picklable_exception(e)
+        queue.put(msg)  # StopIteration or the exception
+        # It seems Python Queue has a bug: if we return here, then the last message is never sent to the receiver.
+        # So we just dead-loop, assuming that the process will be killed anyways when the consuming side destructs the prefetcher.
+        while True:
+            time.sleep(1000)
+
+    def _get_message(self):
+        if self._ring_buffer is not None:  # the previous item is no longer needed; its space must be freed before we wait for the prefetch process
+            self._ring_buffer.release()
+        msg = self._queue.get()
+        if self._ring_buffer is not None and isinstance(msg, tuple) and isinstance(msg[0], _SharedMemoryItem):
+            item, source_state = msg
+            msg = (self._ring_buffer.load(item, copy=self._copy_items), source_state)
+        return msg
+
+    def next_batch(self, n: int) -> List:
+        if self._ring_buffer is None:
+            return super().next_batch(n)
+        # views into the ring buffer are only valid until the next item is requested, hence the items of a batch must be copied
+        self._copy_items = True
+        try:
+            return super().next_batch(n)
+        finally:
+            self._copy_items = False
+
+    def __del__(self):  # note: this is often not called. If you really need it, gc.collect() will do the trick.
+        super().__del__()
+        if self._ring_buffer is not None:
+            self._ring_buffer.close()
 
     def _terminate_and_join_prefetch_process(self):  # terminate the pre-fetch process if one is running
         if self._prefetch_process:
@@ -1001,6 +2630,16 @@ class _ForkPrefetchIterator(CheckpointableIterator):
         p.join()
 
 
+_prefetch_processes = weakref.WeakSet()  # type: weakref.WeakSet  -- prefetch processes started by this process, see _join_prefetch_processes()
+
+def _join_prefetch_processes():
+    # make sure that in case of an unexpected shutdown, we still get rid of any active child process
+    for p in list(_prefetch_processes):
+        _ForkPrefetchIterator._join_process(p)
+
+atexit.register(_join_prefetch_processes)  # registered after multiprocessing's own exit handler, hence runs before it
+
+
 class BucketedReadaheadBatchIterator(CheckpointableIterator):
     """
     Iterates over items from a checkpointable iterator and groups items of similar length into batches.
@@ -1011,9 +2650,14 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
     is dynamic, and determined by a user-provided callback.
 
     This is based on Marian NMT's BatchGenerator.
+
+    With a large read-ahead, the first batch is only yielded once the read-ahead window has been read. For a faster start,
+    pass warmup_size: the first window then has warmup_size items, and each further window twice as many as the previous one,
+    up to read_ahead. This is deterministic and checkpointable.
     """
 
-    def __init__(self, source_iterator: CheckpointableIterator, read_ahead: int, key: Callable[[Any], Any], batch_size: Union[int,Callable[[Any], int]], shuffle: bool=True, seed: int=0):
+    def __init__(self, source_iterator: CheckpointableIterator, read_ahead: int, key: Callable[[Any], Any], batch_size: Union[int,Callable[[Any], int]], shuffle: bool=True, seed: int=0,
+                 warmup_size: Optional[int]=None):
         """
         Args:
             source_iterator: The data set that is read from. Typically this is an infinite source.
@@ -1022,13 +2666,17 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
             batch_size: Batch size in number of items. Either an integer or a callback to determine batch size for a given first batch item.
             shuffle: Pass False to not randomize the batches. (default: True)
             seed: Random seed for batch shuffling.
+            warmup_size: Number of items in the first read-ahead window. (default: no warm-up, i.e. read_ahead)
         """
         if not isinstance(source_iterator, CheckpointableIterator):
             raise ValueError('source_iterator has to be a CheckpointableIterator')
+        if warmup_size is not None and warmup_size < 1:
+            raise ValueError('warmup_size must be at least 1')
         # keep arguments
-        self._key = key                # type: Callable[[Any], Any]
-        self._batch_size = batch_size  # type: Union[int,Callable[[Any], int]]
-        self._read_ahead = read_ahead  # type: int
+        self._key = key                  # type: Callable[[Any], Any]
+        self._batch_size = batch_size    # type: Union[int,Callable[[Any], int]]
+        self._read_ahead = read_ahead    # type: int
+        self._warmup_size = warmup_size  # type: Optional[int]
         # initialize state
         self._seed = seed
         self._random = None
@@ -1038,14 +2686,21 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
         self.setstate(None)
 
     def getstate(self):
-        return {'source_state': self._source_state,
-                'random_state': self._random_state,
-                'num_served':   self._num_batches_yielded}
+        checkpoint = {'source_state': self._source_state,
+                      'random_state': self._random_state,
+                      'num_served':   self._num_batches_yielded}
+        if self._warmup_size is not None:
+            checkpoint['read_ahead'] = self._window_size
+        return checkpoint
 
     def setstate(self, checkpoint: Optional[Dict]):
         self._source_state        = checkpoint['source_state'] if checkpoint else None  # type: Dict  -- state of input before reading the current set of batches
         self._random_state        = checkpoint['random_state'] if checkpoint else None  # type: Any   -- state of random generator at _source_state
         self._num_batches_yielded = checkpoint['num_served']   if checkpoint else 0     # type: int   -- number of batches served from the current set of batches
+        if checkpoint:  # size of the current read-ahead window, which only differs from read_ahead during warm-up
+            self._window_size = checkpoint.get('read_ahead', self._read_ahead)  # type: int
+        else:
+            self._window_size = min(self._warmup_size, self._read_ahead) if self._warmup_size is not None else self._read_ahead
         # checkpointing: restore to start of current set of batches
         self._source_iterator.setstate(self._source_state)
         if self._random_state:
@@ -1053,6 +2708,7 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
         elif self._random:
             self._random.seed(self._seed)
         self._source_exhausted = False  # type: bool  -- set to True once we hit StopIteration on source
+        self._batches = []              # type: List[List[Any]]  -- current set of batches
         def _generate():
             skip_to_checkpoint = self._num_batches_yielded
             source_exhausted = False
@@ -1060,13 +2716,14 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
                 # prefetch the readahead buffer
                 self._source_state = self._source_iterator.getstate()
                 self._random_state = self._random.getstate() if self._random else None
-                items = list(islice(self._source_iterator, self._read_ahead))
-                source_exhausted = (len(items) < self._read_ahead)
+                items = list(islice(self._source_iterator, self._window_size))
+                source_exhausted = (len(items) < self._window_size)
                 # create batches
                 batches = self._create_batches(items)
                 # shuffle the batches
                 if self._random:
                     self._random.shuffle(batches)
+                self._batches = batches  # note: the batches already served are also kept alive, by the iterator below
                 # on first loop iteration, restore iterator inside batches from checkpoint
                 batches = iter(batches)
                 self._num_batches_yielded = _advance_iterator(batches, skip_to_checkpoint)
@@ -1075,8 +2732,21 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
                 for batch in batches:
                     self._num_batches_yielded += 1
                     yield batch
+                self._window_size = min(2 * self._window_size, self._read_ahead)  # warm-up: double the window up to read_ahead
         self._iterator = _generate()  # type: Iterator  -- iterator into current set of batches
 
+    def _resume_cost(self, checkpoint: Optional[Dict]) -> Tuple[int, str]:
+        num_served = checkpoint['num_served'] if checkpoint else 0
+        if not num_served:
+            return 0, ''
+        # the whole read-ahead window is re-read and batched, of which the served batches are wasted
+        window_size = checkpoint.get('read_ahead', self._read_ahead)
+        return window_size, 're-reads the read-ahead window of up to {} items and skips {} batches'.format(window_size, num_served)
+
+    def _buffer_usage(self, estimate_size: Callable[[List], int]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        items = [item for batch in self._batches for item in batch]
+        return len(items), sys.getsizeof(self._batches) + sum(sys.getsizeof(batch) for batch in self._batches) + estimate_size(items)
+
     def _create_batches(self, items: List[Any]) -> List[List[Any]]:  # helper to form batches from a list of items
             # sort by length, longest first
             if self._key:
@@ -1099,3 +2769,209 @@ class BucketedReadaheadBatchIterator(CheckpointableIterator):
 
     def __next__(self):
         return next(self._iterator)
+
+
+def _source_stages(iterator: CheckpointableIterator, checkpoint: Optional[Dict]) -> List[Tuple[Optional[str], Any, CheckpointableIterator, Optional[Dict]]]:
+    """
+    Helper to find the iterators that iterator reads from, along with their parts of checkpoint, as (key, index, iterator, checkpoint) tuples:
+    the checkpoint of the source is checkpoint[key] or checkpoint[key][index]; key is None if iterator passes the checkpoint of its source through.
+    Iterators that live in other processes, e.g. the pipelines of SpawnPrefetchIterator, are not found.
+    """
+    if isinstance(iterator, (MapIterator, _PipelinedBatchMapIterator)):  # these pass the checkpoint of their source through
+        return [(None, None, iterator._source_iterator, checkpoint)]
+    def part(key, index=None):
+        if checkpoint is None:
+            return None
+        state = checkpoint[key]
+        return state if index is None else state.get(index) if isinstance(state, dict) else state[index]
+    stages = []  # type: List[Tuple[Optional[str], Any, CheckpointableIterator, Optional[Dict]]]
+    if isinstance(getattr(iterator, '_control_iterator', None), CheckpointableIterator):
+        stages.append(('control_iterator_state', None, iterator._control_iterator, part('control_iterator_state')))
+    source_iterators = getattr(iterator, '_source_iterators', None)
+    if isinstance(source_iterators, list):
+        key = 'input_states' if isinstance(iterator, ZipIterator) else 'source_iterator_states'
+        stages.extend((key, index, source_iterator, part(key, index)) for index, source_iterator in enumerate(source_iterators))
+    if isinstance(iterator, LazyMultiplexIterator):  # only the input iterators that are currently open
+        stages.extend(('source_iterator_states', index, source_iterator, part('source_iterator_states', index))
+                      for index, source_iterator in iterator._open_sources.items())
+    if isinstance(getattr(iterator, '_source_iterator', None), CheckpointableIterator):
+        stages.append(('source_state', None, iterator._source_iterator, part('source_state')))
+    return stages
+
+
+def _walk_stages(iterator: CheckpointableIterator, checkpoint: Optional[Dict]=None, path: str='checkpoint',
+                 this_process_only: bool=False) -> Iterator[Tuple[str, CheckpointableIterator, Optional[Dict]]]:
+    """
+    Helper to iterate over the stages of a pipeline, starting with the last one, as (path, iterator, checkpoint) tuples,
+    where path is the position of the stage's state in the checkpoint (as in checkpoints.checkpoint_size_breakdown()).
+    If this_process_only is True, the walk does not continue upstream of a _ForkPrefetchIterator: these stages run in
+    the prefetch process, and the copies found here are idle.
+    """
+    yield path, iterator, checkpoint
+    if this_process_only and isinstance(iterator, _ForkPrefetchIterator):
+        return
+    for key, index, source_iterator, source_checkpoint in _source_stages(iterator, checkpoint):
+        key_path = '' if key is None else '.' + key if index is None else '.{}[{}]'.format(key, index)
+        yield from _walk_stages(source_iterator, source_checkpoint, path + key_path, this_process_only)
+
+
+def estimate_resume_cost(iterator: CheckpointableIterator, checkpoint: Optional[Dict]) -> List[Dict[str, Any]]:
+    """
+    Estimate the work needed to restore a pipeline to a checkpoint, stage by stage, without restoring it.
+
+    Restoring a checkpoint generally requires some stages to re-read items that were already consumed before
+    the checkpoint was taken, e.g. the items of a chunk in SelectManyIterator up to the checkpoint, or the whole
+    read-ahead window in BucketedReadaheadBatchIterator. How expensive re-reading is depends on the stages before:
+    re-read items are skipped via skip(), which e.g. does not apply transforms in MapIterator,
+    but a prefetcher or a chunk reader still has to produce them.
+
+    Args:
+        iterator: last iterator of the pipeline
+        checkpoint: checkpoint as returned by getstate() on the last iterator of the pipeline
+
+    Returns:
+        One dict per stage, starting with the last one, with the following entries:
+        'path': position of the stage's state in the checkpoint (as in checkpoints.checkpoint_size_breakdown()),
+        'iterator': class name of the stage,
+        'replayed_items': number of items the stage re-reads from its source or input beyond those it yields afterwards,
+        'description': description of the work, or '' if there is none.
+    """
+    report = []  # type: List[Dict[str, Any]]
+    for path, stage, stage_checkpoint in _walk_stages(iterator, checkpoint):
+        replayed_items, description = stage._resume_cost(stage_checkpoint)
+        report.append({'path': path, 'iterator': type(stage).__name__, 'replayed_items': replayed_items, 'description': description})
+    return report
+
+
+def _permutation_source_stage(iterator: CheckpointableIterator, checkpoint: Optional[Dict]) -> Tuple[InfinitePermutationSourceIterator, Optional[Dict]]:
+    """
+    Helper to find the only InfinitePermutationSourceIterator of a pipeline, along with its part of checkpoint.
+    """
+    found = []  # type: List[Tuple[InfinitePermutationSourceIterator, Optional[Dict]]]
+    def visit(iterator, checkpoint):
+        if isinstance(iterator, InfinitePermutationSourceIterator):
+            found.append((iterator, checkpoint))
+        for _, _, source_iterator, source_checkpoint in _source_stages(iterator, checkpoint):
+            visit(source_iterator, source_checkpoint)
+    visit(iterator, checkpoint)
+    if len(found) != 1:
+        raise ValueError('pipeline must contain exactly one InfinitePermutationSourceIterator, but contains {}'.format(len(found)))
+    return found[0]
+
+
+def _replace_stage_state(iterator: CheckpointableIterator, checkpoint: Optional[Dict], stage: CheckpointableIterator, stage_state: Dict) -> Dict:
+    """
+    Helper to create a copy of checkpoint in which the state of the given stage of the pipeline is replaced.
+    Parts of the checkpoint that are None, i.e. initial states, are replaced by the states of the (freshly created) iterators.
+    """
+    if iterator is stage:
+        return stage_state
+    if checkpoint is None:
+        checkpoint = iterator.getstate()
+    for key, index, source_iterator, source_checkpoint in _source_stages(iterator, checkpoint):
+        source_checkpoint = _replace_stage_state(source_iterator, source_checkpoint, stage, stage_state)
+        if key is None:  # the checkpoint of the source is passed through
+            return source_checkpoint
+        checkpoint = dict(checkpoint)
+        if index is None:
+            checkpoint[key] = source_checkpoint
+        elif isinstance(checkpoint[key], dict):
+            states = dict(checkpoint[key])
+            states[index] = source_checkpoint
+            checkpoint[key] = states
+        else:
+            states = list(checkpoint[key])
+            states[index] = source_checkpoint
+            checkpoint[key] = type(checkpoint[key])(states)
+    return checkpoint
+
+
+def _merge_permutation_states(states: List[Optional[Dict]], num_items: int, seed: int, shuffle: bool) -> Dict:
+    """
+    Helper to merge the states of all instances of an InfinitePermutationSourceIterator into the earliest position
+    at which any of the instances is going to continue, see reshard_checkpoints().
+    """
+    num_instances = len(states)
+    initial_random_state = Random(seed).getstate()
+    def next_pass(random_state):  # random state before the permutation of the next pass
+        if not shuffle:
+            return random_state
+        random = Random()
+        random.setstate(random_state)
+        random.shuffle(list(range(num_items)))  # consumes the same random numbers as shuffling the source items
+        return random.getstate()
+    positions = []  # type: List[Tuple[Any, int]]  -- random state of the pass and index of the next item to serve, for each instance
+    for rank, state in enumerate(states):
+        if rank >= num_items:  # this instance never serves an item
+            continue
+        random_state = state['random_state'] if state and state['random_state'] is not None else initial_random_state
+        num_items_yielded = state['num_items_yielded'] if state else 0
+        index = num_items_yielded + (rank - num_items_yielded) % num_instances  # next index that belongs to this instance
+        if index >= num_items:
+            random_state, index = next_pass(random_state), rank
+        positions.append((random_state, index))
+    # order the passes; instances are expected to be at most one pass apart
+    random_states = []  # type: List[Any]
+    for random_state, _ in positions:
+        if random_state not in random_states:
+            random_states.append(random_state)
+    if len(random_states) == 1:
+        first_random_state = random_states[0]
+        if shuffle:
+            pass_of_index = lambda index: 0
+        else:  # all passes look the same; assume that instances are less than half a pass apart to detect a wrap-around
+            indices = [index for _, index in positions]
+            wrapped = max(indices) - min(indices) > num_items / 2
+            pass_of_index = lambda index: 1 if wrapped and index < num_items / 2 else 0
+        passes = [pass_of_index(index) for _, index in positions]
+    elif len(random_states) == 2 and next_pass(random_states[0]) == random_states[1]:
+        first_random_state = random_states[0]
+        passes = [0 if random_state == random_states[0] else 1 for random_state, _ in positions]
+    elif len(random_states) == 2 and next_pass(random_states[1]) == random_states[0]:
+        first_random_state = random_states[1]
+        passes = [0 if random_state == random_states[1] else 1 for random_state, _ in positions]
+    else:
+        raise ValueError('the instances are more than one pass over the source items apart')
+    _, index = min(zip(passes, (index for _, index in positions)))
+    return {'random_state':      first_random_state,
+            'num_items_yielded': index}
+
+
+def reshard_checkpoints(checkpoints: List[Optional[Dict]], pipeline_factory: Callable[..., CheckpointableIterator], num_instances: int) -> List[Dict]:
+    """
+    Convert the checkpoints of the N instances of a data-parallel pipeline into checkpoints for num_instances instances,
+    e.g. to resume training on a different number of GPUs.
+
+    This is for pipelines that read from an InfinitePermutationSourceIterator, such as chunked_dataset_iterator() with train=True.
+    All instances iterate over the same permutations of the source items (e.g. chunks), of which each instance serves every N-th one.
+    The checkpoints are merged into a global position in these permutations: the earliest position at which any instance
+    would have continued reading source items when restoring its checkpoint. The new instances start reading there,
+    with all other stages of their pipelines in their initial state. Thereby, no source item is skipped, and nothing is replayed
+    besides skipping to the position in the permutation. However, data items may be served twice, or not at all:
+     - Items that an old instance served from source items after the global position are served again.
+       If the instances consume data at the same rate, this is at most about one source item (e.g. chunk) per old instance.
+     - Items held in the checkpoints of stages, i.e. the buffer of BufferedShuffleIterator, are not served.
+       (BlockwiseShuffleIterator, which chunked_dataset_iterator() uses by default, does not hold items in its checkpoint.)
+
+    Args:
+        checkpoints: checkpoints of the old instances, by instance rank, as returned by getstate() on the last iterator of their pipelines
+        pipeline_factory: function that creates the pipeline of an instance, e.g. a functools.partial of chunked_dataset_iterator,
+                          called with keyword arguments num_instances and instance_rank. The pipelines must only differ in these.
+        num_instances: new number of instances
+
+    Returns:
+        Checkpoints for the pipelines of the new instances, by instance rank.
+    """
+    if not checkpoints:
+        raise ValueError('checkpoints must not be empty')
+    if num_instances < 1:
+        raise ValueError('num_instances must be at least 1')
+    old_pipeline = pipeline_factory(num_instances=len(checkpoints), instance_rank=0)
+    source_states = [_permutation_source_stage(old_pipeline, checkpoint)[1] for checkpoint in checkpoints]
+    source = _permutation_source_stage(old_pipeline, None)[0]
+    merged_state = _merge_permutation_states(source_states, len(source._source_items), source._seed, source._shuffle)
+    new_checkpoints = []
+    for instance_rank in range(num_instances):
+        pipeline = pipeline_factory(num_instances=num_instances, instance_rank=instance_rank)
+        new_checkpoints.append(_replace_stage_state(pipeline, None, _permutation_source_stage(pipeline, None)[0], merged_state))
+    return new_checkpoints
@@ -0,0 +1,391 @@
+"""
+Profiling the stages of iterator pipelines.
+
+`PipelineProfiler` instruments every stage of a pipeline and records, per stage, how many items it produced
+and how long its `__next__()` took, exclusive of the time spent in the stages it reads from.
+This tells which stage is the bottleneck of a slow pipeline:
+
+>>> from infinibatch.iterators import NativeCheckpointableIterator, MapIterator, FixedBatchIterator
+>>> it = FixedBatchIterator(MapIterator(NativeCheckpointableIterator(list(range(100))), lambda n: n * 2), batch_size=10)
+>>> with PipelineProfiler(it) as profiler:
+...     batches = list(it)
+>>> [(stage['iterator'], stage['items']) for stage in profiler.stats()['stages']]
+[('FixedBatchIterator', 10), ('MapIterator', 100), ('NativeCheckpointableIterator', 100)]
+
+For production use, `sample_every` limits the timing to every n-th call of each stage, while items are still counted exactly.
+`stats()` returns plain dicts and lists, which can be handed to a metrics exporter as they are.
+
+`memory_usage()` reports how many items the buffering stages of a pipeline currently hold, and an estimate of their size,
+and `MemoryMonitor` keeps track of the high-water mark of the whole pipeline:
+
+>>> import itertools
+>>> from infinibatch.iterators import BufferedShuffleIterator
+>>> it = BufferedShuffleIterator(NativeCheckpointableIterator(list(range(100))), buffer_size=10)
+>>> monitor = MemoryMonitor(it)
+>>> _ = list(itertools.islice(it, 50))
+>>> [(stage['iterator'], stage['items']) for stage in monitor.sample()['stages']]
+[('BufferedShuffleIterator', 10)]
+>>> _ = list(it)
+>>> usage = monitor.sample()
+>>> usage['items'], usage['peak_items']
+(0, 10)
+"""
+
+import collections
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from infinibatch.iterators import CheckpointableIterator, _PrefetchIteratorBase, _walk_stages
+
+
+_local = threading.local()  # per thread: stack of the time spent in nested calls of the currently timed calls
+
+
+def _timing_stack() -> List[float]:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class _StageProfile:
+    """
+    Counters of one stage of a profiled pipeline.
+    """
+    def __init__(self, path: str, iterator: CheckpointableIterator, sample_every: int, max_samples: int):
+        self.path = path                                   # type: str
+        self.iterator_name = type(iterator).__name__       # type: str
+        self.is_prefetcher = isinstance(iterator, _PrefetchIteratorBase)  # type: bool
+        self.sample_every = sample_every                   # type: int
+        self.max_samples = max_samples                     # type: int
+        self.in_next_batch = False                         # type: bool
+        self.reset()
+
+    def reset(self):
+        self.calls = 0                                     # type: int
+        self.items = 0                                     # type: int
+        self.timed_calls = 0                               # type: int
+        self.timed_seconds = 0.0                           # type: float
+        self.latencies = collections.deque(maxlen=self.max_samples)  # type: collections.deque
+        self.checkpoint_calls = {'getstate': 0, 'setstate': 0}       # type: Dict[str, int]
+        self.checkpoint_seconds = {'getstate': 0.0, 'setstate': 0.0}  # type: Dict[str, float]
+        self.messages = 0                                  # type: int
+        self.stall_seconds = 0.0                           # type: float
+        self.queue_depths = collections.deque(maxlen=self.max_samples)  # type: collections.deque
+
+    @staticmethod
+    def _timed(function: Callable, args: tuple, record: Callable[[float], None]) -> Any:
+        """
+        Call function(*args) and record its time exclusive of the timed calls nested in it.
+        """
+        stack = _timing_stack()
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            record(elapsed - stack.pop())
+            if stack:  # the enclosing call excludes this one
+                stack[-1] += elapsed
+
+    def _record_call(self, seconds: float):
+        self.timed_calls += 1
+        self.timed_seconds += seconds
+        self.latencies.append(seconds)
+
+    def timed_call(self, function: Callable, *args) -> Any:
+        """
+        Call __next__() or next_batch() of the stage and record its time.
+        """
+        return self._timed(function, args, self._record_call)
+
+    def checkpoint_call(self, kind: str, function: Callable, *args) -> Any:
+        def record(seconds):
+            self.checkpoint_calls[kind] += 1
+            self.checkpoint_seconds[kind] += seconds
+        return self._timed(function, args, record)
+
+    def get_message(self, iterator: _PrefetchIteratorBase, function: Callable) -> Any:
+        self.messages += 1
+        if self.messages % self.sample_every == 0:
+            try:
+                self.queue_depths.append(iterator._queue.qsize())
+            except NotImplementedError:  # multiprocessing queues on some platforms, e.g. macOS
+                pass
+        start = time.perf_counter()
+        try:
+            return function(iterator)
+        finally:
+            self.stall_seconds += time.perf_counter() - start
+
+    def stats(self, elapsed_seconds: float) -> Dict[str, Any]:
+        # with sampling, the total time is extrapolated from the timed calls
+        seconds = self.timed_seconds * self.calls / self.timed_calls if self.timed_calls else 0.0
+        latencies = sorted(self.latencies)
+        stats = {
+            'path':             self.path,
+            'iterator':         self.iterator_name,
+            'calls':            self.calls,
+            'items':            self.items,
+            'items_per_second': self.items / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            'seconds':          seconds,
+            'busy_fraction':    seconds / elapsed_seconds if elapsed_seconds > 0 else 0.0,
+            'latency':          {'mean': sum(latencies) / len(latencies),
+                                 'p50':  _percentile(latencies, 0.5),
+                                 'p90':  _percentile(latencies, 0.9),
+                                 'p99':  _percentile(latencies, 0.99),
+                                 'max':  latencies[-1]} if latencies else None,
+            'getstate_calls':   self.checkpoint_calls['getstate'],
+            'getstate_seconds': self.checkpoint_seconds['getstate'],
+            'setstate_calls':   self.checkpoint_calls['setstate'],
+            'setstate_seconds': self.checkpoint_seconds['setstate'],
+        }  # type: Dict[str, Any]
+        if self.is_prefetcher:
+            stats['stall_seconds'] = self.stall_seconds
+            stats['queue_depth'] = {'mean': sum(self.queue_depths) / len(self.queue_depths),
+                                    'max':  max(self.queue_depths)} if self.queue_depths else None
+        return stats
+
+
+def _instrumented_class(cls: type, profile: _StageProfile) -> type:
+    """
+    Create a subclass of cls that records into profile. It adds no slots, so that it can be assigned to __class__ of an instance of cls.
+    """
+    # Only every sample_every-th call is timed, unless the call is nested in a timed call, which must exclude its time.
+    # This is checked inline, since it is the overhead of the calls that are not timed.
+    sample_every = profile.sample_every
+    cls_next = cls.__next__
+    def __next__(self):
+        if profile.in_next_batch:  # called by next_batch() of the same stage, which is profiled as a whole
+            return cls_next(self)
+        profile.calls += 1
+        if profile.calls % sample_every and not getattr(_local, 'stack', None):
+            item = cls_next(self)
+        else:
+            item = profile.timed_call(cls_next, self)
+        profile.items += 1
+        return item
+
+    def getstate(self):
+        return profile.checkpoint_call('getstate', cls.getstate, self)
+
+    def setstate(self, checkpoint):
+        return profile.checkpoint_call('setstate', cls.setstate, self, checkpoint)
+
+    namespace = {'__slots__': (), '__module__': cls.__module__, '__doc__': cls.__doc__,
+                 '__next__': __next__, 'getstate': getstate, 'setstate': setstate}  # type: Dict[str, Any]
+    if cls.next_batch is not CheckpointableIterator.next_batch:  # the default implementation calls __next__()
+        def next_batch(self, n):
+            profile.calls += 1
+            profile.in_next_batch = True
+            try:
+                if profile.calls % sample_every and not getattr(_local, 'stack', None):
+                    items = cls.next_batch(self, n)
+                else:
+                    items = profile.timed_call(cls.next_batch, self, n)
+            finally:
+                profile.in_next_batch = False
+            profile.items += len(items)
+            return items
+        namespace['next_batch'] = next_batch
+    if profile.is_prefetcher:
+        namespace['_get_message'] = lambda self: profile.get_message(self, cls._get_message)
+    return type(cls.__name__, (cls,), namespace)
+
+
+class PipelineProfiler:
+    """
+    Records throughput and latency statistics for each stage of a pipeline.
+
+    The stages are found by following the links from the last iterator to the iterators it reads from, and are instrumented
+    in place, i.e. the class of each stage is replaced by a subclass that records the calls. (Wrapping the stages in other
+    objects would miss the calls made through references to them that the stages hold, e.g. in running generators.)
+    close() restores the original classes. An instrumented pipeline must not be pickled.
+
+    Timing is exclusive: the time a stage spends in the stages it reads from is subtracted, also across next_batch().
+    Stages that run in another process, e.g. the sources of multiprocessing prefetch iterators, do not report any calls,
+    and the time of a prefetch iterator's __next__() is mostly the time it waits for its queue ('stall_seconds').
+    Stages created after the profiler, e.g. inputs opened later by LazyMultiplexIterator, are not profiled.
+
+    Args:
+        iterator: last iterator of the pipeline
+        sample_every: only time every sample_every-th call of each stage, to reduce the overhead (default: time every call).
+                      Calls nested in timed calls are timed as well, since their time is excluded from the enclosing call.
+                      Calls that are not timed cost about as much as an extra MapIterator stage.
+        max_samples: number of most recent latencies per stage from which the percentiles are computed
+    """
+    def __init__(self, iterator: CheckpointableIterator, sample_every: int=1, max_samples: int=10000):
+        if sample_every < 1:
+            raise ValueError('sample_every must be at least 1')
+        if max_samples < 1:
+            raise ValueError('max_samples must be at least 1')
+        self._sample_every = sample_every  # type: int
+        self._profiles = []                # type: List[_StageProfile]
+        self._instrumented = []            # type: List[tuple]  -- (stage, original class)
+        for path, stage, _ in _walk_stages(iterator):
+            if any(stage is instrumented for instrumented, _ in self._instrumented):  # e.g. an iterator read by two stages
+                continue
+            profile = _StageProfile(path, stage, sample_every, max_samples)
+            self._instrumented.append((stage, type(stage)))
+            stage.__class__ = _instrumented_class(type(stage), profile)
+            self._profiles.append(profile)
+        self._start_time = time.perf_counter()  # type: float
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the statistics recorded since the profiler was created or last reset.
+
+        Returns:
+            A dict with the entries 'elapsed_seconds', 'sample_every', and 'stages', which is a list with one dict per stage,
+            starting with the last one, with the following entries:
+            'path': position of the stage's state in the checkpoint (as in checkpoints.checkpoint_size_breakdown()),
+            'iterator': class name of the stage,
+            'calls': number of calls of __next__() and next_batch(),
+            'items': number of items produced,
+            'items_per_second': items produced per second of elapsed time,
+            'seconds': time spent in __next__() and next_batch() exclusive of other stages (extrapolated when sampling),
+            'busy_fraction': seconds divided by the elapsed time; the stage with the largest one is the bottleneck,
+            'latency': mean, 50th, 90th and 99th percentile, and maximum of the exclusive time per call in seconds,
+                       or None if no call was timed,
+            'getstate_calls', 'getstate_seconds', 'setstate_calls', 'setstate_seconds': count and exclusive time of checkpointing,
+            and for prefetch iterators:
+            'stall_seconds': time spent waiting for the prefetcher,
+            'queue_depth': mean and maximum number of items in the prefetch queue (sampled), or None if unknown.
+        """
+        elapsed_seconds = time.perf_counter() - self._start_time
+        return {'elapsed_seconds': elapsed_seconds,
+                'sample_every':    self._sample_every,
+                'stages':          [profile.stats(elapsed_seconds) for profile in self._profiles]}
+
+    def reset(self):
+        """
+        Clear the statistics, e.g. after each reporting interval.
+        """
+        for profile in self._profiles:
+            profile.reset()
+        self._start_time = time.perf_counter()
+
+    def close(self):
+        """
+        Remove the instrumentation from the pipeline. The statistics remain available.
+        """
+        for stage, cls in self._instrumented:
+            stage.__class__ = cls
+        self._instrumented = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def estimate_size(item: Any) -> int:
+    """
+    Default size estimator of memory_usage(): sys.getsizeof() of the item plus, recursively, that of the elements
+    of lists, tuples, sets, and dicts, and the data of memoryviews. Objects referenced more than once are counted each time.
+    For items whose data is not covered by sys.getsizeof(), e.g. NumPy arrays that are views, pass a size estimator that knows about them.
+    """
+    size = sys.getsizeof(item)
+    if isinstance(item, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(element) for element in item)
+    elif isinstance(item, dict):
+        size += sum(estimate_size(key) + estimate_size(value) for key, value in item.items())
+    elif isinstance(item, memoryview):
+        size += item.nbytes
+    return size
+
+
+def _sampling_size_estimator(size_estimator: Callable[[Any], int], max_sampled_items: Optional[int]) -> Callable[[List], int]:
+    """
+    Helper to create an estimator of the total size of a list of items, which extrapolates from at most max_sampled_items of them.
+    """
+    def estimate_total_size(items: List) -> int:
+        if max_sampled_items is None or len(items) <= max_sampled_items:
+            return sum(size_estimator(item) for item in items)
+        step = len(items) / max_sampled_items  # evenly spaced, so that the result is deterministic
+        sampled_size = sum(size_estimator(items[int(i * step)]) for i in range(max_sampled_items))
+        return int(sampled_size * len(items) / max_sampled_items)
+    return estimate_total_size
+
+
+def memory_usage(iterator: CheckpointableIterator, size_estimator: Callable[[Any], int]=estimate_size,
+                 max_sampled_items: Optional[int]=1000) -> List[Dict[str, Any]]:
+    """
+    Report the items currently held in the buffers of each stage of a pipeline, e.g. the buffer of BufferedShuffleIterator,
+    the read-ahead window of BucketedReadaheadBatchIterator, the FIFO of WindowedIterator, and the queues of prefetch iterators.
+
+    Only stages that buffer items are reported. The items held by multiprocessing prefetch iterators are in other
+    processes, hence only their number is reported. Stages upstream of a multiprocessing prefetch iterator run in
+    the prefetch process, whose memory is not inspected; they are not reported, since their copies in this process
+    are idle. The current collection of SelectManyIterator is not accounted for.
+
+    Args:
+        iterator: last iterator of the pipeline
+        size_estimator: function that returns the size of an item in bytes (default: estimate_size())
+        max_sampled_items: for larger buffers, the size is extrapolated from this many evenly spaced items (None to measure all)
+
+    Returns:
+        One dict per buffering stage, starting with the last one, with the following entries:
+        'path': position of the stage's state in the checkpoint (as in checkpoints.checkpoint_size_breakdown()),
+        'iterator': class name of the stage,
+        'items': number of items held, or None if unknown,
+        'bytes': estimated size of the buffer and the items held in bytes, or None if unknown.
+    """
+    estimate_total_size = _sampling_size_estimator(size_estimator, max_sampled_items)
+    report = []  # type: List[Dict[str, Any]]
+    for path, stage, _ in _walk_stages(iterator, this_process_only=True):
+        usage = stage._buffer_usage(estimate_total_size)
+        if usage is not None:
+            num_items, num_bytes = usage
+            report.append({'path': path, 'iterator': type(stage).__name__, 'items': num_items, 'bytes': num_bytes})
+    return report
+
+
+class MemoryMonitor:
+    """
+    Tracks the memory held in the buffers of a pipeline over time, see memory_usage().
+
+    Call sample() periodically, e.g. every few hundred batches, to measure the current usage and update the high-water marks.
+    The arguments are those of memory_usage().
+    """
+    def __init__(self, iterator: CheckpointableIterator, size_estimator: Callable[[Any], int]=estimate_size,
+                 max_sampled_items: Optional[int]=1000):
+        self._iterator = iterator                    # type: CheckpointableIterator
+        self._size_estimator = size_estimator        # type: Callable[[Any], int]
+        self._max_sampled_items = max_sampled_items  # type: Optional[int]
+        self.reset()
+
+    def sample(self) -> Dict[str, Any]:
+        """
+        Measure the current usage.
+
+        Returns:
+            A dict with the entries 'items' and 'bytes', the totals over all buffering stages (excluding unknown values),
+            'peak_items' and 'peak_bytes', their maxima over all calls of sample() since the monitor was created or reset,
+            and 'stages', the result of memory_usage().
+        """
+        stages = memory_usage(self._iterator, self._size_estimator, self._max_sampled_items)
+        num_items = sum(stage['items'] for stage in stages if stage['items'] is not None)
+        num_bytes = sum(stage['bytes'] for stage in stages if stage['bytes'] is not None)
+        self._peak_items = max(self._peak_items, num_items)
+        self._peak_bytes = max(self._peak_bytes, num_bytes)
+        return {'items':      num_items,
+                'bytes':      num_bytes,
+                'peak_items': self._peak_items,
+                'peak_bytes': self._peak_bytes,
+                'stages':     stages}
+
+    def reset(self):
+        """
+        Reset the high-water marks.
+        """
+        self._peak_items = 0  # type: int
+        self._peak_bytes = 0  # type: int
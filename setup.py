@@ -7,5 +7,5 @@ setup(
     author='Frank Seide',
     author_email='fseide@microsoft.com',
     description='Infinibatch is a library of checkpointable iterators for randomized data loading of massive data sets in deep neural network training.',
-    packages=find_packages()
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*'])
 )
@@ -0,0 +1,150 @@
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+from infinibatch.checkpoints import AsyncCheckpointWriter, load_checkpoint, serialize_checkpoint, deserialize_checkpoint, checkpoint_size_breakdown
+from infinibatch.iterators import NativeCheckpointableIterator, BufferedShuffleIterator, InfinitePermutationSourceIterator, MultiplexIterator, \
+                                  MapIterator, ZipIterator
+
+
+class TestAsyncCheckpointWriter(unittest.TestCase):
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+    def test_checkpoint_matches_position_at_save(self):
+        data = list(range(100))
+        it = BufferedShuffleIterator(NativeCheckpointableIterator(data), 10)
+        consumed = [next(it) for _ in range(20)]
+        release = threading.Event()
+        def slow_serialize(checkpoint):
+            release.wait()
+            return pickle.dumps(checkpoint)
+        with AsyncCheckpointWriter(serialize=slow_serialize, fsync=False) as writer:
+            future = writer.save(it, self.path)
+            rest = list(it)  # the pipeline keeps going while the checkpoint is being written
+            self.assertFalse(future.done())
+            release.set()
+            self.assertEqual(future.result(), self.path)
+        self.assertMultisetEqual(consumed + rest, data)
+        it.setstate(load_checkpoint(self.path))
+        self.assertListEqual(list(it), rest)
+        self.assertFalse(os.path.exists(self.path + '.tmp'))
+
+    def test_buffer_copied_on_background_thread(self):
+        copying_threads = []
+        class Item:
+            def __deepcopy__(self, memo):
+                copying_threads.append(threading.current_thread())
+                return Item()
+        it = BufferedShuffleIterator(NativeCheckpointableIterator([Item() for _ in range(100)]), 10)
+        _ = [next(it) for _ in range(20)]
+        checkpoints = []
+        def serialize(checkpoint):
+            checkpoints.append(checkpoint)
+            return b''
+        with AsyncCheckpointWriter(serialize=serialize, fsync=False) as writer:
+            writer.save(it, self.path).result()
+        self.assertEqual(len(copying_threads), 10)
+        self.assertNotIn(threading.current_thread(), copying_threads)
+        self.assertIsInstance(checkpoints[0]['buffer'], list)
+        self.assertTrue(all(isinstance(item, Item) for item in checkpoints[0]['buffer']))
+        copying_threads.clear()
+        _ = it.getstate()  # a plain getstate() copies right away
+        self.assertListEqual(copying_threads, [threading.current_thread()] * 10)
+
+    def test_order(self):
+        it = NativeCheckpointableIterator(list(range(10)))
+        with AsyncCheckpointWriter() as writer:
+            for _ in range(5):
+                writer.save(it, self.path)
+                next(it)
+        self.assertEqual(load_checkpoint(self.path), {'num_items_yielded': 4})
+
+    def test_error(self):
+        it = NativeCheckpointableIterator(list(range(10)))
+        with AsyncCheckpointWriter() as writer:
+            future = writer.save(it, os.path.join(self.data_dir, 'does-not-exist', 'checkpoint'))
+            self.assertRaises(OSError, future.result)
+
+    def assertMultisetEqual(self, a, b):
+        self.assertEqual(len(a), len(b))
+        self.assertSetEqual(set(a), set(b))
+
+
+class TestBinaryCheckpointFormat(unittest.TestCase):
+    def setUp(self):
+        sources = [InfinitePermutationSourceIterator(list(range(i * 100, (i + 1) * 100)), seed=1) for i in range(3)]
+        control = InfinitePermutationSourceIterator([0, 1, 2], seed=1)
+        self.iterator = BufferedShuffleIterator(MapIterator(MultiplexIterator(control, sources), str), 50, seed=1)
+        _ = [next(self.iterator) for _ in range(75)]
+        self.checkpoint = self.iterator.getstate()
+
+    def test_round_trip(self):
+        expected = [next(self.iterator) for _ in range(20)]
+        for compress in [False, True]:
+            self.iterator.setstate(deserialize_checkpoint(serialize_checkpoint(self.checkpoint, compress=compress)))
+            self.assertListEqual([next(self.iterator) for _ in range(20)], expected)
+
+    def test_round_trip_mixed_types(self):
+        # equal tuples with items of different types must not be deduplicated into one another
+        checkpoint = {'a': (1, 2), 'b': (1.0, 2.0), 'c': (True, False), 'd': (1, 0), 'e': ((1, 0), 'x'), 'f': ((True, False), 'x'),
+                      'g': (0.0, 1), 'h': (-0.0, 1), 'i': (1, 2)}
+        restored = deserialize_checkpoint(serialize_checkpoint(checkpoint))
+        self.assertDictEqual(restored, checkpoint)
+        for key, value in checkpoint.items():
+            self.assertEqual(repr(restored[key]), repr(value))
+        self.assertIs(restored['a'], restored['i'])
+
+    def test_compact(self):
+        # the sources and the control iterator were created with the same seed, hence have equal random states
+        self.assertLess(len(serialize_checkpoint(self.checkpoint)), len(pickle.dumps(self.checkpoint, protocol=4)) * 0.7)
+        self.assertLess(len(serialize_checkpoint(self.checkpoint, compress=True)), len(serialize_checkpoint(self.checkpoint)))
+
+    def test_corruption(self):
+        data = bytearray(serialize_checkpoint(self.checkpoint))
+        data[-10] ^= 1
+        self.assertRaises(ValueError, deserialize_checkpoint, bytes(data))
+        self.assertRaises(ValueError, deserialize_checkpoint, bytes(data[:-1]))
+        self.assertRaises(ValueError, deserialize_checkpoint, pickle.dumps(self.checkpoint))
+
+    def test_version(self):
+        data = bytearray(serialize_checkpoint(self.checkpoint))
+        data[4] += 1  # format version
+        self.assertRaises(ValueError, deserialize_checkpoint, bytes(data))
+
+    def test_load_checkpoint(self):
+        data_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(data_dir, 'checkpoint')
+            with AsyncCheckpointWriter(serialize=serialize_checkpoint) as writer:
+                writer.save(self.iterator, path)
+            self.assertEqual(load_checkpoint(path), self.checkpoint)
+        finally:
+            shutil.rmtree(data_dir)
+
+    def test_size_breakdown(self):
+        breakdown = checkpoint_size_breakdown(self.checkpoint)
+        self.assertSetEqual(set(breakdown), {'checkpoint',
+                                             'checkpoint.source_state',
+                                             'checkpoint.source_state.control_iterator_state',
+                                             'checkpoint.source_state.source_iterator_states[0]',
+                                             'checkpoint.source_state.source_iterator_states[1]',
+                                             'checkpoint.source_state.source_iterator_states[2]'})
+        self.assertSetEqual(set(breakdown['checkpoint']), {'buffer', 'random_state'})
+        self.assertGreater(breakdown['checkpoint']['buffer'], 50 * 3)
+        self.assertDictEqual(breakdown['checkpoint.source_state'], {})
+
+    def test_size_breakdown_zip(self):
+        it = ZipIterator(NativeCheckpointableIterator([1, 2]), NativeCheckpointableIterator([3, 4]))
+        self.assertSetEqual(set(checkpoint_size_breakdown(it.getstate())), {'checkpoint', 'checkpoint.input_states[0]', 'checkpoint.input_states[1]'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,12 @@ please replicate the `addTests` call for the iterators module below.
 """
 
 import doctest
+import infinibatch.checkpoints
 import infinibatch.iterators
+import infinibatch.profiling
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(infinibatch.iterators))
+    tests.addTests(doctest.DocTestSuite(infinibatch.checkpoints))
+    tests.addTests(doctest.DocTestSuite(infinibatch.profiling))
     return tests
\ No newline at end of file
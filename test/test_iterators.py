@@ -8,13 +8,21 @@ from typing import Iterable, Iterator, Any, Union
 import unittest
 import pickle
 import gc
+import sys
+import collections
+import functools
+import multiprocessing
+import subprocess
+import weakref
 
 from infinibatch.iterators import create_source_iterator, ChunkedSourceIterator, InfinitePermutationSourceIterator, BufferedShuffleIterator, BlockwiseShuffleIterator, \
                                   NativeCheckpointableIterator, BucketedReadaheadBatchIterator, \
-                                  MapIterator, ParallelMapIterator, ZipIterator, FixedBatchIterator, WindowedIterator, SelectManyIterator, \
+                                  MapIterator, ParallelMapIterator, WorkerPool, ZipIterator, FixedBatchIterator, WindowedIterator, SelectManyIterator, \
                                   RandomIterator, RecurrentIterator, SamplingRandomMapIterator, \
-                                  PrefetchIterator, MultiplexIterator
+                                  PrefetchIterator, MultiplexIterator, LazyMultiplexIterator, WeightedMultiplexIterator, RoundRobinIterator, MultiWorkerPrefetchIterator, SpawnPrefetchIterator, \
+                                  estimate_resume_cost, reshard_checkpoints
 from infinibatch.datasets import chunked_dataset_iterator
+import infinibatch.iterators
 
 
 # TODO:
@@ -52,6 +60,24 @@ class TestCheckpointableIterator:
         self.iterator.setstate(self.iterator.getstate())
         self.assertRaises(StopIteration, self.iterator.__next__)
 
+    def test_next_batch(self):
+        result = []
+        sizes = itertools.cycle([1, 3, 7])
+        while True:
+            batch = self.iterator.next_batch(next(sizes))
+            if not batch:
+                break
+            result.extend(batch)
+            self.iterator.setstate(self.iterator.getstate())  # checkpoints have to be consistent after every bulk pull
+        self.assertListEqual(result, self.expected_result)
+
+    def test_skip(self):
+        n = len(self.expected_result) // 3
+        self.assertEqual(self.iterator.skip(n), n)
+        self.iterator.setstate(self.iterator.getstate())  # checkpoint after skipping has to be consistent
+        self.assertListEqual(list(self.iterator), self.expected_result[n:])
+        self.assertEqual(self.iterator.skip(1), 0)
+
 
 class TestBase(unittest.TestCase):
     def setUp(self):
@@ -119,6 +145,105 @@ class TestMultiplexIterator(unittest.TestCase, TestCheckpointableIterator):
         self.iterator = MultiplexIterator(NativeCheckpointableIterator(index_seq), [NativeCheckpointableIterator(ds) for ds in data_seqs])
 
 
+class TestLazyMultiplexIterator(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        index_seq = [0, 2, 1, 2, 0, 1, 1]
+        self.data_seqs = [[0.0, 0.1, 0.2, 0.3],
+                          [1.0, 1.1, 1.2, 1.3],
+                          [2.0, 2.1, 2.2, 2.3]]
+        self.expected_result = [0.0, 2.0, 1.0, 2.1, 0.1, 1.1, 1.2]
+        self.created = []
+        self.iterator = LazyMultiplexIterator(NativeCheckpointableIterator(index_seq), self.create_source)
+
+    def create_source(self, index):
+        self.created.append(index)
+        return NativeCheckpointableIterator(self.data_seqs[index])
+
+    def test_lazy_creation(self):
+        _ = list(itertools.islice(self.iterator, 2))
+        self.assertListEqual(self.created, [0, 2])
+        self.assertListEqual(sorted(self.iterator.getstate()['source_iterator_states']), [0, 2])
+
+    def test_max_open_sources(self):
+        iterator = LazyMultiplexIterator(NativeCheckpointableIterator([0, 2, 1, 2, 0, 1, 1]), self.create_source, max_open_sources=1)
+        result = []
+        for item in iterator:
+            result.append(item)
+            self.assertEqual(iterator.num_open_sources, 1)
+        self.assertListEqual(result, self.expected_result)
+
+
+class TestWeightedMultiplexIterator(unittest.TestCase):
+    def setUp(self):
+        self.data_seqs = [list(range(i * 1000, (i + 1) * 1000)) for i in range(3)]
+
+    def create_iterator(self, weights, block_size=7):
+        source_iterators = [InfinitePermutationSourceIterator(ds, shuffle=False) for ds in self.data_seqs]
+        return WeightedMultiplexIterator(source_iterators, weights, seed=42, block_size=block_size)
+
+    def test_weights(self):
+        items = list(itertools.islice(self.create_iterator([0.5, 0.3, 0.2], block_size=100), 1500))
+        counts = [sum(1 for item in items if item // 1000 == i) for i in range(3)]
+        for count, weight in zip(counts, [0.5, 0.3, 0.2]):
+            self.assertAlmostEqual(count / len(items), weight, delta=0.05)
+        # items from each source come in order
+        for i in range(3):
+            source_items = [item for item in items if item // 1000 == i]
+            self.assertListEqual(source_items, self.data_seqs[i][:len(source_items)])
+
+    def test_distribution(self):
+        # weights whose shares end inside cells of the lookup table, a tiny weight, and too many sources for the table
+        for weights in [[0.1, 0.2, 0.3, 0.4], [1, 1e-3, 0, 3], [1, 2] * 150]:
+            with self.subTest(num_sources=len(weights)):
+                it = WeightedMultiplexIterator([NativeCheckpointableIterator([]) for _ in weights], weights, seed=1, block_size=200000)
+                counts = collections.Counter(it._block)
+                for index, weight in enumerate(weights):
+                    expected = 200000 * weight / sum(weights)
+                    self.assertLessEqual(abs(counts[index] - expected), 5 * expected ** 0.5 + 1)  # within 5 standard deviations
+
+    def test_zero_weight(self):
+        items = list(itertools.islice(self.create_iterator([1, 0, 2]), 100))
+        self.assertFalse(any(item // 1000 == 1 for item in items))
+
+    def test_checkpointing(self):
+        for position in [0, 5, 7, 13, 14]:  # positions at and around block boundaries
+            it = self.create_iterator([1, 2, 3])
+            _ = list(itertools.islice(it, position))
+            checkpoint = it.getstate()
+            items1 = list(itertools.islice(it, 30))
+            it = self.create_iterator([1, 1, 1])
+            it.setstate(checkpoint)
+            items2 = list(itertools.islice(it, 30))
+            self.assertListEqual(items1, items2)
+
+    def test_checkpointing_with_weight_change(self):
+        it = self.create_iterator([1, 2, 3])
+        _ = list(itertools.islice(it, 10))
+        it.set_weights([0, 0, 1])
+        items0 = list(itertools.islice(it, 5))
+        self.assertTrue(all(item // 1000 == 2 for item in items0))
+        checkpoint = it.getstate()
+        items1 = list(itertools.islice(it, 30))
+        it.setstate(checkpoint)
+        items2 = list(itertools.islice(it, 30))
+        self.assertListEqual(items1, items2)
+        # resetting restores the initial weights
+        it.setstate(None)
+        self.assertListEqual(it.getstate()['weights'], [1, 2, 3])
+
+    def test_invalid_weights(self):
+        self.assertRaises(ValueError, self.create_iterator, [0, 0, 0])
+        self.assertRaises(ValueError, self.create_iterator, [1, -1, 1])
+        self.assertRaises(ValueError, self.create_iterator, [1, 1])
+
+
+class TestRoundRobinIterator(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data_seqs = [[0, 1, 2], [10, 11], [20, 21, 22, 23]]
+        self.expected_result = [0, 10, 20, 1, 11, 21, 2, 22, 23]
+        self.iterator = RoundRobinIterator([NativeCheckpointableIterator(ds) for ds in data_seqs])
+
+
 class TestSourceIterator(unittest.TestCase):
     def test_exception(self):
         self.assertRaises(ValueError, create_source_iterator, [1], train=False, shuffle=True)
@@ -184,6 +309,27 @@ class TestInfinitePermutationSourceIterator(TestBase):
             self.assertTrue(items1a == items1b)
             self.assertTrue(items1a == items1c)
 
+    def test_skip(self):
+        for num_instances, instance_rank, shuffle in [(1, 0, True), (1, 0, False), (3, 0, True), (3, 2, True), (3, 1, False)]:
+            for num_items_before in [0, 1, 5, 7]:
+                for n in range(25):
+                    reader = InfinitePermutationSourceIterator(list(range(7)), seed=n, shuffle=shuffle, num_instances=num_instances, instance_rank=instance_rank)
+                    expected = InfinitePermutationSourceIterator(list(range(7)), seed=n, shuffle=shuffle, num_instances=num_instances, instance_rank=instance_rank)
+                    _ = list(itertools.islice(reader, num_items_before))
+                    _ = list(itertools.islice(expected, num_items_before + n))
+                    self.assertEqual(reader.skip(n), n)
+                    self.assertEqual(reader.getstate(), expected.getstate())
+                    self.assertListEqual(list(itertools.islice(reader, 10)), list(itertools.islice(expected, 10)))
+
+    def test_skip_jumps_to_index(self):
+        reader = InfinitePermutationSourceIterator(list(range(10 ** 6)), seed=1)  # replaying this item by item would be slow
+        checkpoint = reader.getstate()
+        self.assertEqual(reader.skip(10 ** 6 - 1), 10 ** 6 - 1)
+        last_item = next(reader)
+        reader.setstate(checkpoint)
+        self.assertEqual(list(itertools.islice(reader, 10 ** 6))[-1], last_item)
+        self.assertEqual(estimate_resume_cost(reader, reader.getstate())[0]['replayed_items'], 0)
+
 
 class TestNativeCheckpointableIterator(unittest.TestCase, TestCheckpointableIterator):
     def setUp(self):
@@ -193,6 +339,66 @@ class TestNativeCheckpointableIterator(unittest.TestCase, TestCheckpointableIter
     def test_iterator_exception(self):
         self.assertRaises(ValueError, NativeCheckpointableIterator, iter(range(10)))
 
+    def test_skip_jumps_to_index(self):
+        it = NativeCheckpointableIterator(range(10 ** 12))  # replaying this would take forever
+        it.setstate({'num_items_yielded': 10 ** 11})
+        self.assertEqual(next(it), 10 ** 11)
+        self.assertEqual(it.skip(10 ** 12), 10 ** 12 - 10 ** 11 - 1)
+        self.assertRaises(StopIteration, it.__next__)
+        self.assertRaises(RuntimeError, it.setstate, {'num_items_yielded': 10 ** 12 + 1})
+
+
+class SizedCollection:
+    """
+    Collection that records whether it was iterated over
+    """
+    def __init__(self, items):
+        self.items = items
+        self.iterated = False
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        self.iterated = True
+        return iter(self.items)
+
+
+class TestSkip(unittest.TestCase):
+    def test_map_skip_does_not_transform(self):
+        transformed = []
+        def transform(item):
+            transformed.append(item)
+            return item
+        it = MapIterator(NativeCheckpointableIterator(list(range(10))), transform)
+        self.assertEqual(it.skip(7), 7)
+        self.assertListEqual(list(it), [7, 8, 9])
+        self.assertListEqual(transformed, [7, 8, 9])
+
+    def test_select_many_skips_whole_collections(self):
+        collections = [SizedCollection(list(range(i * 10, i * 10 + 4))) for i in range(3)]
+        it = SelectManyIterator(NativeCheckpointableIterator(collections))
+        self.assertEqual(it.skip(6), 6)
+        self.assertListEqual([collection.iterated for collection in collections], [False, True, False])
+        checkpoint = it.getstate()
+        self.assertListEqual(list(it), [12, 13, 20, 21, 22, 23])
+        it.setstate(checkpoint)
+        self.assertListEqual(list(it), [12, 13, 20, 21, 22, 23])
+
+    def test_select_many_skip_after_checkpoint(self):
+        collections = [SizedCollection(list(range(i * 10, i * 10 + 4))) for i in range(3)]
+        it = SelectManyIterator(NativeCheckpointableIterator(collections))
+        _ = list(itertools.islice(it, 2))
+        it.setstate(it.getstate())
+        self.assertEqual(it.skip(4), 4)  # remainder of the first collection and part of the second
+        self.assertListEqual(list(it), [12, 13, 20, 21, 22, 23])
+
+    def test_fixed_batch_skip(self):
+        it = FixedBatchIterator(NativeCheckpointableIterator(list(range(10))), 3)
+        self.assertEqual(it.skip(2), 2)
+        self.assertEqual(it.skip(5), 2)
+        self.assertRaises(StopIteration, it.__next__)
+
 
 class TestRecurrentIterator(unittest.TestCase, TestCheckpointableIterator):
     def setUp(self):
@@ -209,6 +415,64 @@ class TestRecurrentIterator(unittest.TestCase, TestCheckpointableIterator):
         self.iterator = RecurrentIterator(NativeCheckpointableIterator(data), step_function, initial_state = 0)
 
 
+class CopyOnWriteList:
+    """
+    Recurrent state implementing the snapshot protocol of RecurrentIterator by copy-on-write
+    """
+    num_copies = 0
+
+    def __init__(self, items=None):
+        self._items = items if items is not None else []
+        self._shared = False
+
+    def snapshot(self):
+        self._shared = True
+        snapshot = CopyOnWriteList(self._items)
+        snapshot._shared = True
+        return snapshot
+
+    def restore(self):
+        return self.snapshot()
+
+    def append(self, item):
+        if self._shared:
+            CopyOnWriteList.num_copies += 1
+            self._items = list(self._items)
+            self._shared = False
+        self._items.append(item)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class TestRecurrentIteratorSnapshotState(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = list(range(1, 54))
+
+        def step_function(prev_state, item):
+            prev_state.append(item)  # in-place modification
+            return prev_state, len(prev_state)
+        self.iterator = RecurrentIterator(NativeCheckpointableIterator(data), step_function, initial_state=CopyOnWriteList())
+
+    def test_getstate_does_not_copy(self):
+        next(self.iterator)
+        CopyOnWriteList.num_copies = 0
+        checkpoints = [self.iterator.getstate() for _ in range(10)]
+        self.assertEqual(CopyOnWriteList.num_copies, 0)
+        next(self.iterator)
+        self.assertEqual(CopyOnWriteList.num_copies, 1)  # copied once, upon the next modification
+        self.assertTrue(all(len(checkpoint['recurrent_state']) == 1 for checkpoint in checkpoints))
+
+    def test_checkpoint_reuse(self):
+        next(self.iterator)
+        checkpoint = self.iterator.getstate()
+        self.iterator.setstate(checkpoint)
+        first = list(self.iterator)
+        self.iterator.setstate(checkpoint)
+        self.assertListEqual(list(self.iterator), first)
+
+
 class TestSamplingRandomMapIterator(unittest.TestCase, TestCheckpointableIterator):
     def setUp(self):
         data = list(range(53))
@@ -300,6 +564,26 @@ class TestBufferedShuffleIterator(TestBase):
         self.assertListEqual(items, self.flattened_test_data)
 
 
+class TestBufferedShuffleIteratorWarmup(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.data = list(range(200))
+        self.expected_result = list(BufferedShuffleIterator(NativeCheckpointableIterator(self.data), 50, seed=1, warmup_size=2))
+        self.source = NativeCheckpointableIterator(self.data)
+        self.iterator = BufferedShuffleIterator(self.source, 50, seed=1, warmup_size=2)
+
+    def test_permutation(self):
+        self.assertListEqual(sorted(self.expected_result), self.data)
+        self.assertNotEqual(self.expected_result, self.data)
+
+    def test_first_item_early(self):
+        next(self.iterator)
+        self.assertLess(self.source.getstate()['num_items_yielded'], 10)
+
+    def test_buffer_grows_to_buffer_size(self):
+        _ = list(itertools.islice(self.iterator, 100))
+        self.assertEqual(len(self.iterator.getstate()['buffer']), 50)
+
+
 # note: this is also tested in more depth in Test_chunked_dataset_iterator()
 class TestBlockwiseShuffleIterator(TestBase):
     def test_shuffle(self):
@@ -313,6 +597,24 @@ class TestBlockwiseShuffleIterator(TestBase):
         self.assertListEqual(items, self.flattened_test_data)
 
 
+class TestBlockwiseShuffleIteratorWarmup(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.data = list(range(100))
+        self.expected_result = list(BlockwiseShuffleIterator(NativeCheckpointableIterator(self.data), 32, seed=1, warmup_size=3))
+        self.source = NativeCheckpointableIterator(self.data)
+        self.iterator = BlockwiseShuffleIterator(self.source, 32, seed=1, warmup_size=3)
+
+    def test_block_sizes(self):
+        # blocks of 3, 6, 12, 24, 32, and the remaining 23 items
+        boundaries = [0, 3, 9, 21, 45, 77, 100]
+        for start, end in zip(boundaries, boundaries[1:]):
+            self.assertListEqual(sorted(self.expected_result[start:end]), self.data[start:end])
+
+    def test_first_item_early(self):
+        next(self.iterator)
+        self.assertEqual(self.source.getstate()['num_items_yielded'], 3)
+
+
 def map_fun(n):
     return n + 1
 
@@ -324,6 +626,32 @@ class TestMapIterator(unittest.TestCase, TestCheckpointableIterator):
         self.iterator = MapIterator(NativeCheckpointableIterator(data), map_fun)
 
 
+class TestMapIteratorFused(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [map_fun(map_fun(n)) + 1 for n in data]
+        self.iterator = MapIterator(MapIterator(MapIterator(NativeCheckpointableIterator(data), map_fun), map_fun), lambda n: n + 1)
+
+    def test_fused(self):
+        self.assertIsInstance(self.iterator._source_iterator, NativeCheckpointableIterator)
+
+    def test_checkpoint_compatible(self):
+        data = list(range(53))
+        class UnfusedMapIterator(MapIterator):
+            pass
+        unfused = MapIterator(UnfusedMapIterator(NativeCheckpointableIterator(data), map_fun), map_fun)
+        _ = list(itertools.islice(unfused, 10))
+        fused = MapIterator(MapIterator(NativeCheckpointableIterator(data), map_fun), map_fun)
+        fused.setstate(unfused.getstate())
+        self.assertListEqual(list(fused), [map_fun(map_fun(n)) for n in data[10:]])
+
+    def test_subclass_not_fused(self):
+        class CountingMapIterator(MapIterator):
+            pass
+        source = CountingMapIterator(NativeCheckpointableIterator([1, 2]), map_fun)
+        self.assertIs(MapIterator(source, map_fun)._source_iterator, source)
+
+
 class TestParallelMapIterator(unittest.TestCase, TestCheckpointableIterator):
     def setUp(self):
         data = list(range(53))
@@ -331,6 +659,201 @@ class TestParallelMapIterator(unittest.TestCase, TestCheckpointableIterator):
         self.iterator = ParallelMapIterator(NativeCheckpointableIterator(data), map_fun, 5, 7)
 
 
+class TestParallelMapIteratorSharedPool(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [map_fun(map_fun(n)) for n in data]
+        self.pool = WorkerPool(2, limit_workers=False)  # exempt from the cap, so that this runs with two workers on any host
+        self.iterator = ParallelMapIterator(NativeCheckpointableIterator(data), map_fun, 2, 3, pool=self.pool)
+        self.iterator = ParallelMapIterator(self.iterator, map_fun, 2, 5, pool=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_close(self):
+        with WorkerPool(1) as pool:
+            iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2, 3]), map_fun, 1, 2, pool=pool)
+            self.assertListEqual(list(iterator), [2, 3, 4])
+        self.assertTrue(pool.closed)
+        self.assertRaises(ValueError, pool.map_async, map_fun, [1])
+
+    def test_max_total_workers(self):
+        max_total_workers = WorkerPool.max_total_workers
+        try:
+            WorkerPool.max_total_workers = WorkerPool._num_total_workers + 3  # allow for three more workers on top of the ones of other tests
+            with self.assertLogs('infinibatch.iterators', level='WARNING') as logs:
+                with WorkerPool(2) as pool1, WorkerPool(2) as pool2, WorkerPool(2) as pool3:
+                    self.assertListEqual([pool1.num_processes, pool2.num_processes, pool3.num_processes], [2, 1, 1])
+            self.assertEqual(len(logs.output), 2)
+            with WorkerPool(3) as pool1, WorkerPool(2, limit_workers=False) as pool2:
+                self.assertListEqual([pool1.num_processes, pool2.num_processes], [3, 2])
+        finally:
+            WorkerPool.max_total_workers = max_total_workers
+
+    def test_workers_released_when_garbage_collected(self):
+        num_total_workers = WorkerPool._num_total_workers
+        for backend in ['process', 'thread']:
+            pool = WorkerPool(2, backend=backend, limit_workers=False)
+            self.assertEqual(WorkerPool._num_total_workers, num_total_workers + 2)
+            del pool
+            gc.collect()
+            self.assertEqual(WorkerPool._num_total_workers, num_total_workers)
+
+    def test_max_total_workers_own_pool(self):
+        max_total_workers = WorkerPool.max_total_workers
+        try:
+            WorkerPool.max_total_workers = WorkerPool._num_total_workers + 1
+            iterator = ParallelMapIterator(NativeCheckpointableIterator(list(range(10))), map_fun, 3, 2)
+            self.assertEqual(iterator._source_iterator._pool.num_processes, 3)  # not limited unless asked for
+            with self.assertLogs('infinibatch.iterators', level='WARNING'):
+                limited = ParallelMapIterator(NativeCheckpointableIterator(list(range(10))), map_fun, 3, 2, limit_workers=True)
+            self.assertEqual(limited._source_iterator._pool.num_processes, 1)
+            self.assertEqual(limited._source_iterator._source_iterator._batch_size, 2)  # batches sized for the workers it got
+            self.assertListEqual(list(limited), list(iterator))
+        finally:
+            WorkerPool.max_total_workers = max_total_workers
+
+    def test_own_pool_closed_with_iterator(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2, 3]), map_fun, 1, 2)
+        pool = iterator._source_iterator._pool
+        del iterator
+        gc.collect()
+        self.assertTrue(pool.closed)
+
+
+class TestParallelMapIteratorThreadBackend(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [n * 3 for n in data]
+        # the thread backend does not require a pickleable transform
+        self.iterator = ParallelMapIterator(NativeCheckpointableIterator(data), lambda n: n * 3, 3, 4, backend='thread')
+
+
+class TestParallelMapIteratorAdaptive(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.data = list(range(153))
+        self.expected_result = [map_fun(n) for n in self.data]
+        self.iterator = ParallelMapIterator(NativeCheckpointableIterator(self.data), map_fun, 3, 2,
+                                            items_per_process_bounds=(1, 20), scale_workers=True)
+
+    def test_bounds(self):
+        batched_iterator = self.iterator._source_iterator
+        for _ in self.iterator:
+            self.assertTrue(1 <= batched_iterator.items_per_process <= 20)
+            self.assertTrue(1 <= batched_iterator.num_active_workers <= 3)
+
+    def test_restore_with_different_tuning(self):
+        result = list(itertools.islice(self.iterator, 50))
+        checkpoint = self.iterator.getstate()
+        iterator = ParallelMapIterator(NativeCheckpointableIterator(self.data), map_fun, 2, 7, items_per_process_bounds=(7, 7))
+        iterator.setstate(checkpoint)
+        result += list(iterator)
+        self.assertListEqual(result, self.expected_result)
+
+    def test_no_abandoned_units_without_shared_memory(self):
+        batched_iterator = self.iterator._source_iterator
+        for _ in range(10):
+            _ = next(self.iterator)
+            self.iterator.setstate(self.iterator.getstate())  # drops the batches in flight
+        self.assertListEqual(batched_iterator._abandoned_units, [])
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'shared memory requires Python 3.8')
+class TestParallelMapIteratorSharedMemory(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [bytes(to_pickle_buffer(n)) for n in data]
+        # results are PickleBuffers, which are sent out-of-band; items are copied to bytes before the slab is recycled
+        iterator = ParallelMapIterator(NativeCheckpointableIterator(data), to_pickle_buffer, 2, 3, shared_memory_size=3 * 1600)
+        self.iterator = MapIterator(iterator, bytes)
+
+    def test_zero_copy(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2]), to_pickle_buffer, 1, 2, shared_memory_size=4096)
+        item = next(iterator)
+        self.assertIsInstance(item, memoryview)
+        self.assertEqual(bytes(item), bytes(to_pickle_buffer(1)))
+        del item  # release the view before the slab gets closed
+
+    def test_next_batch_copies(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator(list(range(40))), to_pickle_buffer, 2, 3, shared_memory_size=3 * 1600)
+        _ = next(iterator)
+        batch = iterator.next_batch(10)  # the rest of the first batch and the items of the next ones
+        rest = [bytes(item) for item in iterator]  # recycles the slabs
+        self.assertListEqual([bytes(item) for item in batch], [bytes(to_pickle_buffer(n)) for n in range(1, 11)])
+        self.assertListEqual(rest, [bytes(to_pickle_buffer(n)) for n in range(11, 40)])
+
+    def test_close_with_live_views(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2]), to_pickle_buffer, 1, 2, shared_memory_size=4096)
+        item = next(iterator)
+        del iterator  # closes the slabs while item still references one of them
+        gc.collect()
+        self.assertEqual(bytes(item), bytes(to_pickle_buffer(1)))
+        self.assertEqual(len(infinibatch.iterators._unclosed_shared_memory), 1)
+        del item
+        infinibatch.iterators._close_shared_memory()
+        self.assertEqual(len(infinibatch.iterators._unclosed_shared_memory), 0)
+
+    def test_slabs_closed_when_garbage_collected(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2]), to_pickle_buffer, 1, 2, shared_memory_size=4096)
+        self.assertEqual(bytes(next(iterator)), bytes(to_pickle_buffer(1)))
+        slab_pool = weakref.ref(iterator._source_iterator._slab_pool)
+        del iterator
+        gc.collect()
+        self.assertIsNone(slab_pool())
+        infinibatch.iterators._close_shared_memory()  # the last batch may have been collected after the slabs were closed
+        self.assertListEqual(infinibatch.iterators._unclosed_shared_memory, [])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inspects /proc')
+    def test_workers_detach_slabs(self):
+        with WorkerPool(2, limit_workers=False) as pool:
+            for _ in range(3):  # pipelines rebuilt on a shared pool
+                iterator = ParallelMapIterator(NativeCheckpointableIterator(list(range(20))), to_pickle_buffer, 2, 3, pool=pool, shared_memory_size=3 * 1600)
+                self.assertEqual(len([bytes(item) for item in iterator]), 20)
+                del iterator
+                gc.collect()
+            self.assertListEqual(pool.map_async(count_shared_memory_mappings, range(8)).get(), [0] * 8)
+
+    @unittest.skipUnless(os.name == 'posix', 'shared memory is tracked by the resource tracker on POSIX only')
+    def test_no_resource_tracker_warnings(self):
+        script = ('from infinibatch.iterators import NativeCheckpointableIterator, ParallelMapIterator, WorkerPool\n'
+                  'import pickle\n'
+                  'def f(n):\n'
+                  '    return pickle.PickleBuffer(bytes([n]) * 1500)\n'
+                  'if __name__ == "__main__":\n'
+                  '    it = ParallelMapIterator(NativeCheckpointableIterator(list(range(20))), f, 2, 3, shared_memory_size=4800)\n'
+                  '    assert [bytes(item) for item in it] == [bytes(f(n)) for n in range(20)]\n')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'script.py')
+            with open(path, 'w') as f:
+                f.write(script)
+            root = os.path.dirname(os.path.dirname(os.path.abspath(infinibatch.iterators.__file__)))
+            result = subprocess.run([sys.executable, path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=dict(os.environ, PYTHONPATH=root), timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        self.assertEqual(result.stderr.decode(), '')
+
+    def test_results_too_large(self):
+        iterator = ParallelMapIterator(NativeCheckpointableIterator([1, 2, 3]), to_pickle_buffer, 1, 2, shared_memory_size=1024)
+        self.assertListEqual([bytes(item) for item in iterator], [bytes(to_pickle_buffer(n)) for n in [1, 2, 3]])
+
+    def test_thread_backend(self):
+        self.assertRaises(ValueError, ParallelMapIterator, NativeCheckpointableIterator([1]), to_pickle_buffer, 1, 2, backend='thread', shared_memory_size=4096)
+
+
+class TestParallelMapIteratorSynchronous(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [map_fun(n) for n in data]
+        self.iterator = ParallelMapIterator(NativeCheckpointableIterator(data), map_fun, 2, 3, num_in_flight_batches=1)
+
+
+class TestParallelMapIteratorManyInFlight(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [map_fun(n) for n in data]
+        self.iterator = ParallelMapIterator(NativeCheckpointableIterator(data), map_fun, 2, 3, num_in_flight_batches=4)
+
+
 class TestZipIterator(unittest.TestCase, TestCheckpointableIterator):
     def setUp(self):
         data1 = list(range(53))
@@ -355,6 +878,137 @@ class TestWindowedIterator(TestBase):
             self.assertListEqual(actual1a, actual1b)  # checkpointing
 
 
+class TestWindowedIteratorNumeric(TestBase):
+    def test(self):
+        for n in [0, 2, 3, 8, 9, 10, 11, 12]:  # cover various boundary conditions
+            seq = list(range(n))
+            it = WindowedIterator(NativeCheckpointableIterator(seq), 3, typecode='l')
+            actual0 = list(itertools.islice(it, n * 3 // 10))
+            checkpoint = it.getstate()
+            actual1a = list(it)
+            it.setstate(checkpoint)
+            actual1b = list(it)
+            actual = actual0 + actual1a
+            expected = list(zip(seq, itertools.islice(seq, 1, None), itertools.islice(seq, 2, None)))
+            self.assertListEqual([tuple(window) for window in actual], expected)  # basic operation
+            self.assertListEqual(actual1a, actual1b)                              # checkpointing
+            self.assertTrue(all(window.readonly for window in actual))
+
+    def test_checkpoint_compatible(self):
+        seq = list(range(20))
+        it = WindowedIterator(NativeCheckpointableIterator(seq), 4)
+        _ = list(itertools.islice(it, 6))
+        numeric_it = WindowedIterator(NativeCheckpointableIterator(seq), 4, typecode='l')
+        numeric_it.setstate(it.getstate())
+        self.assertListEqual([tuple(window) for window in numeric_it], list(it))
+
+    def test_invalid_typecode(self):
+        self.assertRaises(ValueError, WindowedIterator, NativeCheckpointableIterator([1]), 3, typecode='x')
+        self.assertRaises(ValueError, WindowedIterator, NativeCheckpointableIterator(['a']), 3, typecode='u')  # array supports it, memoryview does not
+
+
+class TestEstimateResumeCost(unittest.TestCase):
+    def test_pipeline(self):
+        chunks = [list(range(i * 100, (i + 1) * 100)) for i in range(5)]
+        samples = SelectManyIterator(NativeCheckpointableIterator(chunks))
+        batches = BucketedReadaheadBatchIterator(MapIterator(samples, lambda n: n + 1), read_ahead=50, key=lambda n: n, batch_size=5)
+        _ = list(itertools.islice(batches, 13))  # 65 items: 13 batches, of which 10 from the first and 3 from the second read-ahead window
+        report = estimate_resume_cost(batches, batches.getstate())
+        self.assertListEqual([(stage['path'], stage['iterator'], stage['replayed_items']) for stage in report],
+                             [('checkpoint',                           'BucketedReadaheadBatchIterator', 50),
+                              ('checkpoint.source_state',              'MapIterator',                     0),
+                              ('checkpoint.source_state',              'SelectManyIterator',             50),
+                              ('checkpoint.source_state.source_state', 'NativeCheckpointableIterator',    0)])
+        self.assertEqual(report[0]['description'], 're-reads the read-ahead window of up to 50 items and skips 3 batches')
+
+    def test_initial_state(self):
+        it = MultiplexIterator(NativeCheckpointableIterator([0, 1]), [NativeCheckpointableIterator([1]), NativeCheckpointableIterator('ab')])
+        report = estimate_resume_cost(it, None)
+        self.assertListEqual([stage['path'] for stage in report],
+                             ['checkpoint', 'checkpoint.control_iterator_state', 'checkpoint.source_iterator_states[0]', 'checkpoint.source_iterator_states[1]'])
+        self.assertTrue(all(stage['replayed_items'] == 0 for stage in report))
+
+    def test_replay_without_index(self):
+        it = NativeCheckpointableIterator('abcdef')  # a string is not jumped into, see NativeCheckpointableIterator.skip()
+        _ = list(itertools.islice(it, 4))
+        self.assertEqual(estimate_resume_cost(it, it.getstate())[0]['replayed_items'], 4)
+
+
+class TestReshardCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.chunks = [[(i, j) for j in range(5)] for i in range(12)]
+        self.all_items = [item for chunk in self.chunks for item in chunk]
+
+    def serve_until_complete(self, iterators, served):
+        # serve from the iterators in turn until every item has been served; returns the number of items served
+        remaining = set(self.all_items) - set(served)
+        num_served = 0
+        while remaining:
+            for it in iterators:
+                remaining.discard(next(it))
+                num_served += 1
+            self.assertLess(num_served, 10 * len(self.all_items))
+        return num_served
+
+    def check_reshard(self, pipeline_factory, old_num_instances, new_num_instances, num_items_before, max_duplicates):
+        old_pipelines = [pipeline_factory(num_instances=old_num_instances, instance_rank=rank) for rank in range(old_num_instances)]
+        served = [item for it in old_pipelines for item in itertools.islice(it, num_items_before)]
+        checkpoints = [it.getstate() for it in old_pipelines]
+        new_checkpoints = reshard_checkpoints(checkpoints, pipeline_factory, new_num_instances)
+        self.assertEqual(len(new_checkpoints), new_num_instances)
+        new_pipelines = []
+        for rank, checkpoint in enumerate(new_checkpoints):
+            it = pipeline_factory(num_instances=new_num_instances, instance_rank=rank)
+            it.setstate(checkpoint)
+            new_pipelines.append(it)
+        num_served = self.serve_until_complete(new_pipelines, served)
+        self.assertLessEqual(len(served) + num_served, len(self.all_items) + max_duplicates + new_num_instances)
+
+    def test_permutation_source(self):
+        for shuffle in (False, True):
+            for old_num_instances, new_num_instances in ((3, 2), (2, 5), (4, 4)):
+                with self.subTest(shuffle=shuffle, old_num_instances=old_num_instances, new_num_instances=new_num_instances):
+                    factory = functools.partial(InfinitePermutationSourceIterator, self.all_items, seed=1, shuffle=shuffle)
+                    self.check_reshard(factory, old_num_instances, new_num_instances, 7, old_num_instances)
+
+    def test_chunked_dataset(self):
+        for shuffle in (False, True):
+            with self.subTest(shuffle=shuffle):
+                factory = functools.partial(chunked_dataset_iterator, self.chunks, iter, buffer_size=7, seed=1, shuffle=shuffle)
+                self.check_reshard(factory, 3, 2, 8, 3 * (5 + 7))
+
+    def test_resume_position(self):
+        factory = functools.partial(chunked_dataset_iterator, self.chunks, iter, buffer_size=7, seed=1, shuffle=False)
+        old_pipelines = [factory(num_instances=2, instance_rank=rank) for rank in range(2)]
+        for it in old_pipelines:
+            _ = list(itertools.islice(it, 12))  # rank 0 has read chunks 0, 2 and 4; rank 1 chunks 1, 3 and 5
+        new_pipelines = [factory(num_instances=3, instance_rank=rank) for rank in range(3)]
+        for it, checkpoint in zip(new_pipelines, reshard_checkpoints([it.getstate() for it in old_pipelines], factory, 3)):
+            it.setstate(checkpoint)
+        self.assertSetEqual({next(it) for it in new_pipelines}, {(4, 0), (5, 0), (6, 0)})
+
+    def test_across_passes(self):
+        for shuffle in (False, True):
+            with self.subTest(shuffle=shuffle):
+                # rank 0 is at the end of the first pass, rank 1 already in the second pass
+                factory = functools.partial(InfinitePermutationSourceIterator, self.all_items, seed=1, shuffle=shuffle)
+                old_pipelines = [factory(num_instances=2, instance_rank=rank) for rank in range(2)]
+                _ = list(itertools.islice(old_pipelines[0], 29))
+                _ = list(itertools.islice(old_pipelines[1], 31))
+                reference = factory()
+                _ = list(itertools.islice(reference, 58))
+                expected = list(itertools.islice(reference, 3))
+                new_pipelines = [factory(num_instances=3, instance_rank=rank) for rank in range(3)]
+                for it, checkpoint in zip(new_pipelines, reshard_checkpoints([it.getstate() for it in old_pipelines], factory, 3)):
+                    it.setstate(checkpoint)
+                self.assertSetEqual({next(it) for it in new_pipelines}, set(expected))
+
+    def test_no_permutation_source(self):
+        factory = functools.partial(chunked_dataset_iterator, self.chunks, iter, buffer_size=7, train=False, shuffle=False)
+        with self.assertRaises(ValueError):
+            reshard_checkpoints([None, None], factory, 3)
+
+
 class TestRandomIterator(TestBase):
     def test(self):
         n = 100
@@ -374,6 +1028,179 @@ class TestPrefetchIterator(unittest.TestCase, TestCheckpointableIterator):
         self.iterator = PrefetchIterator(source_iterator, buffer_size=13)
 
 
+class TestPrefetchIteratorCheckpointInterval(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.expected_result = list(range(53))
+        source_iterator = NativeCheckpointableIterator(self.expected_result)
+        self.iterator = PrefetchIterator(source_iterator, buffer_size=13, checkpoint_interval=4)
+
+    def test_bounded_replay(self):
+        for _ in range(30):
+            next(self.iterator)
+            self.assertLess(self.iterator.getstate()['item_offset'], 4)
+
+    def test_change_interval(self):
+        # a checkpoint taken with a larger interval can be restored with a smaller one and vice versa
+        _ = list(itertools.islice(self.iterator, 11))
+        checkpoint = self.iterator.getstate()
+        for checkpoint_interval in [1, 13]:
+            iterator = PrefetchIterator(NativeCheckpointableIterator(self.expected_result), buffer_size=13, checkpoint_interval=checkpoint_interval)
+            iterator.setstate(checkpoint)
+            _ = list(itertools.islice(iterator, 5))
+            iterator.setstate(iterator.getstate())
+            self.assertListEqual(list(iterator), self.expected_result[16:])
+
+
+class TestMultiWorkerPrefetchIterator(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        shards = [list(ChunkedSourceIterator(data, num_instances=3, instance_rank=rank)) for rank in range(3)]
+        self.expected_result = [map_fun(item) for items in itertools.zip_longest(*shards) for item in items if item is not None]
+        pipeline_factory = lambda num_instances, instance_rank: MapIterator(ChunkedSourceIterator(data, num_instances, instance_rank), map_fun)
+        self.iterator = MultiWorkerPrefetchIterator(pipeline_factory, num_workers=3, buffer_size=5)
+
+    def test_infinite_source(self):
+        data = list(range(20))
+        pipeline_factory = lambda num_instances, instance_rank: InfinitePermutationSourceIterator(data, seed=1, num_instances=num_instances, instance_rank=instance_rank)
+        iterator = MultiWorkerPrefetchIterator(pipeline_factory, num_workers=4, buffer_size=5)
+        self.assertMultisetEqual(list(itertools.islice(iterator, 20)), data)
+
+    def assertMultisetEqual(self, a, b):
+        self.assertEqual(len(a), len(b))
+        self.assertSetEqual(set(a), set(b))
+
+
+class TestSpawnPrefetchIterator(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.expected_result = list(range(53))
+        # the pipeline factory is sent to the prefetch process, hence it has to be pickleable
+        self.iterator = SpawnPrefetchIterator(functools.partial(NativeCheckpointableIterator, self.expected_result), buffer_size=13)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "the PrefetchIterator backend 'fork' requires the fork start method")
+    def test_checkpoint_interchangeable_with_fork(self):
+        fork_iterator = PrefetchIterator(NativeCheckpointableIterator(self.expected_result), buffer_size=13, backend='fork')
+        _ = list(itertools.islice(fork_iterator, 20))
+        self.iterator.setstate(fork_iterator.getstate())
+        self.assertListEqual(list(self.iterator), self.expected_result[20:])
+
+    def test_exception(self):
+        iterator = SpawnPrefetchIterator(functools.partial(InfinitePermutationSourceIterator, []), buffer_size=13)
+        self.assertRaises(ValueError, iterator.__next__)
+
+    def test_multi_worker(self):
+        iterator = MultiWorkerPrefetchIterator(functools.partial(ChunkedSourceIterator, self.expected_result), num_workers=2, buffer_size=5, backend='spawn')
+        self.assertListEqual(sorted(iterator), self.expected_result)
+
+    def test_prefetch_iterator_backend(self):
+        self.assertRaises(ValueError, PrefetchIterator, NativeCheckpointableIterator(self.expected_result), 13, backend='spawn')
+
+
+class TestThreadPrefetchIterator(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.expected_result = list(range(53))
+        source_iterator = NativeCheckpointableIterator(self.expected_result)
+        self.iterator = PrefetchIterator(source_iterator, buffer_size=13, backend='thread')
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "the PrefetchIterator backend 'fork' requires the fork start method")
+    def test_checkpoint_interchangeable_with_fork(self):
+        fork_iterator = PrefetchIterator(NativeCheckpointableIterator(self.expected_result), buffer_size=13, backend='fork')
+        _ = list(itertools.islice(fork_iterator, 20))
+        self.iterator.setstate(fork_iterator.getstate())
+        self.assertListEqual(list(self.iterator), self.expected_result[20:])
+
+    def test_exception(self):
+        def fail_on_seven(n):
+            if n == 7:
+                raise KeyError(n)
+            return n
+        iterator = PrefetchIterator(MapIterator(NativeCheckpointableIterator(self.expected_result), fail_on_seven), buffer_size=13, backend='thread')
+        self.assertListEqual(list(itertools.islice(iterator, 7)), self.expected_result[:7])
+        self.assertRaises(KeyError, iterator.__next__)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, PrefetchIterator, NativeCheckpointableIterator(self.expected_result), 13, backend='gpu')
+
+
+def fail_on_seven(n):
+    if n == 7:
+        raise KeyError(n)
+    return n
+
+
+def failing_pipeline():
+    return MapIterator(NativeCheckpointableIterator(list(range(53))), fail_on_seven)
+
+
+class TestPrefetchIteratorException(TestBase):
+    # an exception raised by the source is re-raised by the consumer, for all backends
+    def create_iterators(self):
+        if multiprocessing.get_start_method() == 'fork':
+            yield 'fork', PrefetchIterator(failing_pipeline(), buffer_size=13, backend='fork')
+            if sys.version_info >= (3, 8):
+                yield 'fork with shared memory', PrefetchIterator(failing_pipeline(), buffer_size=13, backend='fork', shared_memory_size=4096)
+        yield 'thread', PrefetchIterator(failing_pipeline(), buffer_size=13, backend='thread')
+        yield 'spawn', SpawnPrefetchIterator(failing_pipeline, buffer_size=13)
+        yield 'multi-worker', MultiWorkerPrefetchIterator(lambda num_instances, instance_rank: failing_pipeline(), num_workers=2, buffer_size=13)
+
+    def test(self):
+        for backend, iterator in self.create_iterators():
+            with self.subTest(backend=backend):
+                self.assertRaises(KeyError, list, iterator)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "the PrefetchIterator backend 'fork' requires the fork start method")
+    def test_fork_unpicklable_exception(self):
+        def fail(n):
+            raise KeyError(lambda: n)  # the lambda cannot be pickled
+        iterator = PrefetchIterator(MapIterator(NativeCheckpointableIterator([1]), fail), buffer_size=13, backend='fork')
+        self.assertRaises(RuntimeError, iterator.__next__)
+
+
+def to_pickle_buffer(n):
+    return pickle.PickleBuffer(bytes([n]) * 1500)
+
+
+def count_shared_memory_mappings(_):
+    with open('/proc/self/maps') as f:
+        return sum('/dev/shm/psm_' in line for line in f)  # SharedMemory blocks, as opposed to semaphores
+
+
+@unittest.skipIf(sys.version_info < (3, 8), 'shared memory requires Python 3.8')
+@unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "shared memory is only supported by the PrefetchIterator backend 'fork'")
+class TestPrefetchIteratorSharedMemory(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        data = list(range(53))
+        self.expected_result = [bytes(to_pickle_buffer(n)) for n in data]
+        # items are passed as PickleBuffers, which are sent out-of-band; the ring buffer holds only two items at a time
+        source_iterator = MapIterator(NativeCheckpointableIterator(data), to_pickle_buffer)
+        self.iterator = MapIterator(PrefetchIterator(source_iterator, buffer_size=13, shared_memory_size=3200, backend='fork'), bytes)
+
+    def test_small_items(self):
+        data = list(range(53))
+        it = PrefetchIterator(NativeCheckpointableIterator(data), buffer_size=13, shared_memory_size=1024, backend='fork')
+        self.assertListEqual(list(it), data)
+
+    def test_zero_copy(self):
+        it = PrefetchIterator(MapIterator(NativeCheckpointableIterator(list(range(3))), to_pickle_buffer), buffer_size=2, shared_memory_size=8192,
+                              backend='fork')
+        item = next(it)
+        self.assertIsInstance(item, memoryview)
+        self.assertEqual(bytes(item), bytes(to_pickle_buffer(0)))
+        del item  # release the view before the ring buffer gets closed
+
+    def test_ring_buffer_closed_when_garbage_collected(self):
+        it = PrefetchIterator(MapIterator(NativeCheckpointableIterator(list(range(3))), to_pickle_buffer), buffer_size=2, shared_memory_size=8192,
+                              backend='fork')
+        self.assertEqual(bytes(next(it)), bytes(to_pickle_buffer(0)))
+        ring_buffer = weakref.ref(it._ring_buffer)
+        process = it._prefetch_process
+        del it
+        gc.collect()
+        self.assertIsNone(ring_buffer())
+        self.assertIsNotNone(process.exitcode)
+        infinibatch.iterators._close_shared_memory()
+        self.assertListEqual(infinibatch.iterators._unclosed_shared_memory, [])
+
+
 class Test_chunked_dataset_iterator(TestBase):
     def test_no_shuffle(self):
         items = list(itertools.islice(chunked_dataset_iterator(self.chunk_file_paths, self.read_chunk, shuffle=False, buffer_size=1000), len(self.flattened_test_data)))
@@ -398,6 +1225,18 @@ class Test_chunked_dataset_iterator(TestBase):
         items1 = list(itertools.islice(dataset1, len(self.test_data[1]) + len(self.test_data[3])))
         self.assertMultisetEqual(set(items0 + items1), self.flattened_test_data)
 
+    def test_warmup(self):
+        for use_windowed in (True, False):
+            with self.subTest(use_windowed=use_windowed):
+                create = lambda: chunked_dataset_iterator(self.chunk_file_paths, self.read_chunk, buffer_size=1000, seed=1, use_windowed=use_windowed, warmup_size=2)
+                dataset = create()
+                items = list(itertools.islice(dataset, 5))
+                checkpoint = dataset.getstate()
+                items += list(itertools.islice(dataset, 10))
+                self.assertListEqual(items, list(itertools.islice(create(), 15)))
+                dataset.setstate(checkpoint)
+                self.assertListEqual(list(itertools.islice(dataset, 10)), items[5:])
+
     def test_checkpointing(self):
         random = Random(1)
         for use_windowed in (True, False):
@@ -452,5 +1291,32 @@ class TestBucketedReadaheadBatchIterator(TestBase):
         self.assertListEqual(batches1, batches2)
 
 
+class TestBucketedReadaheadBatchIteratorWarmup(unittest.TestCase, TestCheckpointableIterator):
+    def setUp(self):
+        self.data = [str(n) * (n % 7 + 1) for n in range(300)]
+        create = lambda source: BucketedReadaheadBatchIterator(source, read_ahead=64, key=len, batch_size=4, seed=1, warmup_size=8)
+        self.expected_result = list(create(NativeCheckpointableIterator(self.data)))
+        self.source = NativeCheckpointableIterator(self.data)
+        self.iterator = create(self.source)
+
+    def test_all_items(self):
+        self.assertListEqual(sorted(item for batch in self.expected_result for item in batch), sorted(self.data))
+
+    def test_window_sizes(self):
+        next(self.iterator)
+        self.assertEqual(self.source.getstate()['num_items_yielded'], 8)
+        window_sizes = []
+        for _ in self.iterator:
+            checkpoint = self.iterator.getstate()
+            if not window_sizes or window_sizes[-1] != checkpoint['read_ahead']:
+                window_sizes.append(checkpoint['read_ahead'])
+        self.assertListEqual(window_sizes, [8, 16, 32, 64])
+
+    def test_without_warmup_checkpoint_unchanged(self):
+        it = BucketedReadaheadBatchIterator(NativeCheckpointableIterator(self.data), read_ahead=64, key=len, batch_size=4, seed=1)
+        next(it)
+        self.assertSetEqual(set(it.getstate()), {'source_state', 'random_state', 'num_served'})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,168 @@
+import itertools
+import multiprocessing
+import sys
+import time
+import unittest
+
+from infinibatch.iterators import NativeCheckpointableIterator, MapIterator, FixedBatchIterator, SelectManyIterator, PrefetchIterator, \
+                                  BufferedShuffleIterator, BucketedReadaheadBatchIterator, WindowedIterator
+from infinibatch.profiling import PipelineProfiler, MemoryMonitor, memory_usage, estimate_size
+
+
+def _slow_identity(item):
+    time.sleep(0.001)
+    return item
+
+
+class TestPipelineProfiler(unittest.TestCase):
+    def create_pipeline(self, num_items=50):
+        return FixedBatchIterator(MapIterator(NativeCheckpointableIterator(list(range(num_items))), _slow_identity), batch_size=5)
+
+    def test_results_unchanged(self):
+        expected = list(self.create_pipeline())
+        it = self.create_pipeline()
+        with PipelineProfiler(it):
+            batches = [next(it) for _ in range(3)]
+            checkpoint = it.getstate()
+            batches += list(it)
+            it.setstate(checkpoint)
+            self.assertListEqual(list(it), expected[3:])
+        self.assertListEqual(batches, expected)
+
+    def test_exclusive_time(self):
+        it = self.create_pipeline()
+        with PipelineProfiler(it) as profiler:
+            _ = list(it)
+        batch_stage, map_stage, source_stage = profiler.stats()['stages']
+        self.assertEqual((batch_stage['iterator'], batch_stage['items']), ('FixedBatchIterator', 10))
+        self.assertEqual((map_stage['iterator'], map_stage['items']), ('MapIterator', 50))
+        self.assertEqual((source_stage['iterator'], source_stage['items']), ('NativeCheckpointableIterator', 50))
+        self.assertGreaterEqual(map_stage['seconds'], 0.05)  # the transform sleeps for 1 ms per item
+        self.assertLess(batch_stage['seconds'], map_stage['seconds'] / 5)
+        self.assertLess(source_stage['seconds'], map_stage['seconds'] / 5)
+        self.assertGreaterEqual(map_stage['latency']['p50'], 0.005)  # next_batch() of 5 items
+        self.assertLessEqual(map_stage['latency']['p50'], map_stage['latency']['max'])
+        self.assertEqual(max(profiler.stats()['stages'], key=lambda stage: stage['busy_fraction'])['iterator'], 'MapIterator')
+
+    def test_checkpoint_time(self):
+        it = self.create_pipeline()
+        with PipelineProfiler(it) as profiler:
+            checkpoint = it.getstate()
+            it.setstate(checkpoint)
+        for stage in profiler.stats()['stages']:
+            self.assertEqual(stage['getstate_calls'], 1)
+            self.assertEqual(stage['setstate_calls'], 1)
+            self.assertGreaterEqual(stage['getstate_seconds'], 0.0)
+
+    def test_sampling(self):
+        it = SelectManyIterator(NativeCheckpointableIterator([[n] for n in range(1000)]))
+        with PipelineProfiler(it, sample_every=10) as profiler:
+            _ = list(it)
+        stage = profiler.stats()['stages'][0]
+        self.assertEqual(stage['items'], 1000)
+        self.assertEqual(stage['calls'], 1001)
+        self.assertEqual(len(profiler._profiles[0].latencies), 100)
+
+    def test_reset(self):
+        it = self.create_pipeline()
+        with PipelineProfiler(it) as profiler:
+            _ = next(it)
+            profiler.reset()
+            _ = next(it)
+        self.assertEqual(profiler.stats()['stages'][0]['items'], 1)
+
+    def test_close(self):
+        it = self.create_pipeline()
+        profiler = PipelineProfiler(it)
+        self.assertIsNot(type(it), FixedBatchIterator)
+        profiler.close()
+        self.assertIs(type(it), FixedBatchIterator)
+        _ = next(it)
+        self.assertEqual(profiler.stats()['stages'][0]['items'], 0)
+
+    def test_prefetch(self):
+        it = PrefetchIterator(NativeCheckpointableIterator(list(range(100))), buffer_size=10, backend='thread')
+        with PipelineProfiler(it) as profiler:
+            it.setstate(None)  # restart, since the prefetcher started reading before it was profiled
+            self.assertListEqual(list(it), list(range(100)))
+        prefetch_stage, source_stage = profiler.stats()['stages']
+        self.assertEqual(prefetch_stage['items'], 100)
+        self.assertGreaterEqual(prefetch_stage['stall_seconds'], 0.0)
+        self.assertLessEqual(prefetch_stage['queue_depth']['max'], 10)
+        self.assertEqual(source_stage['items'], 100)  # the source runs on the prefetch thread of the same process
+        self.assertNotIn('stall_seconds', source_stage)
+
+
+class TestMemoryUsage(unittest.TestCase):
+    def test_pipeline(self):
+        shuffled = BufferedShuffleIterator(MapIterator(NativeCheckpointableIterator(list(range(1000))), str), buffer_size=20)
+        it = BucketedReadaheadBatchIterator(shuffled, read_ahead=100, key=len, batch_size=10)
+        _ = next(it)
+        self.assertListEqual([(stage['path'], stage['iterator'], stage['items']) for stage in memory_usage(it)],
+                             [('checkpoint',              'BucketedReadaheadBatchIterator', 100),
+                              ('checkpoint.source_state', 'BufferedShuffleIterator',         20)])
+        constant_size = memory_usage(it, size_estimator=lambda item: 1000)
+        self.assertEqual(constant_size[1]['bytes'], sys.getsizeof(shuffled._buffer) + 20 * 1000)
+        self.assertGreater(constant_size[0]['bytes'], 100 * 1000)
+
+    def test_sampled_size(self):
+        it = BufferedShuffleIterator(NativeCheckpointableIterator([[n] * (n % 2) for n in range(1000)]), buffer_size=100)
+        _ = list(itertools.islice(it, 500))
+        exact = memory_usage(it, max_sampled_items=None)[0]['bytes']
+        sampled = memory_usage(it, max_sampled_items=10)[0]['bytes']
+        self.assertAlmostEqual(sampled / exact, 1.0, delta=0.2)
+        usage = memory_usage(it, size_estimator=lambda item: 8, max_sampled_items=10)[0]
+        self.assertEqual(usage['bytes'], sys.getsizeof(it._buffer) + usage['items'] * 8)
+
+    def test_windowed(self):
+        for typecode in (None, 'd'):
+            with self.subTest(typecode=typecode):
+                it = WindowedIterator(NativeCheckpointableIterator([float(n) for n in range(100)]), 10, typecode=typecode)
+                self.assertEqual(memory_usage(it)[0]['items'], 0)
+                _ = next(it)
+                usage = memory_usage(it)[0]
+                self.assertEqual(usage['items'], 20)
+                self.assertGreaterEqual(usage['bytes'], 20 * 8 if typecode else 20 * sys.getsizeof(1.0))
+
+    def test_prefetch(self):
+        it = PrefetchIterator(NativeCheckpointableIterator(list(range(100))), buffer_size=10, backend='thread')
+        _ = next(it)
+        usage = memory_usage(it)
+        self.assertEqual(len(usage), 1)
+        self.assertLessEqual(usage[0]['items'], 10)
+        _ = list(it)
+        self.assertEqual(memory_usage(it)[0]['items'], 0)
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "the PrefetchIterator backend 'fork' requires the fork start method")
+    def test_fork_prefetch(self):
+        shuffled = BufferedShuffleIterator(NativeCheckpointableIterator(list(range(100))), buffer_size=20)
+        it = PrefetchIterator(shuffled, buffer_size=10, backend='fork')
+        _ = next(it)
+        # the shuffle buffer is filled in the prefetch process; its copy in this process is not reported
+        self.assertListEqual([(stage['path'], stage['iterator']) for stage in memory_usage(it)], [('checkpoint', '_ForkPrefetchIterator')])
+        thread_it = PrefetchIterator(shuffled, buffer_size=10, backend='thread')
+        _ = next(thread_it)
+        self.assertEqual(len(memory_usage(thread_it)), 2)
+
+    def test_estimate_size(self):
+        self.assertEqual(estimate_size([b'abc', (1, 'x')]),
+                         sys.getsizeof([b'abc', (1, 'x')]) + sys.getsizeof(b'abc') + sys.getsizeof((1, 'x')) + sys.getsizeof(1) + sys.getsizeof('x'))
+        self.assertEqual(estimate_size(memoryview(bytes(1000))), sys.getsizeof(memoryview(bytes(1000))) + 1000)
+
+    def test_monitor(self):
+        it = BufferedShuffleIterator(NativeCheckpointableIterator(list(range(100))), buffer_size=10)
+        monitor = MemoryMonitor(it)
+        self.assertEqual(monitor.sample()['items'], 0)
+        _ = list(itertools.islice(it, 50))
+        full = monitor.sample()
+        self.assertEqual(full['items'], 10)
+        _ = list(it)
+        empty = monitor.sample()
+        self.assertEqual(empty['items'], 0)
+        self.assertEqual((empty['peak_items'], empty['peak_bytes']), (10, full['bytes']))
+        monitor.reset()
+        self.assertEqual(monitor.sample()['peak_items'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()